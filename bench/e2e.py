@@ -0,0 +1,359 @@
+"""
+
+Function
+---
+Offline end-to-end benchmark of the `main.py` pipeline on synthetic
+subscriptions and templates. Clash is replaced by `bench/fake_clash.py` and
+`api64.ipify.org` by `bench/echo_server.py`, so no network is needed.
+
+Reports wall time, peak RSS and the time of every stage.
+
+Usage
+---
+python -m bench.e2e --proxies 5000 --subscriptions 4 --templates 3
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import utils.utils
+from config import (
+    ProxyIndex,
+    SubscriptionConfigCollection,
+    TemplateConfig,
+    render_outputs,
+    write_outputs,
+)
+from clash import ClashPool
+from distributed import Coordinator
+from utils.geo import GeoContinent, GeoCountry, GeoLookup, Geometry
+from utils.metrics import metrics
+from utils.probing import AdaptiveTimeout, ProbePolicy
+from utils.speed import ORDER_KEYS
+
+from .echo_server import download_url, start_echo_server
+
+FAKE_CLASH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_clash.py')
+
+COUNTRIES = [
+    ('US', 'NA'),
+    ('JP', 'AS'),
+    ('HK', 'AS'),
+    ('SG', 'AS'),
+    ('TW', 'AS'),
+    ('DE', 'EU'),
+    ('GB', 'EU'),
+    ('BR', 'SA'),
+]
+
+
+def parse_args(init_args=None):
+    parser = argparse.ArgumentParser(description='offline end-to-end benchmark')
+    parser.add_argument('--proxies', type=int, default=1000, help='total proxies')
+    parser.add_argument('--subscriptions', type=int, default=4)
+    parser.add_argument('--hosts', type=int, default=50, help='distinct servers')
+    parser.add_argument(
+        '--duplicates', type=float, default=0.1, help='share of repeated proxies'
+    )
+    parser.add_argument('--templates', type=int, default=3)
+    parser.add_argument('--groups', type=int, default=20, help='groups per template')
+    parser.add_argument('--instances', type=int, default=os.cpu_count() + 1)
+    parser.add_argument('--window', type=int, default=0, help='see --probe-window')
+    parser.add_argument('--no-dedupe', action='store_true', help='see --no-dedupe')
+    parser.add_argument(
+        '--dedupe-ingress', action='store_true', help='see --dedupe-ingress'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='probe on this many local worker processes, sharing --instances',
+    )
+    parser.add_argument(
+        '--kill-worker-after',
+        type=float,
+        help='kill one worker this many seconds into probing',
+    )
+    parser.add_argument('--shard-size', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.01, help='mean seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument(
+        '--speed-test', action='store_true', help='run the speed test stage'
+    )
+    parser.add_argument(
+        '--bandwidth', type=float, default=2**22, help='mean bytes/s of a proxy'
+    )
+    parser.add_argument('--order-by', choices=ORDER_KEYS)
+    parser.add_argument('--startup', type=float, default=0.2, help='Clash startup seconds')
+    parser.add_argument('--probe-timeout', type=float, default=1)
+    parser.add_argument('--retry-ratio', type=float, default=0.05)
+    parser.add_argument('--no-hedge', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the report to this path')
+    parser.add_argument('--probe-report', help='see --probe-report')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args(init_args)
+
+
+def make_subscriptions(args, rng: random.Random):
+    # literal IPs from the benchmarking range, some resolvable names
+    hosts = [f'198.18.{i // 256 % 256}.{i % 256}' for i in range(args.hosts)]
+    for i in range(0, len(hosts), 10):
+        hosts[i] = 'localhost'
+
+    subscriptions = [{'proxies': []} for _ in range(args.subscriptions)]
+    for i in range(args.proxies):
+        subscription = subscriptions[i % args.subscriptions]
+        if subscription['proxies'] and rng.random() < args.duplicates:
+            # same proxy listed again under another name
+            other = rng.choice(subscriptions)['proxies'] or subscription['proxies']
+            proxy = dict(rng.choice(other), name=f'dup-{i}')
+        else:
+            proxy = {
+                'name': f'proxy-{i}',
+                'type': 'ss',
+                'server': rng.choice(hosts),
+                'port': rng.randint(1024, 65535),
+                'cipher': 'chacha20-ietf-poly1305',
+                'password': f'password-{i}',
+            }
+        subscription['proxies'].append(proxy)
+    return subscriptions
+
+
+def make_templates(args, rng: random.Random):
+    templates = []
+    for _ in range(args.templates):
+        groups = [{'name': 'Proxy', 'type': 'select'}]
+        for j in range(args.groups - 1):
+            countries = rng.sample(COUNTRIES, rng.randint(1, 3))
+            groups.append(
+                {
+                    'name': f'group-{j}',
+                    'type': 'select',
+                    'country': [code for code, _ in countries],
+                }
+            )
+        templates.append(
+            {
+                'mixed-port': 7890,
+                'mode': 'rule',
+                'proxy-groups': groups,
+                'rules': ['MATCH,Proxy'],
+            }
+        )
+    return templates
+
+
+class FakeGeoLookup(GeoLookup):
+    """Spreads IPs over `COUNTRIES`, no mmdb needed."""
+
+    def __init__(self) -> None:
+        super().__init__(path='')
+
+    def lookup(self, ip):
+        country, continent = COUNTRIES[int(ip) % len(COUNTRIES)]
+        return Geometry(GeoCountry(country), GeoContinent(continent))
+
+
+def peak_rss_mb():
+    """
+
+    Return
+    ---
+    Peak RSS of this process and of its largest child, in MiB.
+    """
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own / 2**20, children / 2**20
+
+
+def start_workers(args, echo_urls):
+    """Local worker processes connected to a fresh coordinator, sharing
+    `args.instances` fake Clash instances."""
+    authkey = os.urandom(16).hex()
+    coordinator = Coordinator(('127.0.0.1', 0), authkey.encode(), args.shard_size)
+    host, port = coordinator.address
+    command = [
+        sys.executable,
+        '-m',
+        'distributed.worker',
+        f'{host}:{port}',
+        '--clash-bin',
+        f'{sys.executable} {FAKE_CLASH}',
+        '--instances',
+        str(max(1, args.instances // args.workers)),
+        '--probe-window',
+        str(args.window),
+        '--probe-timeout',
+        str(args.probe_timeout),
+        '--probe-retry-ratio',
+        str(args.retry_ratio),
+        '--echo-urls',
+        *echo_urls,
+    ]
+    if args.no_hedge:
+        command.append('--no-hedge')
+    workers = [
+        subprocess.Popen(
+            command + ['--name', f'worker-{i}'],
+            env=dict(os.environ, CLASH_CUSTOMIZER_AUTHKEY=authkey),
+            stderr=None if args.verbose else subprocess.DEVNULL,
+        )
+        for i in range(args.workers)
+    ]
+    deadline = time.monotonic() + 30
+    while coordinator.worker_count < args.workers and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return coordinator, workers
+
+
+class Timer:
+    def __init__(self) -> None:
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start
+            logging.warning(f'[bench] {name}: {self.stages[name]:.3f}s')
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    subscriptions = make_subscriptions(args, rng)
+    templates = make_templates(args, rng)
+
+    os.environ['FAKE_CLASH_STARTUP'] = str(args.startup)
+    os.environ['FAKE_CLASH_LATENCY'] = str(args.latency)
+    os.environ['FAKE_CLASH_FAILURE_RATE'] = str(args.failure_rate)
+    os.environ['FAKE_CLASH_SEED'] = str(args.seed)
+    os.environ['FAKE_CLASH_BANDWIDTH'] = str(args.bandwidth)
+    echo_server, utils.utils.egress_echo_url = start_echo_server()
+    hedge_server, utils.utils.egress_hedge_url = start_echo_server()
+    utils.utils.egress_timeout = args.probe_timeout
+    policy = ProbePolicy(
+        timeout=AdaptiveTimeout(initial=args.probe_timeout),
+        retry_ratio=args.retry_ratio,
+        hedge_percentile=None if args.no_hedge else 0.9,
+    )
+
+    coordinator, workers = None, []
+    if args.workers:
+        coordinator, workers = start_workers(
+            args, [utils.utils.egress_echo_url, utils.utils.egress_hedge_url]
+        )
+        if args.kill_worker_after is not None:
+            threading.Timer(args.kill_worker_after, workers[0].kill).start()
+
+    timer = Timer()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as output_dir, ClashPool(
+        f'{sys.executable} {FAKE_CLASH}', args.instances, window=args.window
+    ) as pool:
+        template_configs = [
+            TemplateConfig(data=data, geometry_key='country') for data in templates
+        ]
+        collection = SubscriptionConfigCollection(
+            data=subscriptions,
+            enable_renames=[True] * len(subscriptions),
+            names=[f'S{i}.' for i in range(len(subscriptions))],
+        )
+        with timer.stage('update_ingress_IPs'):
+            collection.update_ingress_IPs()
+        with timer.stage('update_egress_IPs'):
+            collection.update_egress_IPs(
+                None,
+                pool=pool,
+                dedupe=not args.no_dedupe,
+                dedupe_ingress=args.dedupe_ingress,
+                policy=policy,
+                coordinator=coordinator,
+                report_path=args.probe_report,
+            )
+        with timer.stage('log_proxies_info'):
+            collection.log_proxies_info()
+        with timer.stage('purify_proxies'):
+            collection.purify_proxies()
+        if args.speed_test:
+            with timer.stage('update_speed'):
+                collection.update_speed(
+                    None,
+                    download_url(utils.utils.egress_echo_url, 2**18),
+                    pool=pool,
+                )
+        with timer.stage('update_geometry'):
+            collection.update_geometry(FakeGeoLookup())
+        with timer.stage('rename_proxies'):
+            country_map = collection.rename_proxies(
+                '{iso_code}.{seq:02}',
+                'IPv6.{iso_code}.{seq:02}',
+                [f'S{i}.' for i in range(len(subscriptions))],
+                args.order_by,
+            )
+        with timer.stage('inject'):
+            texts = render_outputs(template_configs, ProxyIndex(country_map))
+        with timer.stage('save'):
+            write_outputs(
+                [os.path.join(output_dir, f'output-{i}.yml') for i in range(args.templates)],
+                texts,
+            )
+        valid = len(collection.proxies)
+    wall = time.perf_counter() - start
+    if coordinator is not None:
+        coordinator.close(stop_workers=True)
+        for worker in workers:
+            worker.wait()
+    echo_server.shutdown()
+    hedge_server.shutdown()
+
+    rss_self, rss_children = peak_rss_mb()
+    return {
+        'params': vars(args),
+        'wall_s': wall,
+        'peak_rss_mb': rss_self,
+        'peak_rss_children_mb': rss_children,
+        'valid_proxies': valid,
+        'stages_s': timer.stages,
+        'metrics': metrics.to_json()['metrics'],
+    }
+
+
+def print_report(report):
+    print(f'proxies        {report["params"]["proxies"]} ({report["valid_proxies"]} valid)')
+    print(f'wall           {report["wall_s"]:.3f}s')
+    print(f'peak rss       {report["peak_rss_mb"]:.1f} MiB')
+    print(f'peak rss child {report["peak_rss_children_mb"]:.1f} MiB')
+    for name, seconds in report['stages_s'].items():
+        print(f'  {name:<20} {seconds:.3f}s')
+
+
+def main(init_args=None):
+    args = parse_args(init_args)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='[%(asctime)s] [%(levelname)s] %(message)s',
+        datefmt='%m-%d %H:%M:%S',
+    )
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(report, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+
+Function
+---
+Local stand-in for `api64.ipify.org`: answers every GET with the
+`X-Egress-IP` header set by `bench/fake_clash.py`, or the client address.
+
+`GET /__down?bytes=N` answers `N` zero bytes instead, standing in for the
+speed test endpoint.
+"""
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class EchoServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # many probes connect at once
+    request_queue_size = 1024
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        url = urlsplit(self.path)
+        if url.path == '/__down':
+            return bytes(int(parse_qs(url.query).get('bytes', ['0'])[0]))
+        return self.headers.get('X-Egress-IP', self.client_address[0]).encode()
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(self._body())))
+        self.end_headers()
+
+    def do_GET(self):
+        data = self._body()
+        self.do_HEAD()
+        self.wfile.write(data)
+
+
+def start_echo_server(port: int = 0):
+    """Serve in a daemon thread.
+
+    Return
+    ---
+    `(server, url)`, call `server.shutdown()` to stop.
+    """
+    server = EchoServer(('127.0.0.1', port), EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def download_url(echo_url: str, size: int = 2**20):
+    return f'{echo_url}__down?bytes={size}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    args = parser.parse_args()
+    server = EchoServer(('127.0.0.1', args.port), EchoHandler)
+    print(f'echo server on http://127.0.0.1:{args.port}/')
+    server.serve_forever()
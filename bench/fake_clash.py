@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+
+Function
+---
+Stand-in for the Clash binary, for offline benchmarks. Invoked like Clash
+(`fake_clash.py -f config`), it serves the external controller API
+(`GET /version`, `PUT /proxies/GLOBAL`, `PUT /configs`) and an http(s) proxy
+on `port`/`mixed-port` and on every `listeners` entry.
+
+Proxied requests get an `X-Egress-IP` header derived from the selected
+proxy's server and port, which `bench/echo_server.py` echoes back.
+
+Environment
+---
+- FAKE_CLASH_STARTUP: seconds before the controller answers, default 0
+- FAKE_CLASH_LATENCY: mean seconds added per proxied request, default 0
+- FAKE_CLASH_FAILURE_RATE: share of proxies that never answer, default 0
+- FAKE_CLASH_BANDWIDTH: mean bytes per second of a proxy, default 0 for
+  unlimited
+- FAKE_CLASH_SEED: seed of the per-proxy failures and latencies
+"""
+import argparse
+import hashlib
+import http.client
+import ipaddress
+import json
+import os
+import random
+import select
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+STARTUP = float(os.environ.get('FAKE_CLASH_STARTUP', 0))
+LATENCY = float(os.environ.get('FAKE_CLASH_LATENCY', 0))
+FAILURE_RATE = float(os.environ.get('FAKE_CLASH_FAILURE_RATE', 0))
+SEED = os.environ.get('FAKE_CLASH_SEED', '0')
+BANDWIDTH = float(os.environ.get('FAKE_CLASH_BANDWIDTH', 0))
+
+# how long a failing proxy hangs before dropping the connection
+HANG = 60
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class State:
+    config: dict = {}
+    proxies: dict = {}
+    selected = 'DIRECT'
+    lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as fd:
+            config = json.load(fd)
+        with cls.lock:
+            cls.config = config
+            cls.proxies = {p['name']: p for p in config.get('proxies') or []}
+            if cls.selected not in cls.proxies:
+                cls.selected = 'DIRECT'
+
+    @classmethod
+    def listener_proxy(cls, port):
+        for listener in cls.config.get('listeners', []):
+            if listener['port'] == port:
+                return listener.get('proxy', 'DIRECT')
+        return cls.selected
+
+
+def profile(proxy: dict):
+    """
+
+    Return
+    ---
+    `(egress IP, latency, bandwidth, dead)` of a proxy, stable across runs.
+    """
+    key = f'{SEED}|{proxy.get("server")}|{proxy.get("port")}'
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    rng = random.Random(digest)
+    egress = ipaddress.IPv4Address(
+        (198 << 24) | (18 << 16) | int.from_bytes(digest[:2], 'big')
+    )
+    latency = rng.expovariate(1 / LATENCY) if LATENCY else 0
+    bandwidth = rng.expovariate(1 / BANDWIDTH) if BANDWIDTH else 0
+    return str(egress), latency, bandwidth, rng.random() < FAILURE_RATE
+
+
+class ControllerHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/version':
+            self._reply(200, {'version': 'fake'})
+        else:
+            self._reply(404, {'message': 'not found'})
+
+    def do_PUT(self):
+        path = urlsplit(self.path).path
+        body = self._body()
+        if path == '/proxies/GLOBAL':
+            if body.get('name') not in State.proxies:
+                self._reply(400, {'message': 'proxy not exist'})
+                return
+            State.selected = body['name']
+            self._reply(204)
+        elif path == '/configs':
+            try:
+                State.load(body['path'])
+            except (KeyError, OSError, ValueError) as e:
+                self._reply(400, {'message': str(e)})
+                return
+            serve_listeners()
+            self._reply(204)
+        else:
+            self._reply(404, {'message': 'not found'})
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _route(self):
+        """
+
+        Return
+        ---
+        `(egress IP, bandwidth)` of the proxy serving this port, `None` for
+        DIRECT.
+        """
+        name = State.listener_proxy(self.server.server_address[1])
+        proxy = State.proxies.get(name)
+        if proxy is None:
+            return None, 0
+        egress, latency, bandwidth, dead = profile(proxy)
+        if dead:
+            time.sleep(HANG)
+            raise ConnectionAbortedError
+        time.sleep(latency)
+        return egress, bandwidth
+
+    def _forward(self, method):
+        try:
+            egress, bandwidth = self._route()
+        except ConnectionAbortedError:
+            self.close_connection = True
+            return
+        url = urlsplit(self.path)
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+        headers = {
+            k: v for k, v in self.headers.items() if k.lower() != 'proxy-connection'
+        }
+        if egress is not None:
+            headers['X-Egress-IP'] = egress
+        path = (url.path or '/') + (f'?{url.query}' if url.query else '')
+        conn.request(method, path, headers=headers)
+        r = conn.getresponse()
+        data = r.read()
+        self.send_response(r.status)
+        self.send_header('Content-Length', r.getheader('Content-Length', '0'))
+        self.end_headers()
+        for start in range(0, len(data), 2**16):
+            chunk = data[start : start + 2**16]
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+            self.wfile.write(chunk)
+        conn.close()
+
+    def do_GET(self):
+        self._forward('GET')
+
+    def do_HEAD(self):
+        self._forward('HEAD')
+
+    def do_CONNECT(self):
+        try:
+            self._route()
+        except ConnectionAbortedError:
+            self.close_connection = True
+            return
+        host, port = self.path.rsplit(':', 1)
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=10)
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        sockets = [self.connection, upstream]
+        while True:
+            readable, _, _ = select.select(sockets, [], [], 10)
+            if not readable:
+                break
+            for s in readable:
+                data = s.recv(65536)
+                if not data:
+                    upstream.close()
+                    return
+                (upstream if s is self.connection else self.connection).sendall(data)
+        upstream.close()
+
+
+listeners = {}
+
+
+def serve(port, handler):
+    server = Server(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_listeners():
+    ports = [State.config.get('port') or State.config.get('mixed-port')]
+    ports += [listener['port'] for listener in State.config.get('listeners', [])]
+    for port in ports:
+        if port and port not in listeners:
+            listeners[port] = serve(port, ProxyHandler)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', dest='config', required=True)
+    args = parser.parse_args()
+
+    State.load(args.config)
+    serve_listeners()
+    time.sleep(STARTUP)
+    controller_port = int(State.config['external-controller'].rsplit(':', 1)[1])
+    print(f'fake clash, controller on {controller_port}', flush=True)
+    Server(('127.0.0.1', controller_port), ControllerHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+
+Function
+---
+Micro-benchmarks of the pure-Python hot paths on synthetic fixtures, each
+function timed in isolation: `rename_proxies`, `TemplateConfig.inject`,
+`TemplateConfig.render`, `purify_proxies`, `designate_jobs`,
+`get_tcp_port_picker` and `fast_update.main`.
+
+Every benchmark runs `--repeat` times on a fresh fixture and reports the
+fastest run. Results can be saved as a baseline and later compared against
+it, the exit code is `1` if any benchmark got slower than `--threshold`.
+
+Usage
+---
+python -m bench.micro --proxies 100 1000 100000 --groups 10 1000
+python -m bench.micro --save-baseline baseline.json
+python -m bench.micro --compare baseline.json --profile prof/ --tracemalloc
+"""
+import argparse
+import contextlib
+import copy
+import cProfile
+import fnmatch
+import gc
+import ipaddress
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from config import ProxyIndex, SubscriptionConfigCollection, TemplateConfig
+from config.output import RenderedProxies
+from utils import designate_jobs, dump_yaml, get_tcp_port_picker
+from utils import fast_update
+from utils.geo import GeoContinent, GeoCountry, Geometry
+
+from .e2e import COUNTRIES
+
+SUBSCRIPTIONS = 4
+
+
+def parse_args(init_args=None):
+    parser = argparse.ArgumentParser(description='micro-benchmarks')
+    parser.add_argument(
+        '--proxies', type=int, nargs='+', default=[100, 1000, 10000]
+    )
+    parser.add_argument('--groups', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '-k', dest='patterns', nargs='+', help='only benchmarks matching a glob'
+    )
+    parser.add_argument('--save-baseline', help='save the results to this path')
+    parser.add_argument('--compare', help='compare with the baseline at this path')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.2,
+        help='slowdown ratio counted as a regression (default: %(default)s)',
+    )
+    parser.add_argument('--profile', help='write a cProfile file per benchmark here')
+    parser.add_argument(
+        '--tracemalloc', action='store_true', help='report peak traced memory'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(init_args)
+
+
+class Fixture:
+    """Synthetic subscriptions and templates, built once per size."""
+
+    def __init__(self, proxies: int, groups: int, seed: int = 0) -> None:
+        self.proxy_count = proxies
+        self.group_count = groups
+        rng = random.Random(seed)
+        self.subscriptions = [{'proxies': []} for _ in range(SUBSCRIPTIONS)]
+        for i in range(proxies):
+            self.subscriptions[i % SUBSCRIPTIONS]['proxies'].append(
+                {
+                    'name': f'proxy-{i}',
+                    'type': 'ss',
+                    'server': f'198.18.{i // 256 % 256}.{i % 256}',
+                    'port': 1024 + i % 60000,
+                    'cipher': 'chacha20-ietf-poly1305',
+                    'password': f'password-{i}',
+                }
+            )
+        # about one in ten proxies shares its ingress and egress with another
+        self.egress = [rng.randrange(proxies) for _ in range(proxies)]
+        for i in range(proxies):
+            if rng.random() > 0.1:
+                self.egress[i] = i
+        groups_data = [{'name': 'Proxy', 'type': 'select'}]
+        for j in range(groups - 1):
+            countries = rng.sample(COUNTRIES, rng.randint(1, 3))
+            groups_data.append(
+                {
+                    'name': f'group-{j}',
+                    'type': 'select',
+                    'country': [code for code, _ in countries],
+                }
+            )
+        self.template = {
+            'mixed-port': 7890,
+            'mode': 'rule',
+            'proxy-groups': groups_data,
+            'rules': ['MATCH,Proxy'],
+        }
+        self._country_map = None
+        # files of the fast_update benchmark, removed with the fixture
+        self.directory = tempfile.TemporaryDirectory(prefix='bench-micro-')
+
+    def collection(self):
+        """A fresh collection with probe results and geometry filled in."""
+        collection = SubscriptionConfigCollection(
+            data=copy.deepcopy(self.subscriptions),
+            enable_renames=[True] * SUBSCRIPTIONS,
+        )
+        for i, proxy in enumerate(collection.proxies):
+            key = self.egress[i]
+            proxy.ingress_ip = ipaddress.IPv4Address(0xC6120000 + key)
+            proxy.egress_ip = ipaddress.IPv4Address(0x0A000000 + key)
+            country, continent = COUNTRIES[key % len(COUNTRIES)]
+            proxy.geometry = Geometry(GeoCountry(country), GeoContinent(continent))
+        return collection
+
+    def country_map(self):
+        if self._country_map is None:
+            self._country_map = rename(self.collection())
+        return self._country_map
+
+
+def rename(collection: SubscriptionConfigCollection):
+    return collection.rename_proxies(
+        '{iso_code}.{seq:02}',
+        'IPv6.{iso_code}.{seq:02}',
+        [f'S{i}.' for i in range(SUBSCRIPTIONS)],
+    )
+
+
+# a setup takes the fixture and returns the call to time
+Setup = Callable[[Fixture], Callable[[], object]]
+
+
+class Benchmark(NamedTuple):
+    name: str
+    setup: Setup
+    # whether the result depends on the number of proxy groups
+    uses_groups: bool = False
+
+
+def setup_rename(fixture: Fixture):
+    collection = fixture.collection()
+    return lambda: rename(collection)
+
+
+def setup_purify(fixture: Fixture):
+    collection = fixture.collection()
+    return collection.purify_proxies
+
+
+def setup_inject(fixture: Fixture):
+    country_map = fixture.country_map()
+    template_config = TemplateConfig(copy.deepcopy(fixture.template), 'country')
+    return lambda: template_config.inject(country_map)
+
+
+def setup_render(fixture: Fixture):
+    country_map = fixture.country_map()
+    template_config = TemplateConfig(copy.deepcopy(fixture.template), 'country')
+    return lambda: template_config.render(RenderedProxies(ProxyIndex(country_map)))
+
+
+def setup_designate_jobs(fixture: Fixture):
+    jobs = list(range(fixture.proxy_count))
+    return lambda: designate_jobs(jobs, os.cpu_count() + 1)
+
+
+def setup_port_picker(fixture: Fixture):
+    # ports of a pool of cpu_count + 1 instances with 16 listeners each
+    count = (os.cpu_count() + 1) * 18
+
+    def pick():
+        picker = get_tcp_port_picker()
+        return [next(picker) for _ in range(count)]
+
+    return pick
+
+
+def setup_fast_update(fixture: Fixture):
+    config_path = os.path.join(fixture.directory.name, 'config.yml')
+    template_path = os.path.join(fixture.directory.name, 'template.yml')
+    template_config = TemplateConfig(copy.deepcopy(fixture.template), 'country')
+    template_config.inject(fixture.country_map())
+    with open(config_path, 'w', encoding='utf-8') as fd:
+        dump_yaml(template_config.data, fd)
+    # a rules update touching one proxy
+    template = copy.deepcopy(fixture.template)
+    template['rules'] = ['MATCH,DIRECT']
+    template['proxies'] = [dict(template_config['proxies'][0], udp=True)]
+    with open(template_path, 'w', encoding='utf-8') as fd:
+        dump_yaml(template, fd)
+
+    def update():
+        with contextlib.redirect_stdout(None):
+            fast_update.main([config_path, template_path])
+
+    return update
+
+
+BENCHMARKS = [
+    Benchmark('rename_proxies', setup_rename),
+    Benchmark('purify_proxies', setup_purify),
+    Benchmark('inject', setup_inject, uses_groups=True),
+    Benchmark('render', setup_render, uses_groups=True),
+    Benchmark('designate_jobs', setup_designate_jobs),
+    Benchmark('get_tcp_port_picker', setup_port_picker),
+    Benchmark('fast_update', setup_fast_update, uses_groups=True),
+]
+
+
+def run_one(
+    benchmark: Benchmark, fixture: Fixture, args, bench_id: str
+) -> Dict[str, float]:
+    """
+
+    Return
+    ---
+    Fastest of `args.repeat` runs in seconds, and the peak traced memory of
+    one more run in KiB if asked.
+    """
+    best = float('inf')
+    for _ in range(args.repeat):
+        call = benchmark.setup(fixture)
+        gc.collect()
+        start = time.perf_counter()
+        call()
+        best = min(best, time.perf_counter() - start)
+    result = {'seconds': best}
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+        call = benchmark.setup(fixture)
+        profiler = cProfile.Profile()
+        profiler.runcall(call)
+        name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in bench_id)
+        profiler.dump_stats(os.path.join(args.profile, name + '.prof'))
+    if args.tracemalloc:
+        call = benchmark.setup(fixture)
+        tracemalloc.start()
+        call()
+        result['peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return result
+
+
+def cases(args) -> List[Tuple[str, Benchmark, int, int]]:
+    ret = []
+    # grouped by fixture, which is built once
+    for proxies in args.proxies:
+        for i, groups in enumerate(args.groups):
+            for benchmark in BENCHMARKS:
+                if i and not benchmark.uses_groups:
+                    continue
+                bench_id = f'{benchmark.name}[proxies={proxies}'
+                bench_id += f',groups={groups}]' if benchmark.uses_groups else ']'
+                if args.patterns and not any(
+                    fnmatch.fnmatch(bench_id, pattern) for pattern in args.patterns
+                ):
+                    continue
+                ret.append((bench_id, benchmark, proxies, groups))
+    return ret
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float):
+    """
+
+    Return
+    ---
+    Ids of benchmarks slower than `threshold` times their baseline.
+    """
+    regressions = []
+    print(f'{"benchmark":<50} {"baseline":>10} {"now":>10} {"ratio":>7}')
+    for bench_id, result in results.items():
+        if bench_id not in baseline:
+            continue
+        before = baseline[bench_id]['seconds']
+        ratio = result['seconds'] / before if before else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions.append(bench_id)
+        print(
+            f'{bench_id:<50} {before * 1000:>8.2f}ms '
+            f'{result["seconds"] * 1000:>8.2f}ms {ratio:>6.2f}x{flag}'
+        )
+    return regressions
+
+
+def main(init_args=None):
+    args = parse_args(init_args)
+    fixtures: Dict[Tuple[int, int], Fixture] = {}
+    results: Dict[str, dict] = {}
+    for bench_id, benchmark, proxies, groups in cases(args):
+        if (proxies, groups) not in fixtures:
+            fixtures.clear()
+            fixtures[proxies, groups] = Fixture(proxies, groups, args.seed)
+        result = run_one(benchmark, fixtures[proxies, groups], args, bench_id)
+        results[bench_id] = result
+        line = f'{bench_id:<50} {result["seconds"] * 1000:>10.2f}ms'
+        if 'peak_kib' in result:
+            line += f' {result["peak_kib"]:>10.0f}KiB'
+        print(line, flush=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fd:
+            json.dump(results, fd, indent=2)
+        print(f'baseline saved to {args.save_baseline}')
+    if args.compare:
+        with open(args.compare, 'r') as fd:
+            baseline = json.load(fd)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+
+Function
+---
+Startup budget of the command line entries: wall time of each command in a
+fresh interpreter, next to a bare `python -c pass`, and the modules that
+took longest to import. The exit code is `1` if a command took longer than
+`--budget` milliseconds on top of the bare interpreter.
+
+Usage
+---
+python -m bench.startup --budget 75
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence
+
+from utils.serialization import dump_yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(init_args=None):
+    parser = argparse.ArgumentParser(description='startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=75,
+        help='milliseconds a command may add to the bare interpreter '
+        '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--top', type=int, default=5, help='slowest imports shown per command'
+    )
+    return parser.parse_args(init_args)
+
+
+def commands(directory: str) -> Dict[str, List[str]]:
+    config_path = os.path.join(directory, 'config.yml')
+    template_path = os.path.join(directory, 'template.yml')
+    proxies = [
+        {'name': f'proxy-{i}', 'type': 'ss', 'server': '198.18.0.1', 'port': i}
+        for i in range(1, 11)
+    ]
+    with open(config_path, 'w', encoding='utf-8') as fd:
+        dump_yaml({'proxies': proxies, 'rules': ['MATCH,Proxy']}, fd)
+    with open(template_path, 'w', encoding='utf-8') as fd:
+        dump_yaml({'mode': 'rule', 'rules': ['MATCH,DIRECT']}, fd)
+    return {
+        'main --help': ['main.py', '--help'],
+        'fast_update --help': ['-m', 'utils.fast_update', '--help'],
+        'fast_update': ['-m', 'utils.fast_update', config_path, template_path],
+    }
+
+
+def run(args: Sequence[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, *args],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def slowest_imports(args: Sequence[str], top: int):
+    """
+
+    Return
+    ---
+    `(cumulative microseconds, module)` of the `top` slowest top-level
+    imports, from `-X importtime`.
+    """
+    r = subprocess.run(
+        [sys.executable, '-X', 'importtime', *args],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    imports = []
+    for line in r.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:') :].split('|')
+        # top-level imports are not indented
+        if not name[1:].startswith(' '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(init_args=None):
+    args = parse_args(init_args)
+    bare = min(run(['-c', 'pass']) for _ in range(args.repeat))
+    print(f'{"python -c pass":<24} {bare * 1000:>8.1f}ms')
+    over = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, command in commands(directory).items():
+            best = min(run(command) for _ in range(args.repeat))
+            extra = (best - bare) * 1000
+            flag = ''
+            if extra > args.budget:
+                flag = '  OVER BUDGET'
+                over.append(name)
+            print(f'{name:<24} {best * 1000:>8.1f}ms  +{extra:.1f}ms{flag}')
+            for cumulative, module in slowest_imports(command, args.top):
+                print(f'    {module:<40} {cumulative / 1000:>8.1f}ms')
+    if over:
+        print(f'{len(over)} commands over the {args.budget:.0f}ms budget')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
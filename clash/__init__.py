@@ -1 +1,2 @@
-from .clash import Clash
\ No newline at end of file
+from .clash import Clash, ClashStartupError
+from .pool import ClashPool
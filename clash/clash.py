@@ -4,80 +4,170 @@ import time
 import os
 import subprocess
 import tempfile
+from typing import Union
 
 import requests
 from config.config import Config
+from utils.metrics import metrics
+from utils.serialization import dump_json
 
-import yaml
+
+# tmpfs if available, configs are written once and read once
+CONFIG_DIR = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
+
+class ClashStartupError(RuntimeError):
+    pass
 
 
 class Clash:
-    def __init__(self, bin: str, config: Config) -> None:
+    def __init__(self, bin: str, config: Config, startup_timeout: float = 10) -> None:
         self.bin = bin
         self.config = config
+        self.startup_timeout = startup_timeout
         self._config_name = self._dump_config()
         self._log_fd = tempfile.SpooledTemporaryFile()
         self._start()
         self._requested_switch_count = 0
         self._success_switch_count = 0
 
-    def switch_proxy(self, proxy_name: str):
+    def switch_proxy(self, proxy_name: str, timeout: float = 1, retries: int = 1):
+        """
+
+        Args
+        ---
+        - retries: attempts after a request error, e.g. a busy controller.
+        """
         self._requested_switch_count += 1
         payload = {'name': proxy_name}
         ret = False
-        try:
-            r = requests.put(
-                url=self.config.controller + '/proxies/GLOBAL',
-                data=json.dumps(payload),
-                timeout=1,
-            )
+        for _ in range(1 + retries):
+            try:
+                r = requests.put(
+                    url=self.config.controller + '/proxies/GLOBAL',
+                    data=json.dumps(payload),
+                    timeout=timeout,
+                )
+            except requests.RequestException:
+                continue
             if r.status_code == 204:
                 self._success_switch_count += 1
                 ret = True
-        except:
-            ret = False
-        if len(self.config.proxies) == self._requested_switch_count:
+            break
+        if len(self.config.proxies or []) == self._requested_switch_count:
             if self._success_switch_count == 0:
                 logging.warning(f'[clash] no successful switching')
                 self._print_log()
         return ret
 
+    def reload(self, config: Config):
+        """Load a new config into the running instance.
+
+        The controller and proxy ports of `config` have to stay the same.
+
+        Return
+        ---
+        `True` on success.
+        """
+        self.config = config
+        self._dump_config(self._config_name)
+        self._requested_switch_count = 0
+        self._success_switch_count = 0
+        try:
+            r = requests.put(
+                url=self.config.controller + '/configs',
+                params={'force': 'true'},
+                data=json.dumps({'path': self._config_name}),
+                timeout=self.startup_timeout,
+            )
+        except requests.exceptions.RequestException:
+            return False
+        logging.debug(
+            f'[clash] reload, {len(config.proxies or [])} proxies, '
+            f'status {r.status_code}'
+        )
+        return r.status_code == 204
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
     def _start(self):
         logging.info(
             f'[clash] new clash, '
             f'{len(self.config.proxies)} proxies, '
             f'config is {self._config_name}'
         )
+        start = time.monotonic()
         self._proc = subprocess.Popen(
             f'{self.bin} -f {self._config_name}'.split(' '),
             stdout=self._log_fd,
             stderr=self._log_fd,
         )
-        time.sleep(3)
+        self._wait_ready(deadline=start + self.startup_timeout)
+        seconds = time.monotonic() - start
+        metrics.inc('clash_starts_total')
+        metrics.observe('clash_startup_seconds', seconds)
+        logging.debug(f'[clash] ready in {seconds:.3f}s')
 
-    def _dump_config(self):
-        fd = tempfile.NamedTemporaryFile('w', encoding='utf-8', delete=False)
-        yaml.safe_dump(self.config.data, fd, allow_unicode=True)
+    def _wait_ready(self, deadline: float):
+        """Poll the external controller until it answers."""
+        while True:
+            if self._proc.poll() is not None:
+                reason = f'exited with code {self._proc.returncode}'
+                break
+            try:
+                r = requests.get(self.config.controller + '/version', timeout=0.5)
+                if r.status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                reason = f'not ready in {self.startup_timeout}s'
+                break
+            time.sleep(0.05)
+        self._proc.kill()
+        raise ClashStartupError(
+            f'[clash] {reason}, config {self._config_name}, log:\n{self._read_log()}'
+        )
+
+    def _dump_config(self, path: Union[str, None] = None):
+        # JSON is valid YAML and much faster to dump
+        if path is None:
+            fd = tempfile.NamedTemporaryFile(
+                'w', suffix='.json', dir=CONFIG_DIR, encoding='utf-8', delete=False
+            )
+        else:
+            fd = open(path, 'w', encoding='utf-8')
+        dump_json(self.config.data, fd)
         fd.close()
         return fd.name
 
+    def _read_log(self):
+        self._log_fd.seek(0)
+        return str(self._log_fd.read(), encoding='utf-8', errors='replace')
+
     def _print_log(self):
         self._proc.kill()
-        self._log_fd.seek(0)
-        log = ''.join([str(b, encoding='utf-8') for b in self._log_fd.readlines()])
         logging.debug('Clash log')
-        logging.debug(log)
+        logging.debug(self._read_log())
 
-    def __del__(self):
+    def close(self):
         try:
             self._proc.kill()
+            self._proc.wait()
         except:
             pass
 
         try:
             os.remove(self._config_name)
+        except FileNotFoundError:
+            pass
         except Exception as e:
             logging.warning(
                 f'Failed to delete temporary Clash config "{self._config_name}", '
                 f'error type {type(e)}'
             )
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,162 @@
+import contextlib
+import logging
+import queue
+import socket
+import threading
+from typing import Callable, List, MutableMapping, Sequence, Tuple, Union
+
+from config.config import Config
+from utils import make_listeners_clash_config, make_simple_clash_config
+from utils.metrics import metrics
+
+from .clash import Clash, ClashStartupError
+
+
+class ClashPool:
+    """Long-lived Clash instances, loaded with new proxies via hot reload.
+
+    Crashed instances are restarted on their next use. Use as a context
+    manager, or call `close` to stop every instance.
+
+    With a non-zero `window`, instances get one listener per proxy and
+    take at most `window` proxies at a time, see `make_listeners_clash_config`.
+
+    `bin` may be a function returning the path, called when the first
+    instance starts, e.g. to download Clash only if it is needed.
+
+    Ports are picked by the OS and held until their instance starts, so that
+    pools of other processes on the host do not pick them as well.
+    """
+
+    def __init__(
+        self,
+        bin: Union[str, Callable[[], str]],
+        size: int,
+        startup_timeout: float = 10,
+        window: int = 0,
+    ) -> None:
+        self._bin = bin
+        self.size = size
+        self.startup_timeout = startup_timeout
+        self.window = window
+        self._lock = threading.Lock()
+        # sockets holding the ports of instances not started yet
+        self._held: List[List[socket.socket]] = [[] for _ in range(size)]
+        self._ports = [self._reserve_ports(slot) for slot in range(size)]
+        self._instances: List[Union[Clash, None]] = [None] * size
+        self._idle: queue.Queue = queue.Queue()
+        for slot in range(size):
+            self._idle.put(slot)
+
+    @contextlib.contextmanager
+    def acquire(self, proxies: Sequence[MutableMapping]):
+        """Borrow an instance loaded with `proxies`.
+
+        Raise
+        ---
+        `ClashStartupError` if no instance could be started.
+        """
+        slot = self._idle.get()
+        try:
+            yield self._load(slot, proxies)
+        finally:
+            self._idle.put(slot)
+
+    @property
+    def bin(self) -> str:
+        with self._lock:
+            if callable(self._bin):
+                self._bin = self._bin()
+            return self._bin
+
+    def close(self):
+        for slot in range(self.size):
+            self._release_ports(slot)
+        for slot, clash in enumerate(self._instances):
+            if clash is not None:
+                clash.close()
+                self._instances[slot] = None
+                metrics.inc('clash_instances', -1)
+        logging.info(f'[clash pool] closed, ports {self._ports} released')
+
+    def _reserve_ports(self, slot: int) -> Tuple[int, ...]:
+        """Hold free ports for the instance of `slot`, until `_release_ports`.
+
+        Return
+        ---
+        Controller port, proxy port, then `window` listener ports.
+        """
+        self._release_ports(slot)
+        for _ in range(2 + self.window):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Clash listens on every interface
+            sock.bind(('', 0))
+            self._held[slot].append(sock)
+        return tuple(sock.getsockname()[1] for sock in self._held[slot])
+
+    def _release_ports(self, slot: int):
+        for sock in self._held[slot]:
+            sock.close()
+        self._held[slot] = []
+
+    def _make_config(self, slot: int, proxies: Sequence[MutableMapping]):
+        controller_port, proxy_port, *listener_ports = self._ports[slot]
+        if self.window:
+            return Config(
+                make_listeners_clash_config(
+                    controller_port=controller_port,
+                    listener_ports=listener_ports,
+                    proxies=list(proxies),
+                )
+            )
+        return Config(
+            make_simple_clash_config(
+                controller_port=controller_port,
+                proxy_port=proxy_port,
+                proxies=list(proxies),
+            )
+        )
+
+    def _load(self, slot: int, proxies: Sequence[MutableMapping]):
+        clash = self._instances[slot]
+        if clash is not None:
+            if clash.alive and clash.reload(self._make_config(slot, proxies)):
+                return clash
+            logging.warning(f'[clash pool] instance {slot} is down, restarting')
+            clash.close()
+            self._instances[slot] = None
+            metrics.inc('clash_instances', -1)
+
+        if not self._held[slot]:
+            # the ports went with an instance that is down, anyone may have
+            # them now
+            self._ports[slot] = self._reserve_ports(slot)
+        config = self._make_config(slot, proxies)
+        # resolved before the ports are let go, it may download Clash
+        bin = self.bin
+        try:
+            self._release_ports(slot)
+            clash = Clash(
+                bin=bin,
+                config=config,
+                startup_timeout=self.startup_timeout,
+            )
+        except ClashStartupError as e:
+            # the ports may have been taken since they were released, retry once
+            logging.warning(str(e))
+            self._ports[slot] = self._reserve_ports(slot)
+            self._release_ports(slot)
+            clash = Clash(
+                bin=self.bin,
+                config=self._make_config(slot, proxies),
+                startup_timeout=self.startup_timeout,
+            )
+        self._instances[slot] = clash
+        metrics.inc('clash_instances')
+        return clash
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -2,4 +2,6 @@ from .subscription_config import SubscriptionConfig
 from .subscription_config_collection import SubscriptionConfigCollection
 from .template_config import TemplateConfig
 from .config import Config
-from .proxy import Proxy
\ No newline at end of file
+from .proxy import Proxy, ProbeError
+from .render_plan import ProxyIndex
+from .output import RenderedProxies, render_outputs, save_outputs, write_outputs
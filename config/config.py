@@ -42,6 +42,14 @@ class Config:
                 raise e('http(s) proxy port needed')
         return f'http://127.0.0.1:{port}'
 
+    @property
+    def listener_proxies(self):
+        """http(s) proxies of the `listeners`, in order."""
+        return [
+            f'http://127.0.0.1:{listener["port"]}'
+            for listener in self.data.get('listeners', [])
+        ]
+
     def __getitem__(self, key):
         return self.data[key]
 
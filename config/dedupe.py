@@ -0,0 +1,38 @@
+from typing import Dict, List, Sequence
+
+from .proxy import Proxy
+
+
+def group_by_fingerprint(proxies: Sequence[Proxy]) -> List[List[Proxy]]:
+    """Group proxies with the same connection parameters.
+
+    Notice
+    ---
+    Order kept, the first proxy of a group is its representative.
+    """
+    groups: Dict[str, List[Proxy]] = {}
+    for proxy in proxies:
+        groups.setdefault(proxy.fingerprint, []).append(proxy)
+    return list(groups.values())
+
+
+def group_by_ingress(proxies: Sequence[Proxy]) -> List[List[Proxy]]:
+    """Group proxies sharing an ingress IP, unresolved ones stay alone.
+
+    Notice
+    ---
+    Order kept, the first proxy of a group is its representative.
+    """
+    groups: Dict[object, List[Proxy]] = {}
+    for proxy in proxies:
+        key = proxy.ingress_ip if proxy.ingress_ip else id(proxy)
+        groups.setdefault(key, []).append(proxy)
+    return list(groups.values())
+
+
+def fan_out(groups: Sequence[Sequence[Proxy]], values: Sequence):
+    """Give every member the egress probed through its representative."""
+    for group, value in zip(groups, values):
+        for proxy in group:
+            proxy.egress_ip = value
+            proxy.representative = group[0] if proxy is not group[0] else None
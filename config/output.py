@@ -0,0 +1,70 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+
+from utils import serialization
+from utils.serialization import dump_yaml
+
+from .render_plan import ProxyIndex
+
+
+class RenderedProxies:
+    """YAML fragments shared by every output, rendered once: the proxies
+    block and the flow-style name list of each selector."""
+
+    def __init__(self, index: ProxyIndex) -> None:
+        self.index = index
+        self.proxies_block = dump_yaml([proxy.data for proxy in index.proxies])
+        # id of a name list of `index` -> (the list, rendered items)
+        self._names: Dict[int, Tuple[List[str], str]] = {}
+
+    @staticmethod
+    def _flow_items(names: Sequence[str]) -> str:
+        text = dump_yaml(list(names), default_flow_style=True, width=2**31 - 1)
+        # '[a, b]\n' -> 'a, b'
+        return text.strip()[1:-1]
+
+    def flow(self, own: Sequence[str], names: List[str]) -> str:
+        """
+
+        Return
+        ---
+        Flow sequence of `own` followed by `names`, where `names` is a list
+        held by the index and rendered only once.
+        """
+        parts = []
+        if own:
+            parts.append(self._flow_items(own))
+        if names:
+            if id(names) not in self._names:
+                self._names[id(names)] = (names, self._flow_items(names))
+            parts.append(self._names[id(names)][1])
+        return '[' + ', '.join(parts) + ']'
+
+
+def write_atomic(path: str, text: str):
+    serialization.write_atomic(path, text.encode('utf-8'))
+
+
+def render_outputs(template_configs: Sequence, index: ProxyIndex) -> List[str]:
+    """Render every template against `index`, sharing the fragments."""
+    rendered = RenderedProxies(index)
+    return [template_config.render(rendered) for template_config in template_configs]
+
+
+def write_outputs(paths: Sequence[str], texts: Sequence[str], max_workers: int = 8):
+    """Write rendered outputs in parallel."""
+    with ThreadPoolExecutor(max(1, min(max_workers, len(paths)))) as executor:
+        list(executor.map(write_atomic, paths, texts))
+    for path in paths:
+        logging.info(f'config is saved to {path}')
+
+
+def save_outputs(
+    template_configs: Sequence,
+    paths: Sequence[str],
+    index: ProxyIndex,
+    max_workers: int = 8,
+):
+    """Render every template against `index` and write them in parallel."""
+    write_outputs(paths, render_outputs(template_configs, index), max_workers)
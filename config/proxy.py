@@ -1,14 +1,92 @@
+import enum
+import hashlib
+import json
 from typing import MutableMapping, Union
 from ipaddress import IPv4Address, IPv6Address
-import geoip2.models
+
+import requests
+
+from utils.geo import Geometry, IPAddress
+from utils.speed import SpeedSample
+
+# packed IPs, IPv6 addresses are flagged above the 128 address bits
+NO_IP = -1
+IPV6_FLAG = 1 << 128
+
+
+def pack_ip(ip: Union[IPAddress, None]) -> int:
+    if ip is None:
+        return NO_IP
+    if ip.version == 6:
+        return int(ip) | IPV6_FLAG
+    return int(ip)
+
+
+def unpack_ip(packed: int) -> Union[IPAddress, None]:
+    if packed < 0:
+        return None
+    if packed & IPV6_FLAG:
+        return IPv6Address(packed ^ IPV6_FLAG)
+    return IPv4Address(packed)
+
+
+class ProbeError(enum.IntEnum):
+    """Why an egress probe failed, kept instead of the exception itself."""
+
+    TIMEOUT = 1
+    SSL = 2
+    PROXY = 3
+
+    @classmethod
+    def from_exception(cls, e: Union[Exception, type]) -> 'ProbeError':
+        e_type = e if isinstance(e, type) else type(e)
+        if issubclass(e_type, requests.exceptions.Timeout):
+            return cls.TIMEOUT
+        if issubclass(e_type, requests.exceptions.SSLError):
+            return cls.SSL
+        return cls.PROXY
+
+    def __str__(self):
+        return self.name
 
 
 class Proxy:
+    """A proxy of a subscription, with its probe results.
+
+    IPs are kept as packed integers and probe errors as `ProbeError` codes,
+    the `ingress_ip` and `egress_ip` properties unpack them.
+    """
+
+    __slots__ = (
+        'data',
+        '_ingress',
+        '_egress',
+        '_error',
+        '_connect',
+        'connect_rtt',
+        '_fingerprint',
+        'geometry',
+        'representative',
+        'speed',
+        'provider',
+    )
+
     def __init__(self, data: MutableMapping) -> None:
         self.data = data
-        self.ingress_ip: Union[IPv4Address, IPv6Address, None] = None
-        self.egress_ip: Union[IPv4Address, IPv6Address, Exception, None] = None
-        self.geometry: Union[geoip2.models.Country, None] = None
+        self._ingress = NO_IP
+        self._egress = NO_IP
+        self._error = 0
+        # fastest address accepting TCP connections and seconds to connect
+        self._connect = NO_IP
+        self.connect_rtt: Union[float, None] = None
+        self._fingerprint: Union[str, None] = None
+        self.geometry: Union[Geometry, None] = None
+        # the proxy probed in place of this one, if collapsed before probing
+        self.representative: Union[Proxy, None] = None
+        # latency and throughput, if measured
+        self.speed: Union[SpeedSample, None] = None
+        # index of the subscription listing it
+        self.provider: Union[int, None] = None
 
     def __getitem__(self, key):
         return self.data[key]
@@ -16,6 +94,61 @@ class Proxy:
     def __setitem__(self, key, value):
         self.data[key] = value
 
+    @property
+    def ingress_ip(self) -> Union[IPAddress, None]:
+        return unpack_ip(self._ingress)
+
+    @ingress_ip.setter
+    def ingress_ip(self, ip: Union[IPAddress, None]):
+        self._ingress = pack_ip(ip)
+
+    @property
+    def connect_ip(self) -> Union[IPAddress, None]:
+        return unpack_ip(self._connect)
+
+    @connect_ip.setter
+    def connect_ip(self, ip: Union[IPAddress, None]):
+        self._connect = pack_ip(ip)
+
+    @property
+    def egress_ip(self) -> Union[IPAddress, ProbeError, None]:
+        """Egress IP, the `ProbeError` if probing failed, `None` if unknown."""
+        if self._error:
+            return ProbeError(self._error)
+        return unpack_ip(self._egress)
+
+    @egress_ip.setter
+    def egress_ip(self, value: Union[IPAddress, ProbeError, Exception, None]):
+        if isinstance(value, Exception):
+            value = ProbeError.from_exception(value)
+        if isinstance(value, ProbeError):
+            self._egress, self._error = NO_IP, int(value)
+        else:
+            self._egress, self._error = pack_ip(value), 0
+
+    @property
+    def error(self) -> Union[ProbeError, None]:
+        return ProbeError(self._error) if self._error else None
+
+    @property
+    def fingerprint(self) -> str:
+        """Stable digest of the normalized connection parameters, the name
+        excluded."""
+        if self._fingerprint is not None:
+            return self._fingerprint
+        params = {
+            k: v for k, v in self.data.items() if k != 'name' and v is not None
+        }
+        if isinstance(params.get('server'), str):
+            params['server'] = params['server'].strip().lower()
+        try:
+            params['port'] = int(params['port'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        raw = json.dumps(params, sort_keys=True, default=str, ensure_ascii=False)
+        self._fingerprint = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        return self._fingerprint
+
     def __str__(self):
         return (
             f'name: {self["name"]}\n'
@@ -31,16 +164,9 @@ class Proxy:
         ---
         `0` for invalid proxies, `non-0` for the others.
         """
-        val = 0
-        if (
-            isinstance(self.ingress_ip, IPv4Address)
-            or isinstance(self.ingress_ip, IPv6Address)
-        ) and (
-            isinstance(self.egress_ip, IPv4Address)
-            or isinstance(self.egress_ip, IPv6Address)
-        ):
-            val = hash(str(self.ingress_ip) + str(self.egress_ip))
-        return val
+        if self._ingress < 0 or self._egress < 0:
+            return 0
+        return hash((self._ingress, self._egress)) or 1
 
     def __eq__(self, __o: object) -> bool:
         assert isinstance(__o, Proxy)
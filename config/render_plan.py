@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Mapping, NamedTuple, Sequence, Tuple, Union
+
+from utils.serialization import ParseCache
+from utils.speed import speed_key
+
+from .proxy import Proxy
+
+plan_cache_dir = os.path.join('assets', 'cache', 'plans')
+plan_cache_size = 64
+
+# proxy group keys selecting proxies, besides the geometry key (countries)
+CONTINENT_KEY = 'continent'
+# not `filter`, Clash.Meta uses it on the proxies of `use` providers
+FILTER_KEY = 'name-filter'
+# proxy group keys ordering and filtering the selected proxies by speed
+ORDER_KEY = 'order-by'
+MAX_LATENCY_KEY = 'max-latency'
+MIN_THROUGHPUT_KEY = 'min-throughput'
+RANKING_KEYS = (ORDER_KEY, MAX_LATENCY_KEY, MIN_THROUGHPUT_KEY)
+
+# bumped when the plan format changes, invalidates cached plans
+PLAN_VERSION = 3
+
+SKIP = 'skip'
+ALL = 'all'
+SELECT = 'select'
+
+
+class GroupPlan(NamedTuple):
+    index: int
+    mode: str
+    countries: Tuple[str, ...] = ()
+    continents: Tuple[str, ...] = ()
+    patterns: Tuple[str, ...] = ()
+    # 'latency', 'ttfb' or 'throughput', '' to keep the order
+    order: str = ''
+    # milliseconds
+    max_latency: Union[float, None] = None
+    # KiB/s
+    min_throughput: Union[float, None] = None
+
+    @property
+    def selector(self):
+        return self.countries, self.continents, self.patterns
+
+    @property
+    def ranking(self):
+        return self.order, self.max_latency, self.min_throughput
+
+
+def _as_tuple(value):
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(str(v) for v in value)
+
+
+def _as_number(value):
+    return None if value is None else float(value)
+
+
+def _compile(proxy_groups: Sequence[Mapping], geometry_key: str) -> List[GroupPlan]:
+    plans = []
+    for i, proxy_group in enumerate(proxy_groups):
+        ranking = dict(
+            order=str(proxy_group.get(ORDER_KEY) or ''),
+            max_latency=_as_number(proxy_group.get(MAX_LATENCY_KEY)),
+            min_throughput=_as_number(proxy_group.get(MIN_THROUGHPUT_KEY)),
+        )
+        keys = (geometry_key, CONTINENT_KEY, FILTER_KEY)
+        present = [key for key in keys if key in proxy_group.keys()]
+        if not present:
+            # no selector, all proxies
+            plans.append(GroupPlan(i, ALL, **ranking))
+            continue
+        plan = GroupPlan(
+            i,
+            SELECT,
+            countries=_as_tuple(proxy_group.get(geometry_key)),
+            continents=_as_tuple(proxy_group.get(CONTINENT_KEY)),
+            patterns=_as_tuple(proxy_group.get(FILTER_KEY)),
+            **ranking,
+        )
+        if not any(plan.selector) and proxy_group.get('proxies'):
+            # empty selectors next to own proxies, keep them alone
+            plan = plan._replace(mode=SKIP)
+        plans.append(plan)
+    return plans
+
+
+def compile_plan(template: Mapping, geometry_key: str) -> List[GroupPlan]:
+    """Which proxies each proxy group of `template` needs.
+
+    Plans are cached on disk by the hash of the proxy groups, see
+    `ParseCache`.
+    """
+    raw = json.dumps(
+        [PLAN_VERSION, geometry_key, template['proxy-groups']],
+        sort_keys=True,
+        default=str,
+        ensure_ascii=False,
+    ).encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    plan_cache = ParseCache(plan_cache_dir, plan_cache_size)
+    try:
+        # stored as plain tuples
+        return [GroupPlan(*row) for row in plan_cache.get(digest)]
+    except KeyError:
+        pass
+
+    plans = _compile(template['proxy-groups'], geometry_key)
+    try:
+        plan_cache.put(digest, [tuple(plan) for plan in plans])
+    except OSError as e:
+        logging.warning(f'failed to cache render plan, {e}')
+    return plans
+
+
+class ProxyIndex:
+    """Proxy names by country, continent and name pattern, built once per
+    country map and shared by every template."""
+
+    def __init__(self, country_map: Mapping[str, List[Proxy]]) -> None:
+        self.proxies: List[Proxy] = []
+        self.by_country: Dict[str, List[str]] = {}
+        self.by_continent: Dict[str, List[str]] = {}
+        for iso_code, proxies in country_map.items():
+            self.proxies += proxies
+            self.by_country[iso_code] = [proxy['name'] for proxy in proxies]
+            for proxy in proxies:
+                if proxy.geometry is None:
+                    continue
+                self.by_continent.setdefault(
+                    proxy.geometry.continent.code, []
+                ).append(proxy['name'])
+        self.all_names = [proxy['name'] for proxy in self.proxies]
+        self.speeds = {
+            proxy['name']: proxy.speed for proxy in self.proxies if proxy.speed
+        }
+        self._selected: Dict[tuple, List[str]] = {}
+
+    def by_pattern(self, pattern: str) -> List[str]:
+        regex = re.compile(pattern)
+        return [name for name in self.all_names if regex.search(name)]
+
+    def rank(self, names: List[str], ranking: tuple) -> List[str]:
+        """Filter `names` by `(order, max_latency, min_throughput)` and order
+        them, see `GroupPlan`. Unmeasured proxies are filtered out and ordered
+        last.
+
+        Return
+        ---
+        `names` itself if there is nothing to do.
+        """
+        order, max_latency, min_throughput = ranking
+        if not any(x is not None and x != '' for x in ranking):
+            return names
+        if not self.speeds:
+            logging.warning(f'no speed measured, ignore {ranking}')
+            return names
+        speeds = self.speeds
+        if max_latency is not None:
+            names = [
+                name
+                for name in names
+                if name in speeds and speeds[name].latency * 1000 <= max_latency
+            ]
+        if min_throughput is not None:
+            names = [
+                name
+                for name in names
+                if name in speeds and speeds[name].throughput / 1024 >= min_throughput
+            ]
+        if order:
+            key = speed_key(order)
+            names = sorted(names, key=lambda name: key(speeds.get(name)))
+        return list(names)
+
+    def select(self, selector: Union[tuple, None], ranking: tuple = ('', None, None)):
+        """
+
+        Args
+        ---
+        - selector: `(countries, continents, patterns)`, `None` for all
+          proxies.
+        - ranking: see `rank`.
+
+        Return
+        ---
+        Names matching any of the selector, without repeats. The same list
+        object is returned for the same arguments.
+        """
+        key = (selector, ranking)
+        if key in self._selected:
+            return self._selected[key]
+        if selector is None:
+            names = self.all_names
+        else:
+            countries, continents, patterns = selector
+            names = []
+            for iso_code in countries:
+                names += self.by_country.get(iso_code, [])
+            for code in continents:
+                names += self.by_continent.get(code, [])
+            for pattern in patterns:
+                names += self.by_pattern(pattern)
+            names = list(dict.fromkeys(names))
+        self._selected[key] = self.rank(names, ranking)
+        return self._selected[key]
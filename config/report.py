@@ -0,0 +1,106 @@
+import json
+import logging
+import threading
+import time
+from ipaddress import IPv4Address, IPv6Address
+from typing import IO, Dict, Sequence, Tuple, Union
+
+from utils.geo import IPAddress
+
+from .proxy import ProbeError, Proxy
+
+OK = 'ok'
+UNKNOWN = 'unknown'
+NO_INGRESS = 'no_ingress'
+
+
+def outcome(value: Union[IPAddress, ProbeError, None]) -> str:
+    """`'ok'`, the lower-cased `ProbeError` name, or `'unknown'`."""
+    if isinstance(value, ProbeError):
+        return value.name.lower()
+    if isinstance(value, (IPv4Address, IPv6Address)):
+        return OK
+    return UNKNOWN
+
+
+class ProbeReport:
+    """Egress results of a run, one NDJSON record per proxy written to `path`
+    as it arrives, and counters of the outcomes kept along the way.
+
+    Records carry the subscription, name, server, ingress, the fastest
+    address and its connect RTT if checked, egress, error class, where the
+    result came from (`probed`, `cached` or `shared`), the probe duration in
+    seconds and the time it arrived. Safe to use from
+    several threads. Use as a context manager, or call `close`.
+    """
+
+    def __init__(self, path: Union[str, None], names: Sequence[str]) -> None:
+        """
+
+        Args
+        ---
+        - path: NDJSON file, truncated, `None` to keep the counters only.
+        - names: of the subscriptions, by `Proxy.provider`.
+        """
+        self.path = path
+        self.names = names
+        # outcome -> proxies, and 'no_ingress' -> unresolved proxies
+        self.counts: Dict[str, int] = {}
+        # (subscription, outcome) -> proxies
+        self.by_subscription: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._fd: Union[IO, None] = None
+        if path is not None:
+            self._fd = open(path, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(
+        self,
+        proxy: Proxy,
+        value: Union[IPAddress, ProbeError, None],
+        source: str,
+        duration: Union[float, None] = None,
+    ):
+        result = outcome(value)
+        subscription = self.names[proxy.provider] if proxy.provider is not None else ''
+        ingress = proxy.ingress_ip
+        line = None
+        if self._fd is not None:
+            line = json.dumps(
+                {
+                    'subscription': subscription,
+                    'name': proxy.data.get('name'),
+                    'server': proxy.data.get('server'),
+                    'port': proxy.data.get('port'),
+                    'ingress': str(ingress) if ingress else None,
+                    'connect': str(proxy.connect_ip) if proxy.connect_ip else None,
+                    'connect_rtt': proxy.connect_rtt,
+                    'egress': str(value) if result == OK else None,
+                    'error': None if result == OK else result,
+                    'source': source,
+                    'duration': duration,
+                    'time': time.time(),
+                },
+                ensure_ascii=False,
+            )
+        with self._lock:
+            self.counts[result] = self.counts.get(result, 0) + 1
+            if not ingress:
+                self.counts[NO_INGRESS] = self.counts.get(NO_INGRESS, 0) + 1
+            key = (subscription, result)
+            self.by_subscription[key] = self.by_subscription.get(key, 0) + 1
+            if line is not None and self._fd is not None:
+                self._fd.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            self._fd.close()
+            self._fd = None
+        logging.info(f'[report] written to {self.path}')
@@ -1,23 +1,35 @@
-from geoip2.errors import AddressNotFoundError
-from ipaddress import ip_address
-import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv6Address, ip_address
 from os import PathLike
-import signal
-from clash import Clash
+import ipaddress
+import logging
+import os
+import queue
+import threading
+import time
+import requests
+from clash import ClashPool, ClashStartupError
 import sys
 from utils import *
+from utils.geo import IPAddress
+from utils.metrics import metrics
+from utils.reachability import UDP_TYPES, tcp_port
+from utils.speed import format_speed, speed_key
 from typing import (
     Callable,
+    Dict,
     Iterator,
     List,
     Mapping,
     Sequence,
     TypeAlias,
+    Union,
 )
 from .subscription_config import SubscriptionConfig
 from .config import Proxy, Config
-from geoip2.models import Country
-from geoip2.types import IPAddress
+from .proxy import ProbeError
+from .dedupe import fan_out, group_by_fingerprint, group_by_ingress
+from .report import NO_INGRESS, ProbeReport, outcome
 
 NO_GEOMETRY_CODE = 'NOGEO'
 
@@ -26,46 +38,432 @@ class types:
     CountryMap: TypeAlias = Mapping[str, List[Proxy]]
 
 
-def worker_ingress(proxy: Proxy):
-    try:
-        proxy.ingress_ip = ipaddress.ip_address(proxy['server'])
-    except ValueError:
-        records = my_nslookup(proxy['server'])
-        if not records:
-            # no record
-            proxy.ingress_ip = None
-        else:
-            proxy.ingress_ip = [ipaddress.ip_address(record) for record in records][0]
-    logging.info(f'[ingress] {str(proxy.ingress_ip)} {proxy["name"]}')
-    return proxy
-
+def dump_egress(value: Union[IPAddress, ProbeError, None]):
+    """
 
-clash_bin = None
+    Return
+    ---
+    `(egress, error)` strings for `ProbeStore`.
+    """
+    if isinstance(value, ProbeError):
+        return None, value.name
+    return str(value), None
 
 
-def worker_egress(proxies: Sequence[Proxy], ports: Sequence[int]):
-    config = Config(
-        make_simple_clash_config(
-            controller_port=ports[0],
-            proxy_port=ports[1],
-            proxies=[proxy.data for proxy in proxies],
+def load_egress(egress: Union[str, None], error: Union[str, None]):
+    if error is not None:
+        if error in ProbeError.__members__:
+            return ProbeError[error]
+        # exception class name, recorded by older versions
+        return ProbeError.from_exception(
+            getattr(requests.exceptions, error, requests.RequestException)
         )
-    )
-    clash = Clash(bin=clash_bin, config=config)
-    for proxy in proxies:
-        value = None
-        if clash.switch_proxy(proxy['name']):
+    return ip_address(egress)
+
+
+def record_egress(
+    store: ProbeStore,
+    proxy: Proxy,
+    value: Union[IPAddress, ProbeError, None],
+    duration: Union[float, None] = None,
+):
+    if value is None:
+        # switching failed, nothing learned about the proxy
+        return
+    ingress = str(proxy.ingress_ip) if proxy.ingress_ip else None
+    store.put(proxy.fingerprint, ingress, *dump_egress(value), duration)
+
+
+def probe_egress(
+    proxy: str, policy: ProbePolicy, budget: Union[RetryBudget, None] = None
+):
+    """Probe through the http(s) proxy `proxy`, retrying a timed out or refused
+    probe once while `budget` lasts.
+
+    Return
+    ---
+    `(egress IP or error code, seconds of the last attempt)`.
+    """
+    for attempt in range(2):
+        start = time.perf_counter()
+        try:
+            value = ip_address(policy.get_egress_ip(proxy))
+        except (
+            requests.exceptions.Timeout,
+            requests.exceptions.SSLError,
+            requests.exceptions.ProxyError,
+        ) as e:
+            value = ProbeError.from_exception(e)
+            if (
+                attempt == 0
+                and value != ProbeError.SSL
+                and budget is not None
+                and budget.take()
+            ):
+                continue
+            return value, time.perf_counter() - start
+        duration = time.perf_counter() - start
+        policy.timeout.observe(duration)
+        return value, duration
+
+
+def log_egress(
+    value, duration: float, proxy: Proxy, report: Union[ProbeReport, None] = None
+):
+    logging.info(f'[egress] {value} {duration:.2f}s {proxy["name"]}')
+    if report is not None:
+        report.add(proxy, value, 'probed', duration)
+
+
+def take_jobs(jobs: queue.Queue, stop: threading.Event) -> Iterator[Sequence[int]]:
+    """Batches of indices from the shared queue, until every batch is done or
+    `stop` is set. A batch is done once the worker asks for the next one, so
+    while other workers hold batches they may hand back, this waits."""
+    while not stop.is_set():
+        try:
+            batch = jobs.get(timeout=0.1)
+        except queue.Empty:
+            # batches handed back are put before their `task_done`
+            if not jobs.unfinished_tasks:
+                return
+            continue
+        try:
+            yield batch
+        finally:
+            jobs.task_done()
+
+
+def hand_back(
+    jobs: queue.Queue,
+    batch: Sequence[int],
+    error: ClashStartupError,
+    failures: int,
+    pool: ClashPool,
+) -> bool:
+    """Put `batch` back on `jobs` after its instance failed to start, for
+    another instance to take.
+
+    Return
+    ---
+    Whether the worker should go on, `False` once it failed `failures` times
+    in a row, as many as the instances of `pool`.
+    """
+    logging.error(str(error))
+    jobs.put(batch)
+    return failures < pool.size
+
+
+def indexed_data(proxies: Sequence[Proxy], batch: Sequence[int]):
+    """Proxy configs of a batch named after their indices, names may repeat
+    across subscriptions."""
+    return [dict(proxies[i].data, name=str(i)) for i in batch]
+
+
+def worker_egress(
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    jobs: queue.Queue,
+    store: Union[ProbeStore, None],
+    policy: ProbePolicy,
+    budget: RetryBudget,
+    report: Union[ProbeReport, None],
+    stop: threading.Event,
+):
+    """Probe batches of `proxies` from `jobs`, one proxy after another by
+    switching GLOBAL.
+
+    Return
+    ---
+    `(index, egress IP or error)` of the probed proxies.
+    """
+    results = []
+    failures = 0
+    for batch in take_jobs(jobs, stop):
+        try:
+            with pool.acquire(indexed_data(proxies, batch)) as clash:
+                for i in batch:
+                    if stop.is_set():
+                        break
+                    value, duration = None, 0.0
+                    if clash.switch_proxy(str(i)):
+                        value, duration = probe_egress(
+                            clash.config.proxy, policy, budget
+                        )
+                    results.append((i, value))
+                    log_egress(value, duration, proxies[i], report)
+                    if store is not None:
+                        record_egress(store, proxies[i], value, duration)
+        except ClashStartupError as e:
+            failures += 1
+            if hand_back(jobs, batch, e, failures, pool):
+                continue
+            break
+        failures = 0
+    return results
+
+
+def worker_egress_listeners(
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    jobs: queue.Queue,
+    store: Union[ProbeStore, None],
+    policy: ProbePolicy,
+    budget: RetryBudget,
+    report: Union[ProbeReport, None],
+    stop: threading.Event,
+):
+    """Probe batches of `proxies` from `jobs`, a batch at once through their
+    own listeners.
+
+    Return
+    ---
+    `(index, egress IP or error)` of the probed proxies.
+    """
+    results = []
+    failures = 0
+    executor = ThreadPoolExecutor(pool.window)
+    try:
+        for batch in take_jobs(jobs, stop):
             try:
-                value = ip_address(get_egress_ip({'https': clash.config.proxy}))
-            except (
-                requests.exceptions.Timeout,
-                requests.exceptions.SSLError,
-                requests.exceptions.ProxyError,
-            ) as e:
-                value = e
-        proxy.egress_ip = value
-        logging.info(f'[egress] {value} {proxy["name"]}')
-    return proxies
+                with pool.acquire(indexed_data(proxies, batch)) as clash:
+                    batch_values = list(
+                        executor.map(
+                            lambda proxy: probe_egress(proxy, policy, budget),
+                            clash.config.listener_proxies,
+                        )
+                    )
+            except ClashStartupError as e:
+                failures += 1
+                if hand_back(jobs, batch, e, failures, pool):
+                    continue
+                break
+            failures = 0
+            for i, (value, duration) in zip(batch, batch_values):
+                results.append((i, value))
+                log_egress(value, duration, proxies[i], report)
+                if store is not None:
+                    record_egress(store, proxies[i], value, duration)
+    finally:
+        executor.shutdown()
+    return results
+
+
+def worker_speed(
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    jobs: queue.Queue,
+    url: Union[str, None],
+    stop: threading.Event,
+):
+    """Measure batches of `proxies` from `jobs`, one proxy at a time so they
+    do not share the bandwidth.
+
+    Return
+    ---
+    `(index, SpeedSample or None)` of the measured proxies.
+    """
+    results = []
+    failures = 0
+    for batch in take_jobs(jobs, stop):
+        try:
+            with pool.acquire(indexed_data(proxies, batch)) as clash:
+                listeners = clash.config.listener_proxies
+                for j, i in enumerate(batch):
+                    if stop.is_set():
+                        break
+                    sample = None
+                    if listeners:
+                        sample = measure_speed(listeners[j], url)
+                    elif clash.switch_proxy(str(i)):
+                        sample = measure_speed(clash.config.proxy, url)
+                    results.append((i, sample))
+                    logging.info(f'[speed] {format_speed(sample)} {proxies[i]["name"]}')
+        except ClashStartupError as e:
+            failures += 1
+            if hand_back(jobs, batch, e, failures, pool):
+                continue
+            break
+        failures = 0
+    return results
+
+
+def schedule(proxies: Sequence[Proxy]):
+    """Probe order of `proxies`, interleaved by provider and then by host, so
+    a slow provider or host is spread over every worker.
+
+    Return
+    ---
+    Indices of `proxies`.
+    """
+    providers = [proxy.provider for proxy in proxies]
+    hosts = [str(proxy.data.get('server', '')).lower() for proxy in proxies]
+    return interleave(providers, hosts)
+
+
+def run_workers(
+    worker: Callable,
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    worker_count: int,
+    *args,
+    order: Union[Sequence[int], None] = None,
+    batch_size: int = 16,
+):
+    """Run `worker(pool, proxies, jobs, *args, stop)` on `worker_count`
+    threads sharing one queue of `jobs`, batches of at most `batch_size`
+    indices of `proxies` taken in `order`. Idle workers take the next batch,
+    so a slow batch holds up only its own worker.
+
+    A batch whose instance failed to start is handed back for another
+    instance, workers give up after failing on as many instances in a row.
+
+    Return
+    ---
+    Results of the workers, in the order of `proxies`, `None` if missing.
+    """
+    order = range(len(proxies)) if order is None else order
+    jobs: queue.Queue = queue.Queue()
+    for start in range(0, len(order), batch_size):
+        jobs.put(order[start : start + batch_size])
+    worker_count = max(1, min(worker_count, jobs.qsize()))
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(worker_count)
+    try:
+        futures = [
+            executor.submit(worker, pool, proxies, jobs, *args, stop)
+            for _ in range(worker_count)
+        ]
+        # workers send back (index, value) pairs only, in any order
+        values = [None] * len(proxies)
+        for future in futures:
+            for i, value in future.result():
+                values[i] = value
+        # handed back by the last workers, as every instance failed to start
+        left = 0
+        while not jobs.empty():
+            left += len(jobs.get_nowait())
+        if left:
+            logging.error(
+                f'{left} proxies left undone, no Clash instance could be started'
+            )
+    except KeyboardInterrupt:
+        stop.set()
+        executor.shutdown(cancel_futures=True)
+        raise
+    executor.shutdown()
+    return values
+
+
+def probe_proxies(
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    store: Union[ProbeStore, None] = None,
+    policy: Union[ProbePolicy, None] = None,
+    report: Union[ProbeReport, None] = None,
+    batch_size: int = 16,
+):
+    """Probe egress IPs with the instances of `pool`, recording results in
+    `store` and `report` as they arrive.
+
+    Args
+    ---
+    - policy: deadlines, hedging and retries, shared across runs to keep
+      what it learned, a fresh one if not given.
+    - batch_size: proxies loaded into an instance at a time, `pool.window`
+      in listener mode.
+
+    Return
+    ---
+    Egress IPs or errors, in the order of `proxies`.
+    """
+    policy = policy or ProbePolicy()
+    budget = policy.budget(len(proxies))
+    worker = worker_egress_listeners if pool.window else worker_egress
+    values = run_workers(
+        worker,
+        pool,
+        proxies,
+        pool.size,
+        store,
+        policy,
+        budget,
+        report,
+        order=schedule(proxies),
+        batch_size=pool.window or batch_size,
+    )
+    logging.info(f'[egress] {len(proxies)} probed, {policy.summary(budget)}')
+    return values
+
+
+def measure_proxies(
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    url: Union[str, None] = None,
+    concurrency: int = 4,
+    batch_size: int = 16,
+):
+    """Measure at most `concurrency` proxies at a time with the instances of
+    `pool`.
+
+    Return
+    ---
+    `SpeedSample`s or `None`, in the order of `proxies`.
+    """
+    return run_workers(
+        worker_speed,
+        pool,
+        proxies,
+        min(concurrency, pool.size),
+        url,
+        order=schedule(proxies),
+        batch_size=pool.window or batch_size,
+    )
+
+
+def probe_proxies_by_ingress(
+    pool: ClashPool,
+    proxies: Sequence[Proxy],
+    store: Union[ProbeStore, None] = None,
+    policy: Union[ProbePolicy, None] = None,
+    report: Union[ProbeReport, None] = None,
+    probe: Callable = probe_proxies,
+):
+    """Probe one proxy per ingress IP first and give its egress to the other
+    proxies on that IP. Those behind a failed one are probed themselves.
+
+    Args
+    ---
+    - probe: called like `probe_proxies` for each of the two rounds.
+
+    Return
+    ---
+    Egress IPs or errors, in the order of `proxies`.
+    """
+    groups = group_by_ingress(proxies)
+    policy = policy or ProbePolicy()
+    first_values = probe(pool, [group[0] for group in groups], store, policy, report)
+    values = {}
+    rest: List[Proxy] = []
+    for group, value in zip(groups, first_values):
+        values[id(group[0])] = value
+        if isinstance(value, (IPv4Address, IPv6Address)):
+            for proxy in group[1:]:
+                values[id(proxy)] = value
+                if store is not None:
+                    record_egress(store, proxy, value)
+                if report is not None:
+                    report.add(proxy, value, 'shared')
+        else:
+            rest += group[1:]
+    logging.info(
+        f'[egress] {len(groups)} ingress IPs probed, '
+        f'{len(proxies) - len(groups) - len(rest)} proxies fanned out, '
+        f'{len(rest)} left to probe'
+    )
+    if rest:
+        for proxy, value in zip(rest, probe(pool, rest, store, policy, report)):
+            values[id(proxy)] = value
+    return [values[id(proxy)] for proxy in proxies]
 
 
 class SubscriptionConfigCollection:
@@ -75,24 +473,99 @@ class SubscriptionConfigCollection:
         self,
         data: Sequence[Mapping],
         enable_renames: Sequence[bool],
+        names: Union[Sequence[str], None] = None,
     ) -> None:
+        """
+
+        Args
+        ---
+        - names: of the subscriptions in metrics, e.g. their prefixes,
+          indices if not given or empty.
+        """
+        self.names = [
+            name or str(i) for i, name in enumerate(names or [''] * len(data))
+        ]
         self.data = [
             SubscriptionConfig(data=config, enable_rename=enable_rename)
             for config, enable_rename in zip(data, enable_renames)
         ]
         self.proxies = self._get_proxies()
+        # hostname -> all its addresses, by the latest `update_ingress_IPs`
+        self.ingress_records: Dict[str, List[str]] = {}
+        # egress results of the latest `update_egress_IPs`
+        self.report: Union[ProbeReport, None] = None
+        for i, subscription_config in enumerate(self.data):
+            for proxy in subscription_config.proxies:
+                proxy.provider = i
 
-    def update_geometry(self, get_geometry: Callable[[IPAddress], Country]):
+    def update_geometry(self, geo: GeoLookup):
         logging.info('updating geometry info')
+        ips = [
+            proxy.egress_ip
+            for proxy in self.proxies
+            if isinstance(proxy.egress_ip, (IPv4Address, IPv6Address))
+        ]
+        geometries = geo.lookup_many(ips)
+        logging.info(f'{len(ips)} egress IPs, {len(geometries)} distinct')
         for proxy in self.proxies:
-            try:
-                proxy.geometry = get_geometry(proxy.egress_ip)
-            except AddressNotFoundError:
+            proxy.geometry = geometries.get(proxy.egress_ip)
+            if proxy.geometry is None:
                 logging.info(f'no geometry info for {str(proxy.egress_ip)}')
 
+    def update_speed(
+        self,
+        clash_bin: PathLike,
+        url: Union[str, None] = None,
+        concurrency: int = 4,
+        startup_timeout: float = 10,
+        pool: Union[ClashPool, None] = None,
+    ):
+        """Measure latency, time to first byte and throughput of the proxies,
+        valid ones only after `purify_proxies`.
+
+        Args
+        ---
+        - url: download endpoint, `utils.speed.speed_test_url` if not given.
+        - concurrency: proxies measured at once.
+        - pool: Clash instances to measure with, a temporary pool of
+          `concurrency` instances is used if not given.
+        """
+        proxies = [proxy for proxy in self.proxies if hash(proxy) != 0]
+        logging.info(f'Update speed, {len(proxies)} proxies to measure')
+        if not proxies:
+            return
+        own_pool = pool is None
+        if own_pool:
+            pool = ClashPool(clash_bin, concurrency, startup_timeout)
+        try:
+            samples = measure_proxies(pool, proxies, url, concurrency)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        finally:
+            if own_pool:
+                pool.close()
+        for proxy, sample in zip(proxies, samples):
+            proxy.speed = sample
+        logging.info(
+            f'{sum(sample is not None for sample in samples)} of '
+            f'{len(proxies)} proxies measured'
+        )
+
     def rename_proxies(
-        self, proxy_name_fmt_4: str, proxy_name_fmt_6: str, prefixes=List[str]
+        self,
+        proxy_name_fmt_4: str,
+        proxy_name_fmt_6: str,
+        prefixes=List[str],
+        order_by: Union[str, None] = None,
     ):
+        """
+
+        Args
+        ---
+        - order_by: number the proxies of a country by `'latency'`, `'ttfb'`
+          or `'throughput'` of `update_speed`, best first, instead of in
+          subscription order.
+        """
         # find rename-enabled proxies and renamed-disabled proxies
         rename_enabled_proxies: List[Proxy] = []
         rename_disabled_proxies: List[Proxy] = []
@@ -116,6 +589,11 @@ class SubscriptionConfigCollection:
             else:
                 country_map[iso_code] = [proxy]
 
+        if order_by is not None:
+            sort_key = speed_key(order_by)
+            for proxies in country_map.values():
+                proxies.sort(key=lambda proxy: sort_key(proxy.speed))
+
         # rename
         for key, value in country_map.items():
             for i, proxy in enumerate(value):
@@ -142,80 +620,80 @@ class SubscriptionConfigCollection:
 
         return country_map
 
-    def postprocess_proxies(self, get_geometry: Callable[[IPAddress], Country]):
-        self.update_geometry(get_geometry)
+    def postprocess_proxies(self, geo: GeoLookup):
+        self.update_geometry(geo)
         self.rename_proxies()
 
-    def _get_proxies_by_country(self, iso_code: str):
-        proxies = []
-        for proxy in self.proxies:
-            if proxy.geometry.country.iso_code == iso_code:
-                proxies.append(proxy)
-        return proxies
-
-    def _get_proxies_by_continent(self, iso_code: str):
-        proxies = []
-        for proxy in self.proxies:
-            if proxy.geometry.continent.iso_code == iso_code:
-                proxies.append(proxy)
-        return proxies
-
     def log_proxies_info(self):
-        # full proxies info
-        proxies_info = ''
-        for i, proxy in enumerate(self.proxies):
-            proxies_info += '-' * 80 + '\n' f'{i}\n' f'{proxy}\n'
-        logging.debug(f'proxies info:\n{proxies_info[:-1]}')
-
-        # invalid proxies info
-        count_egress_Timeout = 0
-        count_egress_SSLError = 0
-        count_egress_ProxyError = 0
-        count_ingress_NoRecord = 0
-        indices_invalid = []
-        for i, proxy in enumerate(self.proxies):
-            if not proxy.ingress_ip:
-                count_ingress_NoRecord += 1
-                indices_invalid.append(i)
-            if isinstance(proxy.egress_ip, requests.exceptions.Timeout):
-                count_egress_Timeout += 1
-                indices_invalid.append(i)
-            elif isinstance(proxy.egress_ip, requests.exceptions.SSLError):
-                count_egress_SSLError += 1
-                indices_invalid.append(i)
-            elif isinstance(proxy.egress_ip, requests.exceptions.ProxyError):
-                count_egress_ProxyError += 1
-                indices_invalid.append(i)
-        invalid_proxies_info = ''
-        for i in indices_invalid:
-            invalid_proxies_info += '-' * 80 + '\n' f'{i}\n' f'{self.proxies[i]}\n'
-        logging.debug(f'invalid proxies:\n{invalid_proxies_info[:-1]}')
-
-        # summary
+        """Log a summary of the egress results, counted by `self.report`
+        while probing. Every proxy, and the invalid ones again, are dumped
+        only at DEBUG level."""
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            separator = '-' * 80
+            logging.debug(
+                'proxies info:\n'
+                + '\n'.join(
+                    f'{separator}\n{i}\n{proxy}'
+                    for i, proxy in enumerate(self.proxies)
+                )
+            )
+            logging.debug(
+                'invalid proxies:\n'
+                + '\n'.join(
+                    f'{separator}\n{i}\n{proxy}'
+                    for i, proxy in enumerate(self.proxies)
+                    if not proxy.ingress_ip or proxy.error is not None
+                )
+            )
+
+        report = self.report
+        if report is None:
+            # egress IPs not updated by this collection, count them here
+            report = ProbeReport(None, self.names)
+            for proxy in self.proxies:
+                report.add(proxy, proxy.egress_ip, 'cached')
+        counts = report.counts
         logging.info(
             f'proxies summary:\n'
             f'total count: {len(self.proxies)}\n'
-            f'ingress, no record count: {count_ingress_NoRecord}\n'
-            f'egress, timeout count: {count_egress_Timeout}\n'
-            f'egress, sslerror count: {count_egress_SSLError}\n'
-            f'egress, proxyerror count: {count_egress_ProxyError}'
+            f'ingress, no record count: {counts.get(NO_INGRESS, 0)}\n'
+            f'egress, timeout count: {counts.get(outcome(ProbeError.TIMEOUT), 0)}\n'
+            f'egress, sslerror count: {counts.get(outcome(ProbeError.SSL), 0)}\n'
+            f'egress, proxyerror count: {counts.get(outcome(ProbeError.PROXY), 0)}'
         )
 
     def purify_proxies(self):
         # remove redundant proxies (same ingress and egress IP)
-        self.proxies = list(set(self.proxies))
+        # the first of equal proxies is kept, order kept
+        self.proxies = list(dict.fromkeys(self.proxies))
         # remove invalid proxies
         self.proxies = [proxy for proxy in self.proxies if hash(proxy) != 0]
         logging.info(f'total proxy count after purify: {len(self.proxies)}')
-        # update proxies in self.data (SubscriptionConfig s)
+        # update proxies in self.data (SubscriptionConfig s), each kept proxy
+        # stays with the subscription it came from
+        kept = set(map(id, self.proxies))
+        metrics.clear('subscription_proxies')
         for i, subscription_config in enumerate(self.data):
             count_before = len(subscription_config.proxies)
-            subscription_config.proxies = set(subscription_config.proxies) & set(
-                self.proxies
+            collapsed = sum(
+                proxy.representative is not None
+                for proxy in subscription_config.proxies
             )
+            subscription_config.proxies = [
+                proxy for proxy in subscription_config.proxies if id(proxy) in kept
+            ]
             count_after = len(subscription_config.proxies)
-            logging.info(f'change of config {i}: {count_before} -> {count_after}')
-        pass
+            for phase, count in (('before', count_before), ('after', count_after)):
+                metrics.set(
+                    'subscription_proxies',
+                    count,
+                    subscription=self.names[i],
+                    phase=phase,
+                )
+            logging.info(
+                f'change of config {i}: {count_before} -> {count_after}, '
+                f'{collapsed} collapsed before probing'
+            )
 
     def _get_proxies(self) -> List[Proxy]:
         ret = []
@@ -223,55 +701,217 @@ class SubscriptionConfigCollection:
             ret += subscription_config.proxies
         return ret
 
-    def update_ingress_IPs(self):
-        def init_worker():
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
-
+    def update_ingress_IPs(
+        self, concurrency: int = 64, dns_cache: Union[DNSCache, None] = None
+    ):
         logging.info('Update ingress IP')
+        # (index, address) results, literal IPs need no lookup
+        results = []
+        jobs: Dict[str, List[int]] = {}
+        for i, proxy in enumerate(self.proxies):
+            try:
+                results.append((i, ip_address(proxy['server'])))
+            except ValueError:
+                jobs.setdefault(proxy['server'], []).append(i)
+
         try:
-            pool = multiprocessing.Pool(os.cpu_count() + 1, init_worker)
-            proxies = pool.map(worker_ingress, self.proxies)
-            pool.close()
-            pool.join()
+            records = resolve_hostnames(jobs.keys(), concurrency, dns_cache)
         except KeyboardInterrupt:
-            pool.terminate()
-            pool.join()
             sys.exit(1)
+        self.ingress_records = records
+        for hostname, indices in jobs.items():
+            address = ip_address(records[hostname][0]) if records[hostname] else None
+            results += [(i, address) for i in indices]
 
         # value feed back
-        for src, dst in zip(proxies, self.proxies):
-            dst.ingress_ip = src.ingress_ip
+        for i, address in results:
+            self.proxies[i].ingress_ip = address
+            logging.info(f'[ingress] {str(address)} {self.proxies[i]["name"]}')
+
+    def update_reachability(self, timeout: float = 3, concurrency: int = 256):
+        """Drop the proxies whose server accepts no TCP connection on any of
+        its resolved addresses, before they cost an egress probe. The others
+        get the fastest address and its connect RTT. Run after
+        `update_ingress_IPs`.
+
+        Notice
+        ---
+        Proxies without ingress IP or valid port, and those carried over UDP,
+        are not checked and left to the egress probe.
+        """
+        logging.info('Check reachability')
+        checked: List[Proxy] = []
+        targets = []
+        for proxy in self.proxies:
+            port = tcp_port(proxy.data.get('port'))
+            if (
+                proxy.ingress_ip is None
+                or port is None
+                or proxy.data.get('type') in UDP_TYPES
+            ):
+                continue
+            addresses = self.ingress_records.get(proxy['server']) or [
+                str(proxy.ingress_ip)
+            ]
+            checked.append(proxy)
+            targets.append((addresses, port))
 
-    def update_egress_IPs(self, _clash_bin: PathLike):
-        global clash_bin
-        clash_bin = _clash_bin
+        try:
+            results = check_reachability(targets, timeout, concurrency)
+        except KeyboardInterrupt:
+            sys.exit(1)
 
-        def init_worker():
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        dead = set()
+        for proxy, reach in zip(checked, results):
+            if reach is None:
+                dead.add(id(proxy))
+                logging.info(f'[reach] unreachable {proxy["name"]}')
+                continue
+            address, rtt = reach
+            proxy.connect_ip = ip_address(address)
+            proxy.connect_rtt = rtt
+            metrics.observe('connect_rtt_seconds', rtt)
+        self.proxies = [proxy for proxy in self.proxies if id(proxy) not in dead]
+
+        metrics.clear('reachability_proxies')
+        for result, count in (
+            ('reachable', len(checked) - len(dead)),
+            ('unreachable', len(dead)),
+            ('skipped', len(self.proxies) + len(dead) - len(checked)),
+        ):
+            metrics.set('reachability_proxies', count, outcome=result)
+        logging.info(
+            f'[reach] {len(checked)} checked, {len(dead)} unreachable dropped, '
+            f'{len(self.proxies)} left'
+        )
 
-        splitted_proxies = designate_jobs(self.proxies, os.cpu_count() + 1)
-        picker = get_tcp_port_picker()
-        ports = [next(picker) for _ in range(2 * len(splitted_proxies))]
-        splitted_ports = designate_jobs(ports, len(splitted_proxies))
-        logging.info('Update egress IP')
-        try:
-            pool = multiprocessing.Pool(len(splitted_proxies), init_worker)
-            splitted_proxies_r = pool.starmap(
-                worker_egress, zip(splitted_proxies, splitted_ports)
+    def update_egress_IPs(
+        self,
+        clash_bin: PathLike,
+        store: Union[ProbeStore, None] = None,
+        startup_timeout: float = 10,
+        pool: Union[ClashPool, None] = None,
+        window: int = 0,
+        dedupe: bool = True,
+        dedupe_ingress: bool = False,
+        policy: Union[ProbePolicy, None] = None,
+        coordinator=None,
+        report_path: Union[str, None] = None,
+    ):
+        """
+
+        Args
+        ---
+        - pool: Clash instances to probe with, a temporary pool of
+          `os.cpu_count() + 1` instances is used if not given.
+        - window: for the temporary pool, probe this many proxies at once per
+          instance through per-proxy listeners, `0` to switch GLOBAL instead.
+        - dedupe: probe one proxy per distinct connection parameters.
+        - dedupe_ingress: also probe one proxy per ingress IP first, see
+          `probe_proxies_by_ingress`.
+        - policy: see `probe_proxies`.
+        - coordinator: a `distributed.Coordinator` to probe on its workers
+          instead of with local Clash instances.
+        - report_path: stream a `ProbeReport` of every proxy to this NDJSON
+          file, the outcomes are counted in `self.report` anyway.
+        """
+        with ProbeReport(report_path, self.names) as report:
+            # reuse fresh results of unchanged proxies
+            pending: List[Proxy] = []
+            for proxy in self.proxies:
+                record = None
+                if store is not None:
+                    ingress = str(proxy.ingress_ip) if proxy.ingress_ip else None
+                    record = store.get(proxy.fingerprint, ingress)
+                if record is None:
+                    pending.append(proxy)
+                else:
+                    proxy.egress_ip = load_egress(*record)
+                    report.add(proxy, proxy.egress_ip, 'cached')
+            logging.info(
+                f'Update egress IP, {len(self.proxies) - len(pending)} cached, '
+                f'{len(pending)} to probe'
             )
-            pool.close()
-            pool.join()
+            metrics.set(
+                'egress_probes', len(self.proxies) - len(pending), source='cached'
+            )
+            if pending:
+                self._probe_egress_IPs(
+                    pending,
+                    clash_bin,
+                    store,
+                    startup_timeout,
+                    pool,
+                    window,
+                    dedupe,
+                    dedupe_ingress,
+                    policy,
+                    coordinator,
+                    report,
+                )
+            else:
+                metrics.set('egress_probes', 0, source='probed')
+                metrics.set('egress_probes', 0, source='shared')
+        self.report = report
+        self._count_egress_outcomes()
+
+    def _probe_egress_IPs(
+        self,
+        pending: List[Proxy],
+        clash_bin: PathLike,
+        store: Union[ProbeStore, None],
+        startup_timeout: float,
+        pool: Union[ClashPool, None],
+        window: int,
+        dedupe: bool,
+        dedupe_ingress: bool,
+        policy: Union[ProbePolicy, None],
+        coordinator,
+        report: ProbeReport,
+    ):
+        # collapse proxies listed more than once
+        groups = group_by_fingerprint(pending) if dedupe else [[p] for p in pending]
+        representatives = [group[0] for group in groups]
+        logging.info(f'{len(representatives)} distinct proxies to probe')
+        metrics.set('egress_probes', len(representatives), source='probed')
+        metrics.set(
+            'egress_probes', len(pending) - len(representatives), source='shared'
+        )
+
+        probe = probe_proxies
+        if coordinator is not None:
+            # the workers bring their own Clash instances and policies
+            probe = lambda pool, proxies, store, policy, report: coordinator.probe(
+                proxies, store, report
+            )
+        own_pool = pool is None and coordinator is None
+        if own_pool:
+            pool = ClashPool(clash_bin, os.cpu_count() + 1, startup_timeout, window)
+        try:
+            if dedupe_ingress:
+                values = probe_proxies_by_ingress(
+                    pool, representatives, store, policy, report, probe
+                )
+            else:
+                values = probe(pool, representatives, store, policy, report)
         except KeyboardInterrupt:
-            pool.terminate()
-            pool.join()
             sys.exit(1)
+        finally:
+            if own_pool:
+                pool.close()
 
         # value feed back
-        proxies = []
-        for proxy_group in splitted_proxies_r:
-            proxies += proxy_group
-        for src, dst in zip(proxies, self.proxies):
-            dst.egress_ip = src.egress_ip
+        fan_out(groups, values)
+        for group, value in zip(groups, values):
+            for proxy in group[1:]:
+                report.add(proxy, value, 'shared')
+
+    def _count_egress_outcomes(self):
+        metrics.clear('egress_outcomes')
+        for (subscription, result), count in self.report.by_subscription.items():
+            metrics.set(
+                'egress_outcomes', count, subscription=subscription, outcome=result
+            )
 
     def __getitem__(self, key):
         return self.data[key]
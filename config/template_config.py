@@ -1,66 +1,123 @@
 import logging
-import yaml
+import re
 from os import PathLike
-from typing import Iterable, List, Mapping, MutableMapping
+from typing import Mapping, MutableMapping, Union
 
-from config.proxy import Proxy
+from utils.serialization import dump_yaml
 from .config import Config
+from .render_plan import (
+    ALL,
+    CONTINENT_KEY,
+    FILTER_KEY,
+    RANKING_KEYS,
+    SKIP,
+    GroupPlan,
+    ProxyIndex,
+    compile_plan,
+)
+from .output import RenderedProxies
 from . import subscription_config_collection as scc
 
+# stands in for the 'proxies' of a proxy group until splicing
+PLACEHOLDER = '__clash_config_customizer_proxies_'
+
 
 class TemplateConfig(Config):
     def __init__(self, data: MutableMapping, geometry_key: str) -> None:
         super().__init__(data=data)
         self.geometry_key = geometry_key
+        self.selector_keys = (geometry_key, CONTINENT_KEY, FILTER_KEY, *RANKING_KEYS)
 
-    def inject(self, country_map: scc.types.CountryMap):
-        def get_names(proxies: List[Proxy]):
-            return [proxy['name'] for proxy in proxies]
+    def inject(
+        self,
+        country_map: Union[scc.types.CountryMap, None] = None,
+        index: Union[ProxyIndex, None] = None,
+    ):
+        """
 
-        all_proxies = []
-        for proxies in country_map.values():
-            all_proxies += proxies
+        Args
+        ---
+        - index: prebuilt from `country_map`, share one among templates.
+        """
+        if index is None:
+            index = ProxyIndex(country_map)
 
-        for proxy_group in self['proxy-groups']:
-            if 'proxies' not in proxy_group.keys():
+        proxy_groups = self['proxy-groups']
+        for plan in compile_plan(self.data, self.geometry_key):
+            proxy_group = proxy_groups[plan.index]
+            if not proxy_group.get('proxies'):
                 # create 'proxies' key if necessary
                 proxy_group['proxies'] = []
-            elif (
-                proxy_group['proxies']
-                and self.geometry_key in proxy_group.keys()
-                and proxy_group[self.geometry_key] == None
-            ):
-                # skip injection when the proxy group
-                # 1. already have non-empty 'proxies'
-                # 2. have empty 'geometry_key'
-                continue
+            # remove selector keys
+            for key in self.selector_keys:
+                proxy_group.pop(key, None)
+            proxy_group['proxies'] += self._select_names(plan, proxy_group, index)
 
-            # no geometry need
-            if self.geometry_key not in proxy_group.keys():
-                proxy_group['proxies'] += get_names(all_proxies)
-                continue
+        if not self.data.get('proxies'):
+            self['proxies'] = []
+        self['proxies'] += [proxy.data for proxy in index.proxies]
 
-            # need geometry
-            for iso_code in proxy_group[self.geometry_key]:
-                if iso_code in country_map.keys():
-                    proxy_group['proxies'] += get_names(country_map[iso_code])
+    def _select_names(self, plan: GroupPlan, proxy_group: Mapping, index: ProxyIndex):
+        """
 
-            # if no proxies added, warning and then fill with all proxies
-            if not proxy_group['proxies']:
-                logging.warning(
-                    f'no {proxy_group[self.geometry_key]} proxies for proxy '
-                    f'group {proxy_group["name"]}'
-                )
-                proxy_group['proxies'] += all_proxies
+        Return
+        ---
+        Names to append to the proxy group, a list held by `index`.
+        """
+        if plan.mode == SKIP:
+            # the proxy group already have non-empty 'proxies' and empty
+            # selectors
+            return []
+        if plan.mode == ALL:
+            return index.select(None, plan.ranking)
 
-            # remove geometry key
-            proxy_group.pop(self.geometry_key)
+        names = index.select(plan.selector, plan.ranking)
+        # if no proxies added, warning and then fill with all proxies
+        if not names and not proxy_group.get('proxies'):
+            logging.warning(
+                f'no {plan.selector} proxies for proxy group {proxy_group["name"]}'
+            )
+            names = index.all_names
+        return names
 
-        if 'proxies' not in self.data:
-            self['proxies'] = []
-        self['proxies'] += [proxy.data for proxy in all_proxies]
+    def render(self, rendered: RenderedProxies) -> str:
+        """Like `inject` then `dumps`, but splice in the fragments shared by
+        all templates instead of serializing them again. `self` is not
+        changed.
+        """
+        index = rendered.index
+        data = {k: v for k, v in self.data.items() if k != 'proxies'}
+        fragments = {}
+        proxy_groups = []
+        for plan in compile_plan(self.data, self.geometry_key):
+            proxy_group = self['proxy-groups'][plan.index]
+            own = proxy_group.get('proxies') or []
+            names = self._select_names(plan, proxy_group, index)
+            group = {
+                k: v
+                for k, v in proxy_group.items()
+                if k not in self.selector_keys and k != 'proxies'
+            }
+            token = f'{PLACEHOLDER}{plan.index}__'
+            group['proxies'] = token
+            fragments[token] = rendered.flow(own, names)
+            proxy_groups.append(group)
+        data['proxy-groups'] = proxy_groups
+
+        text = dump_yaml(data)
+        text = re.sub(
+            f'{PLACEHOLDER}\\d+__', lambda m: fragments[m.group(0)], text
+        )
+        own_proxies = self.data.get('proxies') or []
+        if not own_proxies and not index.proxies:
+            return text + 'proxies: []\n'
+        own_block = dump_yaml(own_proxies) if own_proxies else ''
+        return text + 'proxies:\n' + own_block + rendered.proxies_block
+
+    def dumps(self) -> str:
+        return dump_yaml(self.data)
 
     def save(self, path: PathLike):
-        with open(path, 'w') as fd:
-            yaml.safe_dump(self.data, fd, allow_unicode=True)
+        with open(path, 'w', encoding='utf-8') as fd:
+            dump_yaml(self.data, fd)
         logging.info(f'config is saved to {path}')
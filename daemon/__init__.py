@@ -0,0 +1 @@
+from .daemon import Daemon
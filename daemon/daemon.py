@@ -0,0 +1,229 @@
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+from clash import ClashPool
+from config import (
+    Proxy,
+    ProxyIndex,
+    SubscriptionConfigCollection,
+    TemplateConfig,
+    render_outputs,
+)
+from config.output import write_atomic
+from config.subscription_config_collection import dump_egress, probe_proxies
+from layout.layout import Layout
+from utils import ProbeStore, load_yamls
+from utils.metrics import metrics
+
+# seconds before a failed cycle is tried again, doubled on each failure in a
+# row up to `MAX_RETRY_DELAY`
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 1800
+
+
+class Daemon:
+    """Refresh subscriptions on a schedule and keep the outputs up to date.
+
+    Probe results live in an in-memory `ProbeStore` across cycles, so a cycle
+    only probes added or changed proxies. A background thread re-probes the
+    stalest results in small batches before they expire. Outputs are written
+    only when their content changed.
+
+    A failed cycle is logged and tried again later, the outputs of the last
+    good cycle stay in place meanwhile.
+    """
+
+    def __init__(self, layout: Layout) -> None:
+        self.layout = layout
+        self.store = ProbeStore(
+            ':memory:',
+            ttl=layout.probe_store.ttl,
+            error_ttl=layout.probe_store.error_ttl,
+        )
+        self.pool = ClashPool(
+            layout.clash_bin,
+            os.cpu_count() + 1,
+            layout.clash_startup_timeout,
+            layout.probe_window,
+        )
+        self.subscriptions = list(layout.subscription_configs)
+        now = time.time()
+        self.next_refresh = [now + i for i in layout.refresh_intervals]
+        self.fingerprints = [self._fingerprints(s) for s in self.subscriptions]
+        # latest proxies by fingerprint, what the re-prober works on
+        self.proxies: Dict[str, Proxy] = {}
+        self.output_digests: Dict[str, str] = {}
+        self.dirty = threading.Event()
+        self.dirty.set()
+        self.stop = threading.Event()
+
+    @staticmethod
+    def _fingerprints(subscription):
+        return {Proxy(p).fingerprint for p in subscription.get('proxies') or []}
+
+    def run(self):
+        reprober = threading.Thread(target=self.reprobe, daemon=True)
+        reprober.start()
+        failures = 0
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.refresh()
+                    if self.dirty.is_set():
+                        self.dirty.clear()
+                        self.cycle()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    delay = min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+                    logging.exception(
+                        f'[daemon] cycle failed, {type(e).__name__}: {e}, '
+                        f'retry in {delay}s'
+                    )
+                    metrics.inc('daemon_cycle_failures_total')
+                    self.dirty.set()
+                    self.stop.wait(delay)
+                    continue
+                timeout = max(min(self.next_refresh) - time.time(), 0)
+                self.dirty.wait(min(timeout, self.layout.reprobe_interval))
+        finally:
+            self.stop.set()
+            self.pool.close()
+            if self.layout.coordinator is not None:
+                self.layout.coordinator.close()
+            self.layout.wait_for_assets()
+
+    def refresh(self):
+        """Reload subscriptions that are due, marking the state dirty if any
+        proxy was added, changed or removed."""
+        now = time.time()
+        due = [i for i, t in enumerate(self.next_refresh) if t <= now]
+        if not due:
+            return
+        sources = [self.layout.subscription_sources[i] for i in due]
+        try:
+            configs = load_yamls(sources)
+        except Exception as e:
+            logging.warning(f'[daemon] refresh failed, {type(e).__name__}: {e}')
+            configs = [self.subscriptions[i] for i in due]
+        for i, config in zip(due, configs):
+            self.next_refresh[i] = now + self.layout.refresh_intervals[i]
+            fingerprints = self._fingerprints(config)
+            added = len(fingerprints - self.fingerprints[i])
+            removed = len(self.fingerprints[i] - fingerprints)
+            logging.info(
+                f'[daemon] subscription {i} refreshed, '
+                f'{added} added or changed, {removed} removed'
+            )
+            self.subscriptions[i] = config
+            self.fingerprints[i] = fingerprints
+            if added or removed:
+                self.dirty.set()
+
+    def cycle(self):
+        layout = self.layout
+        start = time.monotonic()
+        collection = SubscriptionConfigCollection(
+            data=copy.deepcopy(self.subscriptions),
+            enable_renames=layout.enable_renames,
+            names=layout.prefixes,
+        )
+        with metrics.stage('ingress'):
+            collection.update_ingress_IPs(layout.dns_concurrency, layout.dns_cache)
+        if layout.reachability:
+            with metrics.stage('reachability'):
+                collection.update_reachability(
+                    layout.connect_timeout, layout.connect_concurrency
+                )
+        with metrics.stage('egress'):
+            collection.update_egress_IPs(
+                layout.clash_bin,
+                self.store,
+                pool=self.pool,
+                dedupe=layout.dedupe,
+                dedupe_ingress=layout.dedupe_ingress,
+                policy=layout.probe_policy,
+                coordinator=layout.coordinator,
+                report_path=layout.probe_report,
+            )
+        self.proxies = {proxy.fingerprint: proxy for proxy in collection.proxies}
+        # forget results of proxies gone from every subscription
+        self.store.delete(set(self.store.fingerprints()) - self.proxies.keys())
+        collection.log_proxies_info()
+        with metrics.stage('purify'):
+            collection.purify_proxies()
+        if layout.speed_test:
+            with metrics.stage('speed'):
+                collection.update_speed(
+                    layout.clash_bin,
+                    layout.speed_test_url,
+                    layout.speed_test_concurrency,
+                    pool=self.pool,
+                )
+        with metrics.stage('geo'):
+            collection.update_geometry(layout.get_geo_lookup())
+        with metrics.stage('rename'):
+            country_map = collection.rename_proxies(
+                layout.proxy_name_fmt_4,
+                layout.proxy_name_fmt_6,
+                layout.prefixes,
+                layout.order_by,
+            )
+
+        with metrics.stage('inject'):
+            texts = render_outputs(
+                [
+                    TemplateConfig(data=data, geometry_key=layout.geometry_key)
+                    for data in layout.template_configs
+                ],
+                ProxyIndex(country_map),
+            )
+        with metrics.stage('save'):
+            for output_path, text in zip(layout.output_paths, texts):
+                self.write(output_path, text)
+        metrics.set('stage_duration_seconds', time.monotonic() - start, stage='cycle')
+        metrics.write(layout.metrics_textfile, layout.metrics_json)
+        logging.info(f'[daemon] cycle done in {time.monotonic() - start:.1f}s')
+
+    def write(self, path: str, text: str):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if self.output_digests.get(path) == digest:
+            logging.info(f'[daemon] {path} unchanged')
+            return
+        write_atomic(path, text)
+        self.output_digests[path] = digest
+        logging.info(f'config is saved to {path}')
+
+    def reprobe(self):
+        """Re-probe the stalest results, half a TTL before they expire."""
+        while not self.stop.wait(self.layout.reprobe_interval):
+            fingerprints = self.store.stalest(self.layout.reprobe_batch)
+            proxies: List[Proxy] = [
+                self.proxies[fp] for fp in fingerprints if fp in self.proxies
+            ]
+            if not proxies:
+                continue
+            logging.info(f'[daemon] re-probing {len(proxies)} stale proxies')
+            try:
+                if self.layout.coordinator is not None:
+                    # on the workers, no Clash runs here
+                    values = self.layout.coordinator.probe(proxies, self.store)
+                else:
+                    values = probe_proxies(
+                        self.pool, proxies, self.store, self.layout.probe_policy
+                    )
+            except Exception as e:
+                logging.warning(f'[daemon] re-probe failed, {type(e).__name__}: {e}')
+                continue
+            changed = 0
+            for proxy, value in zip(proxies, values):
+                changed += dump_egress(value) != dump_egress(proxy.egress_ip)
+                proxy.egress_ip = value
+            if changed:
+                logging.info(f'[daemon] {changed} re-probed proxies changed')
+                self.dirty.set()
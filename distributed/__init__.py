@@ -0,0 +1,2 @@
+from .coordinator import Coordinator
+from .protocol import get_authkey
@@ -0,0 +1,251 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import (
+    Connection,
+    Listener,
+    answer_challenge,
+    deliver_challenge,
+)
+from typing import Dict, Sequence, Tuple, Union
+
+from config import Proxy
+from config.report import ProbeReport
+from config.subscription_config_collection import record_egress, schedule
+from utils import ProbeStore
+from utils.metrics import metrics
+
+from .protocol import HELLO, RESULT, SHARD, STOP, parse_address
+
+# times proxies coming back unprobed, e.g. on a Clash startup failure, are
+# sent out again before they are left unknown
+UNPROBED_RETRIES = 2
+
+
+class Coordinator:
+    """Hand out shards of proxies to probe to remote workers, see
+    `distributed.worker`.
+
+    Workers dial in to `address` and stay connected across `probe` calls,
+    each probing one shard at a time. A shard whose worker disconnects, or
+    does not answer within `shard_timeout` seconds, goes back to the queue
+    for another worker, and so do proxies a worker could not probe. Use as a
+    context manager, or call `close`.
+
+    Notice
+    ---
+    Messages are pickled, `authkey` must be kept secret.
+    """
+
+    def __init__(
+        self,
+        address: Union[str, Tuple[str, int]],
+        authkey: bytes,
+        shard_size: int = 256,
+        shard_timeout: float = 600,
+    ) -> None:
+        if isinstance(address, str):
+            address = parse_address(address)
+        self.shard_size = shard_size
+        self.shard_timeout = shard_timeout
+        self._authkey = authkey
+        # no authkey here, handshakes run on the threads serving the workers
+        # so that a silent client does not hold up the others
+        self._listener = Listener(address)
+        self.address = self._listener.address
+        # (run, shard number, proxy data and providers)
+        self._shards: queue.Queue = queue.Queue()
+        # (run, shard number, values)
+        self._results: queue.Queue = queue.Queue()
+        self._runs = itertools.count()
+        self._workers: Dict[str, Connection] = {}
+        self._lock = threading.Lock()
+        # one run at a time, runs share the queues
+        self._probing = threading.Lock()
+        self._closed = threading.Event()
+        threading.Thread(target=self._accept, daemon=True).start()
+        logging.info(f'[coordinator] listening on {self.address}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def worker_count(self) -> int:
+        with self._lock:
+            return len(self._workers)
+
+    def close(self, stop_workers: bool = False):
+        """Stop listening. Disconnected workers wait for the next coordinator
+        on the same address, unless `stop_workers`."""
+        self._closed.set()
+        self._listener.close()
+        with self._lock:
+            workers = list(self._workers.values())
+        for conn in workers:
+            try:
+                if stop_workers:
+                    conn.send((STOP,))
+                conn.close()
+            except OSError:
+                pass
+        logging.info(f'[coordinator] closed, {len(workers)} workers released')
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # closed, or a client gone before it was served
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: Connection):
+        try:
+            deliver_challenge(conn, self._authkey)
+            answer_challenge(conn, self._authkey)
+            kind, name = conn.recv()[:2]
+            assert kind == HELLO
+        except (EOFError, OSError, AuthenticationError) as e:
+            logging.warning(
+                f'[coordinator] handshake failed, {type(e).__name__}: {e}'
+            )
+            conn.close()
+            return
+        except (AssertionError, ValueError, TypeError):
+            conn.close()
+            return
+        with self._lock:
+            self._workers[name] = conn
+            metrics.set('distributed_workers', len(self._workers))
+        logging.info(f'[coordinator] worker {name} joined')
+
+        shard = None
+        try:
+            while not self._closed.is_set():
+                try:
+                    shard = self._shards.get(timeout=1)
+                except queue.Empty:
+                    continue
+                run, number, items = shard
+                conn.send((SHARD, number, items))
+                if not conn.poll(self.shard_timeout):
+                    raise TimeoutError(f'no answer in {self.shard_timeout}s')
+                kind, answered, values = conn.recv()
+                assert kind == RESULT and answered == number
+                self._results.put((run, number, values))
+                metrics.inc('distributed_shards_total', outcome='done')
+                shard = None
+        except (EOFError, OSError, AssertionError, ValueError) as e:
+            logging.warning(
+                f'[coordinator] worker {name} lost, {type(e).__name__}: {e}'
+            )
+        finally:
+            if shard is not None:
+                # another worker takes it over
+                self._shards.put(shard)
+                metrics.inc('distributed_shards_total', outcome='requeued')
+            with self._lock:
+                if self._workers.get(name) is conn:
+                    del self._workers[name]
+                metrics.set('distributed_workers', len(self._workers))
+            conn.close()
+
+    def probe(
+        self,
+        proxies: Sequence[Proxy],
+        store: Union[ProbeStore, None] = None,
+        report: Union[ProbeReport, None] = None,
+    ):
+        """Probe egress IPs of `proxies` on the workers, recording results in
+        `store` and `report` as shards come back. Blocks until every shard is done, however
+        many workers come and go meanwhile.
+
+        Return
+        ---
+        Egress IPs or errors, in the order of `proxies`.
+        """
+        with self._probing:
+            return self._probe(proxies, store, report)
+
+    def _probe(
+        self,
+        proxies: Sequence[Proxy],
+        store: Union[ProbeStore, None],
+        report: Union[ProbeReport, None],
+    ):
+        run = next(self._runs)
+        # shards left by an interrupted run
+        while not self._shards.empty():
+            try:
+                self._shards.get_nowait()
+            except queue.Empty:
+                break
+        order = schedule(proxies)
+        # shard number -> indices of proxies, and times sent out before
+        shards: Dict[int, Sequence[int]] = dict(
+            enumerate(
+                order[start : start + self.shard_size]
+                for start in range(0, len(order), self.shard_size)
+            )
+        )
+        retries = dict.fromkeys(shards, 0)
+        numbers = itertools.count(len(shards))
+        for number, shard in shards.items():
+            self._put_shard(run, number, shard, proxies)
+        logging.info(
+            f'[coordinator] {len(proxies)} proxies in {len(shards)} shards, '
+            f'{self.worker_count} workers connected'
+        )
+
+        values = [None] * len(proxies)
+        pending = set(range(len(shards)))
+        waiting_since = time.monotonic()
+        while pending:
+            try:
+                result_run, number, shard_values = self._results.get(timeout=1)
+            except queue.Empty:
+                if not self.worker_count and time.monotonic() - waiting_since > 30:
+                    logging.warning('[coordinator] no worker connected, waiting')
+                    waiting_since = time.monotonic()
+                continue
+            if result_run != run or number not in pending:
+                # late answer of an abandoned shard
+                continue
+            pending.discard(number)
+            unprobed = []
+            for i, value in zip(shards[number], shard_values):
+                if value is None and retries[number] < UNPROBED_RETRIES:
+                    unprobed.append(i)
+                    continue
+                values[i] = value
+                if store is not None:
+                    record_egress(store, proxies[i], value)
+                if report is not None:
+                    report.add(proxies[i], value, 'probed')
+            if unprobed:
+                retry = next(numbers)
+                shards[retry] = unprobed
+                retries[retry] = retries[number] + 1
+                self._put_shard(run, retry, unprobed, proxies)
+                pending.add(retry)
+                metrics.inc('distributed_shards_total', outcome='requeued')
+                logging.warning(
+                    f'[coordinator] shard {number}: {len(unprobed)} proxies '
+                    f'not probed, sent again as shard {retry}'
+                )
+            logging.info(
+                f'[coordinator] shard {number} done, {len(pending)} left'
+            )
+        return values
+
+    def _put_shard(
+        self, run: int, number: int, shard: Sequence[int], proxies: Sequence[Proxy]
+    ):
+        items = [(proxies[i].data, proxies[i].provider) for i in shard]
+        self._shards.put((run, number, items))
@@ -0,0 +1,42 @@
+"""
+
+Function
+---
+Messages between a `Coordinator` and its workers, tuples sent over an
+authenticated `multiprocessing.connection`:
+
+- worker: `(HELLO, name)` once connected
+- coordinator: `(SHARD, number, [(proxy data, provider), ...])`
+- worker: `(RESULT, number, [egress IP, ProbeError or None, ...])`, in the
+  order of the shard
+- coordinator: `(STOP,)` when closing
+"""
+import os
+from typing import Tuple
+
+HELLO = 'hello'
+SHARD = 'shard'
+RESULT = 'result'
+STOP = 'stop'
+
+AUTHKEY_ENV = 'CLASH_CUSTOMIZER_AUTHKEY'
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """`'host:port'` to `(host, port)`, IPv6 hosts in brackets."""
+    host, _, port = address.rpartition(':')
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+
+def get_authkey(authkey: str = None) -> bytes:
+    """
+
+    Raise
+    ---
+    `ValueError` if neither `authkey` nor the `CLASH_CUSTOMIZER_AUTHKEY`
+    environment variable is set.
+    """
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise ValueError(f'no authkey, set {AUTHKEY_ENV} or pass --authkey')
+    return authkey.encode('utf-8')
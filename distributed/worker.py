@@ -0,0 +1,141 @@
+"""
+
+Args
+---
+- coordinator: `host:port` the coordinator listens on, see `--coordinator`
+  of `main.py`
+
+Function
+---
+Probe egress IPs for a coordinator. Shards of proxies are probed with a
+long-lived pool of Clash instances, like a local run does, and the results
+sent back. The worker reconnects if the coordinator goes away, and exits
+when told to stop.
+
+Usage
+---
+CLASH_CUSTOMIZER_AUTHKEY=secret python -m distributed.worker 10.0.0.1:7000
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import time
+from multiprocessing.connection import Client, Connection
+
+from config import Proxy
+from config.subscription_config_collection import probe_proxies
+from clash import ClashPool
+from utils import AdaptiveTimeout, ProbePolicy
+
+from .protocol import HELLO, RESULT, SHARD, STOP, get_authkey, parse_address
+
+# seconds between attempts to reach the coordinator
+RECONNECT_INTERVAL = 5
+
+
+def parse_args(init_args=None):
+    parser = argparse.ArgumentParser(description='egress probing worker')
+    parser.add_argument('coordinator', help='host:port of the coordinator')
+    parser.add_argument(
+        '--authkey', help='shared secret, CLASH_CUSTOMIZER_AUTHKEY if not given'
+    )
+    parser.add_argument('--name', default=f'{socket.gethostname()}:{os.getpid()}')
+    parser.add_argument('--clash-bin', help='downloaded if not given')
+    parser.add_argument(
+        '--instances',
+        help='Clash instances (default: %(default)s)',
+        type=int,
+        default=os.cpu_count() + 1,
+    )
+    parser.add_argument('--clash-startup-timeout', type=float, default=10)
+    parser.add_argument('--probe-window', type=int, default=0)
+    parser.add_argument('--probe-timeout', type=float, default=10)
+    parser.add_argument('--probe-retry-ratio', type=float, default=0.05)
+    parser.add_argument('--no-hedge', action='store_true')
+    parser.add_argument(
+        '--echo-urls', nargs='+', help='egress echo endpoints, see ProbePolicy'
+    )
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args(init_args)
+
+
+def serve(conn: Connection, pool: ClashPool, policy: ProbePolicy):
+    """Probe shards from `conn` until told to stop.
+
+    Raise
+    ---
+    `EOFError` or `OSError` if the coordinator went away.
+    """
+    while True:
+        message = conn.recv()
+        if message[0] == STOP:
+            return
+        assert message[0] == SHARD
+        _, number, items = message
+        proxies = []
+        for data, provider in items:
+            proxy = Proxy(data)
+            proxy.provider = provider
+            proxies.append(proxy)
+        logging.info(f'[worker] shard {number}, {len(proxies)} proxies')
+        values = probe_proxies(pool, proxies, policy=policy)
+        conn.send((RESULT, number, values))
+
+
+def run_worker(
+    address: str,
+    authkey: bytes,
+    name: str,
+    pool: ClashPool,
+    policy: ProbePolicy,
+):
+    while True:
+        try:
+            conn = Client(parse_address(address), authkey=authkey)
+        except OSError as e:
+            logging.warning(f'[worker] cannot reach {address}, {e}')
+            time.sleep(RECONNECT_INTERVAL)
+            continue
+        logging.info(f'[worker] connected to {address} as {name}')
+        try:
+            conn.send((HELLO, name))
+            serve(conn, pool, policy)
+            return
+        except (EOFError, OSError) as e:
+            logging.warning(f'[worker] lost {address}, {type(e).__name__}: {e}')
+        finally:
+            conn.close()
+        time.sleep(RECONNECT_INTERVAL)
+
+
+def main(init_args=None):
+    args = parse_args(init_args)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(message)s',
+        datefmt='%m-%d %H:%M:%S',
+    )
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+    authkey = get_authkey(args.authkey)
+    clash_bin = args.clash_bin
+    if clash_bin is None:
+        from layout.layout import download_clash
+
+        # downloaded when the first shard arrives
+        clash_bin = download_clash
+    policy = ProbePolicy(
+        urls=args.echo_urls,
+        timeout=AdaptiveTimeout(initial=args.probe_timeout),
+        retry_ratio=args.probe_retry_ratio,
+        hedge_percentile=None if args.no_hedge else 0.9,
+    )
+    with ClashPool(
+        clash_bin, args.instances, args.clash_startup_timeout, args.probe_window
+    ) as pool:
+        run_worker(args.coordinator, authkey, args.name, pool, policy)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,11 @@
 from typing import Sequence, Union
 from .arguments import parse_args
-from .layout import set_layout, Layout
 
 
 def get_layout(init_args: Union[None, Sequence[str]] = None):
     args = parse_args(init_args=init_args)
+    # the rest is imported once the arguments are valid, `--help` stays fast
+    from .layout import set_layout, Layout
+
     set_layout(args=args)
     return Layout
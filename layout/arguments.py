@@ -1,5 +1,7 @@
 import argparse
 
+from utils.speed import ORDER_KEYS, speed_test_url
+
 
 def parse_args(init_args=None):
     parser = argparse.ArgumentParser(
@@ -42,6 +44,222 @@ def parse_args(init_args=None):
 
     # Standard Options
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument(
+        '--dns-concurrency',
+        help='max concurrent DNS lookups of proxy servers (default: %(default)s)',
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        '--dns-ttl',
+        help='seconds to cache resolved proxy servers (default: %(default)s)',
+        type=float,
+        default=3600,
+    )
+    parser.add_argument(
+        '--no-reachability',
+        help='probe egress IPs without first dropping proxies that accept no '
+        'TCP connection',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--connect-timeout',
+        help='seconds for a proxy server to accept a TCP connection on any of '
+        'its addresses (default: %(default)s)',
+        type=float,
+        default=3,
+    )
+    parser.add_argument(
+        '--connect-concurrency',
+        help='max proxy servers connected to at once (default: %(default)s)',
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        '--probe-ttl',
+        help='seconds to reuse a successful egress probe (default: %(default)s)',
+        type=float,
+        default=6 * 3600,
+    )
+    parser.add_argument(
+        '--probe-error-ttl',
+        help='seconds to reuse a failed egress probe (default: %(default)s)',
+        type=float,
+        default=15 * 60,
+    )
+    parser.add_argument(
+        '--clash-startup-timeout',
+        help='seconds to wait for a Clash instance to be ready (default: %(default)s)',
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        '--probe-window',
+        help='probe this many proxies at once per Clash instance through '
+        'per-proxy listeners, needs a Clash core supporting "listeners" '
+        '(default: %(default)s, switch proxies one by one)',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--geo-table',
+        help='look up countries in an interval table built from the mmdb, '
+        'cached next to it',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--fetch-timeout',
+        help='seconds to wait for a remote config (default: %(default)s)',
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        '--fetch-retries',
+        help='retries of a failed remote config download (default: %(default)s)',
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        '--probe-timeout',
+        help='initial seconds an egress probe may take, later adapted to the '
+        'observed probe durations (default: %(default)s)',
+        type=float,
+        default=10,
+    )
+    parser.add_argument(
+        '--probe-retry-ratio',
+        help='timed out or refused probes retried per run, relative to the '
+        'proxies probed (default: %(default)s)',
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        '--no-hedge',
+        help='do not hedge slow probes against a second echo endpoint',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--no-dedupe',
+        help='probe every listed proxy, even those with the same parameters',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--dedupe-ingress',
+        help='probe one proxy per ingress IP first and share its egress IP '
+        'with the others on that IP',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--speed-test',
+        help='measure latency, time to first byte and throughput of the '
+        'valid proxies',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--speed-test-url',
+        help='download endpoint of the speed test (default: %(default)s)',
+        default=speed_test_url,
+    )
+    parser.add_argument(
+        '--speed-test-concurrency',
+        help='proxies measured at once (default: %(default)s)',
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '--order-by',
+        help='number the proxies of a country by this measurement, '
+        'best first, needs --speed-test',
+        choices=ORDER_KEYS,
+    )
+    parser.add_argument(
+        '--asset-mirror',
+        help='directory to take the Clash and mmdb downloads from, '
+        'by the file names of their URLs',
+    )
+    parser.add_argument(
+        '--clash-sha256',
+        help='expected SHA-256 of the Clash download',
+    )
+    parser.add_argument(
+        '--mmdb-sha256',
+        help='expected SHA-256 of the mmdb download',
+    )
+    parser.add_argument(
+        '--mmdb-max-age',
+        help='seconds before the mmdb is refreshed in the background, '
+        '0 to never refresh (default: %(default)s)',
+        type=float,
+        default=7 * 24 * 3600,
+    )
+    parser.add_argument(
+        '--metrics-textfile',
+        help='write metrics of the run to this Prometheus textfile-collector '
+        'file, e.g. /var/lib/node_exporter/clash_customizer.prom',
+    )
+    parser.add_argument(
+        '--metrics-json',
+        help='write metrics of the run to this JSON report',
+    )
+    parser.add_argument(
+        '--probe-report',
+        help='stream the egress result of every proxy to this NDJSON file',
+    )
+
+    # Distributed Options
+    distributed_opts = parser.add_argument_group('Distributed Options')
+    distributed_opts.add_argument(
+        '--coordinator',
+        help='listen on host:port and probe egress IPs on the workers '
+        'connecting to it (python -m distributed.worker) instead of locally',
+    )
+    distributed_opts.add_argument(
+        '--authkey',
+        help='secret shared with the workers, '
+        'CLASH_CUSTOMIZER_AUTHKEY if not given',
+    )
+    distributed_opts.add_argument(
+        '--shard-size',
+        help='proxies handed to a worker at a time (default: %(default)s)',
+        type=int,
+        default=256,
+    )
+    distributed_opts.add_argument(
+        '--shard-timeout',
+        help='seconds before the shard of a silent worker is handed to '
+        'another (default: %(default)s)',
+        type=float,
+        default=600,
+    )
+
+    # Daemon Options
+    daemon_opts = parser.add_argument_group('Daemon Options')
+    daemon_opts.add_argument(
+        '-d',
+        '--daemon',
+        help='keep running, refresh subscriptions and update outputs on change',
+        action='store_true',
+    )
+    daemon_opts.add_argument(
+        '--refresh-intervals',
+        help='seconds between refreshes of each subscription, '
+        'or one value for all (default: %(default)s)',
+        nargs='+',
+        type=float,
+        default=[3600],
+    )
+    daemon_opts.add_argument(
+        '--reprobe-interval',
+        help='seconds between background re-probes (default: %(default)s)',
+        type=float,
+        default=60,
+    )
+    daemon_opts.add_argument(
+        '--reprobe-batch',
+        help='stale proxies to re-probe at a time (default: %(default)s)',
+        type=int,
+        default=32,
+    )
 
     args = parser.parse_args(init_args)
 
@@ -1,13 +1,16 @@
 import argparse
-from geoip2.database import Reader
-from geoip2.types import IPAddress
-from geoip2.models import Country
-import gzip
-import io
-from zipfile import ZipFile
-
-import requests
-from utils import load_yaml
+
+from distributed import Coordinator, get_authkey
+from utils import (
+    load_yamls,
+    AdaptiveTimeout,
+    DNSCache,
+    GeoLookup,
+    IntervalTable,
+    ProbePolicy,
+    ProbeStore,
+)
+from utils.assets import Asset, AssetManager
 import pathlib
 import os
 from typing import *
@@ -26,11 +29,20 @@ clash_extract_dir = os.path.abspath('assets')
 mmdb_url = 'https://git.io/GeoLite2-Country.mmdb'
 mmdb_download_dir = os.path.expanduser('assets')
 
+# versions of the downloaded assets, see `AssetManager`
+asset_manager = AssetManager(clash_extract_dir)
+# seconds to let background downloads finish before exiting
+asset_wait_timeout = 120
+
+dns_cache_path = os.path.join('assets', 'dns_cache.json')
+probe_store_path = os.path.join('assets', 'probes.sqlite3')
+
 OUTPUT_DIR = 'output'
 
 
 class Layout:
     # from arguments
+    subscription_sources: Sequence[str]
     subscription_configs: Iterable[Mapping] = []
     '''No guarantee of validity'''
     template_configs: Iterable[Mapping] = []
@@ -38,13 +50,63 @@ class Layout:
     output_paths: Iterable[str]
     prefixes: Iterable[str]
     enable_renames: Iterable[bool]
-    clash_bin: str
-    get_geometry: Callable[[IPAddress], Country]
+    clash_bin: Union[str, Callable[[], str]]
+    '''Downloaded when the first Clash instance starts'''
+    clash_startup_timeout: float
+    probe_window: int
+    dedupe: bool
+    dedupe_ingress: bool
+    speed_test: bool
+    speed_test_url: str
+    speed_test_concurrency: int
+    order_by: Union[str, None]
+    metrics_textfile: Union[str, None]
+    metrics_json: Union[str, None]
+    probe_report: Union[str, None]
+    dns_concurrency: int
+    dns_cache: DNSCache
+    reachability: bool
+    connect_timeout: float
+    connect_concurrency: int
+    probe_store: ProbeStore
+    probe_policy: ProbePolicy
+    coordinator: Union[Coordinator, None]
+    geo_table: bool
+    geo_lookup: Union[GeoLookup, None] = None
+    daemon: bool
+    refresh_intervals: Sequence[float]
+    reprobe_interval: float
+    reprobe_batch: int
 
     # manual set
     geometry_key = 'country'
     proxy_name_fmt_4 = '{iso_code}.{seq:02}'
     proxy_name_fmt_6 = 'IPv6.' + proxy_name_fmt_4
+    # assets, overridden by arguments
+    clash_sha256: Union[str, None] = None
+    mmdb_sha256: Union[str, None] = None
+    mmdb_max_age: Union[float, None] = 7 * 24 * 3600
+
+    @classmethod
+    def get_geo_lookup(cls) -> GeoLookup:
+        """Lookups in the mmdb, downloaded and loaded on first use, and
+        reloaded once a refreshed mmdb is in place."""
+        mmdb_path = download_mmdb()
+        if cls.geo_lookup is None or cls.geo_lookup.path != mmdb_path:
+            if cls.geo_lookup is not None:
+                cls.geo_lookup.close()
+            cls.geo_lookup = GeoLookup(
+                mmdb_path,
+                table=load_interval_table(mmdb_path) if cls.geo_table else None,
+            )
+        return cls.geo_lookup
+
+    @staticmethod
+    def wait_for_assets():
+        """Let downloads in the background, e.g. a refresh of a stale mmdb,
+        finish before the process exits, at most `asset_wait_timeout`
+        seconds."""
+        asset_manager.wait(asset_wait_timeout)
 
 
 def is_enable_renames_valid(enable_renames):
@@ -53,6 +115,40 @@ def is_enable_renames_valid(enable_renames):
     return r < s
 
 
+def clash_asset():
+    if os.name == 'nt':
+        return Asset(
+            'clash',
+            clash_url_windows,
+            clash_bin_name_windows,
+            unpack='zip',
+            sha256=Layout.clash_sha256,
+            executable=True,
+            legacy_path=os.path.join(clash_extract_dir, clash_bin_name_windows),
+        )
+    return Asset(
+        'clash',
+        clash_url_linux,
+        clash_bin_name_linux,
+        unpack='gzip',
+        sha256=Layout.clash_sha256,
+        executable=True,
+        legacy_path=os.path.join(clash_extract_dir, clash_bin_name_linux),
+    )
+
+
+def mmdb_asset():
+    filename = mmdb_url.split('/')[-1]
+    return Asset(
+        'mmdb',
+        mmdb_url,
+        filename,
+        sha256=Layout.mmdb_sha256,
+        max_age=Layout.mmdb_max_age,
+        legacy_path=os.path.join(mmdb_download_dir, filename),
+    )
+
+
 def download_clash():
     """
 
@@ -60,47 +156,28 @@ def download_clash():
     ---
     Path of Clash binary.
     """
-    os.makedirs(clash_extract_dir, exist_ok=True)
-    if os.name == 'nt':
-        path = os.path.join(clash_extract_dir, clash_bin_name_windows)
-        if os.path.exists(path):
-            logging.info(f'Clash bin exists, delete {path} if you wanna re-download.')
-            return path
-        url = clash_url_windows
-        logging.info(f'download clash from {url}')
-        r = requests.get(url)
-        data = r.content
-        zf = ZipFile(io.BytesIO(data))
-        zf.extractall(clash_extract_dir)
-        return path
-    else:
-        path = os.path.join(clash_extract_dir, clash_bin_name_linux)
-        if os.path.exists(path):
-            logging.info(f'Clash bin exists, delete {path} if you wanna re-download.')
-            return path
-        url = clash_url_linux
-        logging.info(f'download clash from {url}')
-        r = requests.get(url)
-        data = r.content
-        data = gzip.decompress(data)
-        with open(path, 'wb') as fd:
-            fd.write(data)
-        os.chmod(path, 0o775)
-        return path
+    return asset_manager.get(clash_asset())
 
 
 def download_mmdb():
-    filename = mmdb_url.split('/')[-1]
-    path = os.path.join(mmdb_download_dir, filename)
-    if os.path.exists(path):
-        logging.info(f'mmdb exist, delete {path} if you wanna update.')
-        return path
-    logging.info(f'downloading mmdb database from {mmdb_url}')
-    r = requests.get(mmdb_url)
-    data = r.content
-    with open(path, 'wb') as fd:
-        fd.write(data)
-    return path
+    """
+
+    Return
+    ---
+    Path of the mmdb, refreshed in the background once older than
+    `Layout.mmdb_max_age`.
+    """
+    return asset_manager.get(mmdb_asset())
+
+
+def load_interval_table(mmdb_path: str):
+    """Load the interval table of the mmdb, rebuild it if outdated."""
+    path = mmdb_path + '.table'
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(mmdb_path):
+        return IntervalTable.load(path)
+    table = IntervalTable.from_mmdb(mmdb_path)
+    table.save(path)
+    return table
 
 
 def set_layout(args: argparse.Namespace):
@@ -118,18 +195,36 @@ def set_layout(args: argparse.Namespace):
     assert len(args.subscription_configs) == len(args.prefixes)
     assert len(args.template_configs) == len(args.output_names)
 
+    # assets, missing and stale ones are downloaded at once in the background
+    # while configs load, the stages needing them wait for missing ones
+    asset_manager.mirror = args.asset_mirror
+    Layout.clash_sha256 = args.clash_sha256
+    Layout.mmdb_sha256 = args.mmdb_sha256
+    Layout.mmdb_max_age = args.mmdb_max_age if args.mmdb_max_age > 0 else None
+    assets = [mmdb_asset()]
+    if not args.coordinator:
+        assets.append(clash_asset())
+    asset_manager.prefetch(assets)
+
     # load proxy
     # adapt the proxy config to requests package
     # Notice: No guarantee of validation
     if os.environ.get('https_proxy') is not None:
         Layout.proxy = {'https': os.environ.get('https_proxy')}
 
-    # load subscription configs
-    Layout.subscription_configs = [load_yaml(x) for x in args.subscription_configs]
+    # load subscription & template configs at once
+    Layout.subscription_sources = args.subscription_configs
+    configs = load_yamls(
+        args.subscription_configs + args.template_configs,
+        timeout=args.fetch_timeout,
+        retries=args.fetch_retries,
+    )
+    Layout.subscription_configs = configs[: len(args.subscription_configs)]
 
-    # load & check template configs
-    for src in args.template_configs:
-        config = load_yaml(src)
+    # check template configs
+    for src, config in zip(
+        args.template_configs, configs[len(args.subscription_configs) :]
+    ):
         if 'proxy-groups' not in config.keys():
             raise KeyError(f'no "proxy-groups" in config {src}')
         Layout.template_configs.append(config)
@@ -146,7 +241,67 @@ def set_layout(args: argparse.Namespace):
         raise ValueError('enable_renames only accept value 0 or 1')
     Layout.enable_renames = [bool(int(x)) for x in args.enable_renames]
 
-    # Clash binary
-    Layout.clash_bin = download_clash()
-    mmdb_path = download_mmdb()
-    Layout.get_geometry = lambda ip: Reader(mmdb_path).country(ip)
+    # daemon
+    if len(args.refresh_intervals) == 1:
+        # a new list, the default one is shared by every parse
+        args.refresh_intervals = args.refresh_intervals * len(
+            args.subscription_configs
+        )
+    assert len(args.refresh_intervals) == len(args.subscription_configs)
+    Layout.daemon = args.daemon
+    Layout.refresh_intervals = args.refresh_intervals
+    Layout.reprobe_interval = args.reprobe_interval
+    Layout.reprobe_batch = args.reprobe_batch
+
+    # DNS
+    Layout.dns_concurrency = args.dns_concurrency
+    Layout.dns_cache = DNSCache(path=dns_cache_path, ttl=args.dns_ttl)
+
+    # TCP pre-filter
+    Layout.reachability = not args.no_reachability
+    Layout.connect_timeout = args.connect_timeout
+    Layout.connect_concurrency = args.connect_concurrency
+
+    # egress probe results
+    Layout.probe_store = ProbeStore(
+        path=probe_store_path, ttl=args.probe_ttl, error_ttl=args.probe_error_ttl
+    )
+    Layout.probe_store.prune()
+    Layout.probe_policy = ProbePolicy(
+        timeout=AdaptiveTimeout(initial=args.probe_timeout),
+        retry_ratio=args.probe_retry_ratio,
+        hedge_percentile=None if args.no_hedge else 0.9,
+    )
+    Layout.probe_policy.warm_up(Layout.probe_store.durations())
+
+    # Clash
+    Layout.clash_startup_timeout = args.clash_startup_timeout
+    Layout.probe_window = args.probe_window
+    Layout.dedupe = not args.no_dedupe
+    Layout.dedupe_ingress = args.dedupe_ingress
+
+    # distributed probing
+    Layout.coordinator = None
+    if args.coordinator:
+        Layout.coordinator = Coordinator(
+            args.coordinator,
+            get_authkey(args.authkey),
+            args.shard_size,
+            args.shard_timeout,
+        )
+
+    # metrics
+    Layout.metrics_textfile = args.metrics_textfile
+    Layout.metrics_json = args.metrics_json
+    Layout.probe_report = args.probe_report
+
+    # speed test
+    Layout.speed_test = args.speed_test
+    Layout.speed_test_url = args.speed_test_url
+    Layout.speed_test_concurrency = args.speed_test_concurrency
+    Layout.order_by = args.order_by if args.speed_test else None
+
+    # assets, see `clash_asset` and `mmdb_asset`
+    Layout.clash_bin = download_clash
+    Layout.geo_table = args.geo_table
+    Layout.geo_lookup = None
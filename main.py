@@ -1,11 +1,28 @@
+import os
+
 from layout import get_layout
-from config import *
+from utils.metrics import metrics
 
 
 def main():
     # Get configuration from cmdline
     layout = get_layout()
 
+    # imported once the arguments are valid, `--help` stays fast
+    from config import (
+        ProxyIndex,
+        SubscriptionConfigCollection,
+        TemplateConfig,
+        render_outputs,
+        write_outputs,
+    )
+    from clash import ClashPool
+    from daemon import Daemon
+
+    if layout.daemon:
+        Daemon(layout).run()
+        return
+
     # Instantiate template configs
     template_configs = [
         TemplateConfig(data=data, geometry_key=layout.geometry_key)
@@ -15,21 +32,69 @@ def main():
     subscription_config_collection = SubscriptionConfigCollection(
         data=layout.subscription_configs,
         enable_renames=layout.enable_renames,
+        names=layout.prefixes,
     )
     # preprocessing
-    subscription_config_collection.update_ingress_IPs()
-    subscription_config_collection.update_egress_IPs(layout.clash_bin)
-    subscription_config_collection.log_proxies_info()
-    subscription_config_collection.purify_proxies()
+    with metrics.stage('ingress'):
+        subscription_config_collection.update_ingress_IPs(
+            layout.dns_concurrency, layout.dns_cache
+        )
+    if layout.reachability:
+        with metrics.stage('reachability'):
+            subscription_config_collection.update_reachability(
+                layout.connect_timeout, layout.connect_concurrency
+            )
+    # one pool for probing and the speed test, instances start on first use
+    with ClashPool(
+        layout.clash_bin,
+        os.cpu_count() + 1,
+        layout.clash_startup_timeout,
+        layout.probe_window,
+    ) as pool:
+        with metrics.stage('egress'):
+            subscription_config_collection.update_egress_IPs(
+                layout.clash_bin,
+                layout.probe_store,
+                layout.clash_startup_timeout,
+                pool=pool,
+                dedupe=layout.dedupe,
+                dedupe_ingress=layout.dedupe_ingress,
+                policy=layout.probe_policy,
+                coordinator=layout.coordinator,
+                report_path=layout.probe_report,
+            )
+        subscription_config_collection.log_proxies_info()
+        with metrics.stage('purify'):
+            subscription_config_collection.purify_proxies()
+        if layout.speed_test:
+            with metrics.stage('speed'):
+                subscription_config_collection.update_speed(
+                    layout.clash_bin,
+                    layout.speed_test_url,
+                    layout.speed_test_concurrency,
+                    layout.clash_startup_timeout,
+                    pool=pool,
+                )
     # postprocessing
-    subscription_config_collection.update_geometry(layout.get_geometry)
-    country_map = subscription_config_collection.rename_proxies(
-        layout.proxy_name_fmt_4, layout.proxy_name_fmt_6, layout.prefixes
-    )
+    with metrics.stage('geo'):
+        subscription_config_collection.update_geometry(layout.get_geo_lookup())
+    with metrics.stage('rename'):
+        country_map = subscription_config_collection.rename_proxies(
+            layout.proxy_name_fmt_4,
+            layout.proxy_name_fmt_6,
+            layout.prefixes,
+            layout.order_by,
+        )
+
+    with metrics.stage('inject'):
+        texts = render_outputs(template_configs, ProxyIndex(country_map))
+    with metrics.stage('save'):
+        write_outputs(layout.output_paths, texts)
+    if layout.coordinator is not None:
+        layout.coordinator.close()
+    layout.wait_for_assets()
 
-    for template_config, output_path in zip(template_configs, layout.output_paths):
-        template_config.inject(country_map=country_map)
-        template_config.save(path=output_path)
+    metrics.write(layout.metrics_textfile, layout.metrics_json)
 
 
 if __name__ == '__main__':
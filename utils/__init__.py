@@ -1 +1,45 @@
-from .utils import *
\ No newline at end of file
+"""Names are imported from their submodules on first use, so that light
+commands like `utils.fast_update` do not pay for `requests`, `maxminddb` or
+`asyncio` at startup."""
+import importlib
+
+_SUBMODULES = {
+    'load_yaml': 'serialization',
+    'load_yamls': 'utils',
+    'load_yaml_from_url': 'serialization',
+    'load_yaml_from_path': 'serialization',
+    'make_simple_clash_config': 'utils',
+    'make_listeners_clash_config': 'utils',
+    'my_nslookup': 'utils',
+    'get_egress_ip': 'utils',
+    'designate_jobs': 'utils',
+    'interleave': 'utils',
+    'is_tcp_port_in_use': 'utils',
+    'get_tcp_port_picker': 'utils',
+    'DNSCache': 'resolver',
+    'resolve_hostnames': 'resolver',
+    'check_reachability': 'reachability',
+    'ProbeStore': 'probe_store',
+    'AdaptiveTimeout': 'probing',
+    'ProbePolicy': 'probing',
+    'RetryBudget': 'probing',
+    'GeoLookup': 'geo',
+    'Geometry': 'geo',
+    'IntervalTable': 'geo',
+    'dump_json': 'serialization',
+    'dump_yaml': 'serialization',
+    'loads_yaml': 'serialization',
+    'SpeedSample': 'speed',
+    'measure_speed': 'speed',
+}
+
+__all__ = list(_SUBMODULES)
+
+
+def __getattr__(name: str):
+    if name not in _SUBMODULES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(f'.{_SUBMODULES[name]}', __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
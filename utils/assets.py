@@ -0,0 +1,380 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import IO, Dict, Iterable, NamedTuple, Union
+from urllib.parse import urlsplit
+
+CHUNK_SIZE = 2**16
+# seconds before a failed background refresh is tried again
+REFRESH_RETRY_INTERVAL = 3600
+# seconds without writes before a partial download is taken for one left
+# by an interrupted process
+ORPHAN_AGE = 3600
+
+
+class AssetError(RuntimeError):
+    pass
+
+
+class Asset(NamedTuple):
+    name: str
+    url: str
+    # name of the stored file, e.g. 'GeoLite2-Country.mmdb'
+    filename: str
+    # '' to keep the download as is, 'gzip', or 'zip' to take `filename`
+    # out of the archive
+    unpack: str = ''
+    # expected SHA-256 of the download, not checked if `None`
+    sha256: Union[str, None] = None
+    # seconds before the stored version is refreshed, never if `None`
+    max_age: Union[float, None] = None
+    executable: bool = False
+    # where older versions kept the file, adopted instead of downloading
+    legacy_path: Union[str, None] = None
+
+
+def _copy(src: IO, dst: IO, digest=None):
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        if digest is not None:
+            digest.update(chunk)
+        dst.write(chunk)
+
+
+def _file_digest(path: str):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _remove(*paths: str):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class AssetManager:
+    """Downloaded assets like the Clash binary and the mmdb, kept in a
+    content-addressed store.
+
+    Versions live in `<path>/store/<sha256>-<filename>` and an index maps
+    each asset to its current version. A new version is streamed to disk,
+    verified, unpacked and stored before the index is switched over
+    atomically, so readers see either the old or the new version. The
+    current and the previous version of each asset are kept.
+
+    Downloads run on background threads: missing and stale assets can be
+    fetched concurrently with `prefetch`, and a stale asset is refreshed
+    while `get` keeps returning the stored version. The threads do not keep
+    the process alive, `wait` for them before exiting.
+    """
+
+    def __init__(
+        self, path: str, mirror: Union[str, None] = None, timeout: float = 60
+    ) -> None:
+        """
+
+        Args
+        ---
+        - mirror: directory to take downloads from instead of their URL,
+          looked up by the last component of the URL path.
+        - timeout: seconds without data before a download fails.
+        """
+        self.path = path
+        self.mirror = mirror
+        self.timeout = timeout
+        self.store_dir = os.path.join(path, 'store')
+        self.index_path = os.path.join(path, 'assets.json')
+        self._lock = threading.Lock()
+        self._fetching: Dict[str, Future] = {}
+        self._failed: Dict[str, float] = {}
+        self._opened = False
+
+    def get(self, asset: Asset) -> str:
+        """
+
+        Return
+        ---
+        Path of the current version of `asset`, downloaded first if there is
+        none. A stale version is returned while a newer one is fetched in the
+        background.
+
+        Raise
+        ---
+        `AssetError` if there is no version and the download failed.
+        """
+        with self._lock:
+            self._open()
+            entry = self._read_index().get(asset.name)
+            path = self._stored_path(entry)
+            if path is not None:
+                if self._is_stale(asset, entry):
+                    self._start(asset)
+                return path
+            future = self._start(asset)
+        return future.result()
+
+    def prefetch(self, assets: Iterable[Asset]):
+        """Start downloading the `assets` without a version yet, and
+        refreshing the stale ones, at once."""
+        with self._lock:
+            self._open()
+            index = self._read_index()
+            for asset in assets:
+                entry = index.get(asset.name)
+                if self._stored_path(entry) is None or self._is_stale(asset, entry):
+                    self._start(asset)
+
+    def wait(self, timeout: float) -> bool:
+        """Wait at most `timeout` seconds for the downloads in progress.
+
+        Return
+        ---
+        Whether every download finished, successfully or not.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            futures = dict(self._fetching)
+        for name, future in futures.items():
+            try:
+                future.exception(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                logging.warning(
+                    f'[assets] {name}: still downloading after {timeout}s, '
+                    f'left for the next run'
+                )
+                return False
+        return True
+
+    def _open(self):
+        """Sweep partial downloads left by interrupted processes, once.
+        Called with the lock held."""
+        if self._opened:
+            return
+        self._opened = True
+        try:
+            entries = list(os.scandir(self.store_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.endswith('.part'):
+                continue
+            try:
+                if time.time() - entry.stat().st_mtime > ORPHAN_AGE:
+                    os.remove(entry.path)
+                    logging.info(f'[assets] removed partial download {entry.name}')
+            except FileNotFoundError:
+                pass
+
+    def _stored_path(self, entry: Union[dict, None]):
+        if entry is None:
+            return None
+        path = os.path.join(self.store_dir, entry['file'])
+        return path if os.path.exists(path) else None
+
+    def _is_stale(self, asset: Asset, entry: dict):
+        if asset.max_age is None:
+            return False
+        if time.time() - self._failed.get(asset.name, 0) < REFRESH_RETRY_INTERVAL:
+            return False
+        return time.time() - entry['fetched'] > asset.max_age
+
+    def _start(self, asset: Asset) -> Future:
+        """Fetch `asset` on a thread, unless it is being fetched already.
+        Called with the lock held."""
+        if asset.name in self._fetching:
+            return self._fetching[asset.name]
+        future: Future = Future()
+        self._fetching[asset.name] = future
+
+        def run():
+            try:
+                future.set_result(self._fetch(asset))
+            except Exception as e:
+                logging.warning(f'[assets] {asset.name}: {type(e).__name__}: {e}')
+                self._failed[asset.name] = time.time()
+                future.set_exception(
+                    e if isinstance(e, AssetError) else AssetError(str(e))
+                )
+            finally:
+                with self._lock:
+                    del self._fetching[asset.name]
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def _fetch(self, asset: Asset) -> str:
+        os.makedirs(self.store_dir, exist_ok=True)
+        if asset.legacy_path and os.path.isfile(asset.legacy_path):
+            with self._lock:
+                adopt = asset.name not in self._read_index()
+            # `sha256` is of the download, a legacy file unpacked from an
+            # archive cannot match it and is downloaded again
+            if adopt and (
+                asset.sha256 is None
+                or _file_digest(asset.legacy_path) == asset.sha256.lower()
+            ):
+                logging.info(f'[assets] {asset.name}: adopt {asset.legacy_path}')
+                tmp = self._temp_path()
+                shutil.copyfile(asset.legacy_path, tmp)
+                # as old as the file, a stale one is refreshed soon
+                fetched = os.path.getmtime(asset.legacy_path)
+                return self._store(asset, tmp, asset.legacy_path, fetched)
+            if adopt:
+                logging.warning(
+                    f'[assets] {asset.name}: {asset.legacy_path} does not match '
+                    f'the checksum, download instead'
+                )
+
+        download = self._temp_path()
+        unpacked = None
+        try:
+            with open(download, 'wb') as fd:
+                source, digest = self._download(asset, fd)
+            if asset.sha256 is not None and digest != asset.sha256.lower():
+                raise AssetError(
+                    f'{asset.name}: checksum mismatch, '
+                    f'expected {asset.sha256}, got {digest}'
+                )
+            unpacked = self._unpack(asset, download)
+            return self._store(asset, unpacked, source)
+        finally:
+            _remove(download, *([unpacked] if unpacked else []))
+
+    def _temp_path(self):
+        fd, path = tempfile.mkstemp(dir=self.store_dir, suffix='.part')
+        os.close(fd)
+        return path
+
+    def _download(self, asset: Asset, out: IO):
+        """Stream the download of `asset` to `out`.
+
+        Return
+        ---
+        `(source, SHA-256 of the download)`.
+        """
+        digest = hashlib.sha256()
+        if self.mirror is not None:
+            filename = os.path.basename(urlsplit(asset.url).path)
+            source = os.path.join(self.mirror, filename)
+            logging.info(f'[assets] {asset.name}: copy from {source}')
+            with open(source, 'rb') as fd:
+                _copy(fd, out, digest)
+            return source, digest.hexdigest()
+
+        import requests
+
+        logging.info(f'[assets] {asset.name}: download from {asset.url}')
+        start = time.perf_counter()
+        size = 0
+        with requests.get(asset.url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(CHUNK_SIZE):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        logging.info(
+            f'[assets] {asset.name}: {size} bytes '
+            f'in {time.perf_counter() - start:.1f}s'
+        )
+        return asset.url, digest.hexdigest()
+
+    def _unpack(self, asset: Asset, download: str) -> str:
+        """
+
+        Return
+        ---
+        A new temporary file with the content to store.
+        """
+        unpacked = self._temp_path()
+        with open(unpacked, 'wb') as out:
+            if asset.unpack == 'gzip':
+                with gzip.open(download, 'rb') as fd:
+                    _copy(fd, out)
+            elif asset.unpack == 'zip':
+                with zipfile.ZipFile(download) as zf, zf.open(asset.filename) as fd:
+                    _copy(fd, out)
+            else:
+                with open(download, 'rb') as fd:
+                    _copy(fd, out)
+        return unpacked
+
+    def _store(
+        self,
+        asset: Asset,
+        tmp: str,
+        source: str,
+        fetched: Union[float, None] = None,
+    ) -> str:
+        """Move `tmp` into the store and make it the current version, fetched
+        at `fetched`, now if not given."""
+        digest = _file_digest(tmp)
+        name = f'{digest}-{asset.filename}'
+        path = os.path.join(self.store_dir, name)
+        if asset.executable:
+            os.chmod(tmp, 0o775)
+        if os.path.exists(path):
+            # same content as a stored version
+            _remove(tmp)
+        else:
+            os.replace(tmp, path)
+        with self._lock:
+            index = self._read_index()
+            previous = index.get(asset.name, {})
+            index[asset.name] = {
+                'file': name,
+                'previous': previous.get('file')
+                if previous.get('file') != name
+                else previous.get('previous'),
+                'source': source,
+                'fetched': time.time() if fetched is None else fetched,
+            }
+            self._write_index(index)
+            self._prune(asset, index)
+        logging.info(f'[assets] {asset.name}: current version {name}')
+        return path
+
+    def _prune(self, asset: Asset, index: dict):
+        """Remove versions of `asset` other than the current and previous
+        ones, with their side files like interval tables."""
+        keep = {index[asset.name]['file'], index[asset.name]['previous']}
+        for entry in os.scandir(self.store_dir):
+            digest, _, rest = entry.name.partition('-')
+            if not rest.startswith(asset.filename):
+                continue
+            if f'{digest}-{asset.filename}' in keep:
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError:
+                # still in use, e.g. a running binary on Windows
+                pass
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fd:
+            json.dump(index, fd, indent=2)
+        os.replace(tmp, self.index_path)
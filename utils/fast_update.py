@@ -2,51 +2,177 @@
 
 Args
 ---
-- config: previous output config
-- template_config: tiny update like rules update
+- configs: previous output configs, or directories of them, e.g. `output/`
+- template: tiny update like rules update
 
 Function
 ---
-Instantiate a template config and copy proxies in config to it, then override
-the old config.
+Instantiate a template config and copy proxies in each config to it, then
+override the old config. Proxies of the template replace the config proxies
+of the same name.
+
+The template is parsed once, configs are updated in parallel processes and
+written atomically.
 """
 import argparse
-import yaml
-from utils.utils import load_yaml
+import logging
+import os
+import sys
+from typing import Dict, List, Mapping, Sequence
+
+from utils.serialization import (
+    cache_yaml,
+    dump_yaml,
+    load_yaml,
+    loads_yaml,
+    write_atomic,
+)
+
+# of files being written, skipped in directories
+TEMP_SUFFIX = '.tmp'
 
 parser = argparse.ArgumentParser()
-parser.add_argument('config', help='config to be update.')
+parser.add_argument(
+    'configs', nargs='+', help='configs, or directories of configs, to be update.'
+)
 parser.add_argument('template', help='template to be injected.')
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=os.cpu_count(),
+    help='configs updated at once (default: %(default)s)',
+)
 
 
-def main():
-    # parse args
-    args = parser.parse_args()
+def expand_paths(paths: Sequence[str]) -> List[str]:
+    """Replace directories by the configs directly inside them: every
+    regular file, outputs have no extension, but hidden and temporary ones.
+
+    Raise
+    ---
+    `FileNotFoundError` if a directory holds no config.
+    """
+    ret = []
+    for path in paths:
+        if not os.path.isdir(path):
+            ret.append(path)
+            continue
+        configs = sorted(
+            entry.path
+            for entry in os.scandir(path)
+            if entry.is_file()
+            and not entry.name.startswith('.')
+            and not entry.name.endswith(TEMP_SUFFIX)
+        )
+        if not configs:
+            raise FileNotFoundError(f'no config in directory {path}')
+        ret += configs
+    return ret
 
-    # load configs
-    config = load_yaml(args.config)
-    template = load_yaml(args.template)
 
+def update(config: Mapping, template: Mapping) -> dict:
+    """
+
+    Return
+    ---
+    `template` with the proxies of `config`, those also in `template`
+    replaced by the template ones. Neither argument is changed.
+    """
     # Template has 2 type of changes to update:
     # 1. proxy
     # 2. non-proxy
+    proxies = list(config.get('proxies') or [])
 
-    # inject proxies in template to config
-    if 'proxies' in template.keys():
-        for i in range(len(template['proxies'])):
-            for j in range(len(config['proxies'])):
-                if template['proxies'][i]['name'] == config['proxies'][j]['name']:
-                    config['proxies'][j] = template['proxies'][i]
+    # inject proxies in template to config, by name, every config proxy of
+    # the name is replaced
+    if template.get('proxies'):
+        index: Dict[str, List[int]] = {}
+        for i, proxy in enumerate(proxies):
+            index.setdefault(proxy['name'], []).append(i)
+        for proxy in template['proxies']:
+            for i in index.get(proxy['name'], []):
+                proxies[i] = proxy
 
     # inject injected config proxies to template
-    template['proxies'] = config['proxies']
+    ret = dict(template)
+    ret['proxies'] = proxies
+    return ret
+
+
+def update_file(path: str, template: Mapping):
+    with open(path, 'rb') as fd:
+        config = loads_yaml(fd.read())
+    updated = update(config, template)
+    raw = dump_yaml(updated).encode('utf-8')
+    write_atomic(path, raw, suffix=TEMP_SUFFIX)
+    # the next update of this output skips parsing
+    cache_yaml(raw, updated)
+    return path
+
+
+_template = None
+
 
-    # save
-    with open(args.config, 'w') as fd:
-        yaml.safe_dump(template, fd, allow_unicode=True)
+def _init_worker(template: Mapping):
+    global _template
+    _template = template
+
+
+def _update_file_in_worker(path: str):
+    return update_file(path, _template)
+
+
+def update_files(paths: Sequence[str], template: Mapping, jobs: int = 1):
+    """Update every config at `paths`, in `jobs` processes.
+
+    Return
+    ---
+    Paths that failed, with their errors.
+    """
+    failures = []
+    if jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            try:
+                update_file(path, template)
+                print(f'config updated: {path}')
+            except Exception as e:
+                failures.append((path, e))
+        return failures
+
+    # multiprocessing is slow to import, only for many configs
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        min(jobs, len(paths)), initializer=_init_worker, initargs=(template,)
+    ) as executor:
+        futures = [executor.submit(_update_file_in_worker, path) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                future.result()
+                print(f'config updated: {path}')
+            except Exception as e:
+                failures.append((path, e))
+    return failures
+
+
+def main(init_args=None):
+    # parse args
+    args = parser.parse_args(init_args)
+
+    # load the template once
+    template = load_yaml(args.template)
 
-    print(f'config updated: {args.config}')
+    try:
+        paths = expand_paths(args.configs)
+    except FileNotFoundError as e:
+        logging.error(str(e))
+        return 1
+    failures = update_files(paths, template, args.jobs)
+    for path, e in failures:
+        logging.error(f'failed to update {path}, {type(e).__name__}: {e}')
+    return 1 if failures else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
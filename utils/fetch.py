@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+http_cache_dir = os.path.join('assets', 'cache', 'http')
+
+
+class HTTPCache:
+    """Last response body of each URL with its `ETag` and `Last-Modified`."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def _files(self, url: str):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.path, name)
+        return base + '.body', base + '.json'
+
+    def get(self, url: str) -> Union[Tuple[bytes, dict], None]:
+        """
+
+        Return
+        ---
+        `(body, validators)`, `None` if not cached.
+        """
+        body_path, meta_path = self._files(url)
+        try:
+            with open(meta_path, 'r') as fd:
+                meta = json.load(fd)
+            with open(body_path, 'rb') as fd:
+                body = fd.read()
+        except (OSError, ValueError):
+            return None
+        return body, meta['validators']
+
+    def put(self, url: str, body: bytes, validators: dict):
+        os.makedirs(self.path, exist_ok=True)
+        body_path, meta_path = self._files(url)
+        for path, mode, data in (
+            (body_path, 'wb', body),
+            (meta_path, 'w', json.dumps({'url': url, 'validators': validators})),
+        ):
+            with open(path + '.tmp', mode) as fd:
+                fd.write(data)
+            os.replace(path + '.tmp', path)
+
+
+def make_session(pool_size: int = 16, retries: int = 3):
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+        ),
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(
+    session: requests.Session,
+    url: str,
+    timeout: float = 30,
+    cache: Union[HTTPCache, None] = None,
+) -> bytes:
+    """GET `url`, revalidating the cached copy if there is one.
+
+    The cached copy is also used, with a warning, if the request fails.
+    """
+    headers = {'charset': 'utf-8'}
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None:
+        validators = cached[1]
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last-modified' in validators:
+            headers['If-Modified-Since'] = validators['last-modified']
+
+    try:
+        r = session.get(url=url, headers=headers, timeout=timeout)
+        if r.status_code == 304 and cached is not None:
+            logging.info(f'[fetch] not modified, {url}')
+            return cached[0]
+        r.raise_for_status()
+    except (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.HTTPError,
+        requests.exceptions.RetryError,
+    ) as e:
+        if cached is None:
+            raise
+        logging.warning(f'[fetch] {type(e).__name__}, use cached copy of {url}')
+        return cached[0]
+
+    logging.info(f'[fetch] {len(r.content)} bytes, {url}')
+    if cache is not None:
+        validators = {
+            key: r.headers[key]
+            for key in ('etag', 'last-modified')
+            if key in r.headers
+        }
+        cache.put(url, r.content, validators)
+    return r.content
+
+
+def fetch_many(
+    urls: Sequence[str],
+    timeout: float = 30,
+    retries: int = 3,
+    cache: Union[HTTPCache, None] = None,
+    max_workers: int = 16,
+) -> List[bytes]:
+    """Fetch concurrently over one connection pool.
+
+    Return
+    ---
+    Bodies, in the order of `urls`.
+    """
+    if not urls:
+        return []
+    workers = min(len(urls), max_workers)
+    session = make_session(pool_size=workers, retries=retries)
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [
+            executor.submit(fetch, session, url, timeout, cache) for url in urls
+        ]
+        return [future.result() for future in futures]
@@ -0,0 +1,197 @@
+import bisect
+import collections
+import ipaddress
+import logging
+import os
+import pickle
+import threading
+from array import array
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Union
+
+import maxminddb
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+# records of networks at least this wide are cached for the whole prefix
+CACHE_PREFIX_LEN = {4: 24, 6: 48}
+
+
+class GeoCountry(NamedTuple):
+    iso_code: Union[str, None]
+
+
+class GeoContinent(NamedTuple):
+    code: Union[str, None]
+
+
+class Geometry(NamedTuple):
+    country: GeoCountry
+    continent: GeoContinent
+
+
+def to_geometry(record: Union[Mapping, None]) -> Union[Geometry, None]:
+    if record is None:
+        return None
+    return Geometry(
+        country=GeoCountry(record.get('country', {}).get('iso_code')),
+        continent=GeoContinent(record.get('continent', {}).get('code')),
+    )
+
+
+def _open_mmdb(path: str):
+    try:
+        return maxminddb.open_database(path, maxminddb.MODE_MMAP_EXT)
+    except ValueError:
+        # C extension unavailable
+        return maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+
+class IntervalTable:
+    """Sorted, non-overlapping address intervals of an mmdb, for bisect
+    lookups without the database.
+
+    IPv4 bounds are kept in `array('I')`, IPv6 bounds in plain lists.
+    """
+
+    def __init__(self) -> None:
+        self.starts = {4: array('I'), 6: []}
+        self.ends = {4: array('I'), 6: []}
+        self.values = {4: array('H'), 6: array('H')}
+        self.geometries: List[Geometry] = []
+
+    @classmethod
+    def from_mmdb(cls, path: str):
+        table = cls()
+        index: Dict[Geometry, int] = {}
+        networks = {4: [], 6: []}
+        with _open_mmdb(path) as reader:
+            for network, record in reader:
+                geometry = to_geometry(record)
+                if geometry not in index:
+                    index[geometry] = len(table.geometries)
+                    table.geometries.append(geometry)
+                networks[network.version].append(
+                    (
+                        int(network.network_address),
+                        int(network.broadcast_address),
+                        index[geometry],
+                    )
+                )
+        for version, intervals in networks.items():
+            intervals.sort()
+            for start, end, value in intervals:
+                if table.ends[version] and start <= table.ends[version][-1]:
+                    # aliased or nested network, already covered
+                    continue
+                table.starts[version].append(start)
+                table.ends[version].append(end)
+                table.values[version].append(value)
+        logging.info(
+            f'[geo] interval table of {path}, '
+            f'{len(table.starts[4])} IPv4 and {len(table.starts[6])} IPv6 '
+            f'intervals, {len(table.geometries)} distinct records'
+        )
+        return table
+
+    def lookup(self, ip: IPAddress) -> Union[Geometry, None]:
+        starts = self.starts[ip.version]
+        value = int(ip)
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > self.ends[ip.version][i]:
+            return None
+        return self.geometries[self.values[ip.version][i]]
+
+    def save(self, path: str):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fd:
+            pickle.dump(self, fd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path: str) -> 'IntervalTable':
+        with open(path, 'rb') as fd:
+            return pickle.load(fd)
+
+
+class GeoLookup:
+    """Country and continent lookups against an mmdb opened once in mmap mode.
+
+    Instances can be pickled to worker processes, each process maps the same
+    file and so shares its pages. Records of wide networks are kept in an LRU
+    cache keyed by their /24 (IPv4) or /48 (IPv6) prefix.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cache_size: int = 4096,
+        table: Union[IntervalTable, None] = None,
+    ) -> None:
+        self.path = path
+        self.cache_size = cache_size
+        self.table = table
+        self._init_process_state()
+
+    def _init_process_state(self):
+        self._reader = None
+        self._lock = threading.Lock()
+        self._cache: collections.OrderedDict = collections.OrderedDict()
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = _open_mmdb(self.path)
+        return self._reader
+
+    def build_table(self):
+        """Switch to bisect lookups on an interval table of the mmdb."""
+        self.table = IntervalTable.from_mmdb(self.path)
+        return self.table
+
+    def lookup(self, ip: IPAddress) -> Union[Geometry, None]:
+        if self.table is not None:
+            return self.table.lookup(ip)
+
+        shift = ip.max_prefixlen - CACHE_PREFIX_LEN[ip.version]
+        keys = ((ip.version, int(ip) >> shift, shift), (ip.version, int(ip), 0))
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    return self._cache[key]
+
+        record, prefix_len = self.reader.get_with_prefix_len(ip)
+        geometry = to_geometry(record)
+        key = keys[0] if prefix_len <= CACHE_PREFIX_LEN[ip.version] else keys[1]
+        with self._lock:
+            self._cache[key] = geometry
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return geometry
+
+    def lookup_many(
+        self, ips: Iterable[IPAddress]
+    ) -> Dict[IPAddress, Union[Geometry, None]]:
+        """
+
+        Return
+        ---
+        Dict from each distinct IP to its record, `None` if not found.
+        """
+        return {ip: self.lookup(ip) for ip in dict.fromkeys(ips)}
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def __getstate__(self):
+        return {
+            'path': self.path,
+            'cache_size': self.cache_size,
+            'table': self.table,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
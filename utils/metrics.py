@@ -0,0 +1,204 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple, Union
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _escape(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Gauges, counters and summaries of a run, written as a Prometheus
+    textfile-collector file and as a JSON report. Thread-safe.
+
+    Names are given without the namespace, e.g. `stage_duration_seconds`.
+    """
+
+    def __init__(self, namespace: str = 'clash_customizer') -> None:
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        # name -> (type, help)
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        # sample name -> labels -> value
+        self._samples: Dict[str, Dict[Labels, float]] = {}
+
+    def describe(self, name: str, kind: str, help: str):
+        """
+
+        Args
+        ---
+        - kind: `gauge`, `counter` or `summary`.
+        """
+        self._meta[name] = (kind, help)
+
+    @staticmethod
+    def _labels(labels: Dict[str, object]) -> Labels:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._samples.setdefault(name, {})[self._labels(labels)] = value
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            samples = self._samples.setdefault(name, {})
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Add `value` to the summary `name`, also keeping its maximum as the
+        gauge `name_max`."""
+        key = self._labels(labels)
+        with self._lock:
+            for suffix, update in (
+                ('_sum', lambda old: old + value),
+                ('_count', lambda old: old + 1),
+                ('_max', lambda old: max(old, value)),
+            ):
+                samples = self._samples.setdefault(name + suffix, {})
+                samples[key] = update(samples.get(key, 0))
+
+    def clear(self, name: str):
+        """Drop every sample of `name`, e.g. before setting per-run values."""
+        with self._lock:
+            self._samples.pop(name, None)
+
+    def get(self, name: str, **labels) -> Union[float, None]:
+        with self._lock:
+            return self._samples.get(name, {}).get(self._labels(labels))
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Time the enclosed block as stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.set('stage_duration_seconds', seconds, stage=name)
+            logging.info(f'[metrics] stage {name} took {seconds:.3f}s')
+
+    def _families(self):
+        """Sample names grouped under their described metric."""
+        with self._lock:
+            samples = {name: dict(values) for name, values in self._samples.items()}
+        families: Dict[str, Dict[str, Dict[Labels, float]]] = {}
+        for name, values in samples.items():
+            family = name
+            for suffix in ('_sum', '_count'):
+                base = name[: -len(suffix)]
+                if name.endswith(suffix) and self._meta.get(base, ('',))[0] == 'summary':
+                    family = base
+            families.setdefault(family, {})[name] = values
+        return families
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for family, samples in sorted(self._families().items()):
+            kind, help = self._meta.get(family, ('untyped', ''))
+            full = f'{self.namespace}_{family}'
+            lines.append(f'# HELP {full} {help}')
+            lines.append(f'# TYPE {full} {kind}')
+            for name, values in sorted(samples.items()):
+                for labels, value in sorted(values.items()):
+                    text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    text = '{' + text + '}' if text else ''
+                    lines.append(f'{self.namespace}_{name}{text} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> dict:
+        return {
+            'namespace': self.namespace,
+            'metrics': {
+                name: [
+                    {'labels': dict(labels), 'value': value}
+                    for labels, value in sorted(values.items())
+                ]
+                for family, samples in sorted(self._families().items())
+                for name, values in sorted(samples.items())
+            },
+        }
+
+    def write(
+        self,
+        textfile: Union[str, None] = None,
+        json_path: Union[str, None] = None,
+    ):
+        """Write the Prometheus textfile and the JSON report, atomically so
+        collectors never read a partial file."""
+        self.set('last_run_timestamp_seconds', time.time())
+        for path, text in (
+            (textfile, self.to_prometheus),
+            (json_path, lambda: json.dumps(self.to_json(), indent=2)),
+        ):
+            if path is None:
+                continue
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as fd:
+                fd.write(text())
+            os.replace(tmp, path)
+            logging.info(f'[metrics] written to {path}')
+
+
+metrics = Metrics()
+metrics.describe(
+    'stage_duration_seconds', 'gauge', 'Duration of the latest run of each stage.'
+)
+metrics.describe(
+    'subscription_proxies',
+    'gauge',
+    'Proxies of each subscription before and after purify.',
+)
+metrics.describe(
+    'egress_outcomes',
+    'gauge',
+    'Egress results of the latest run by subscription and outcome class.',
+)
+metrics.describe(
+    'egress_probes',
+    'gauge',
+    'Egress results of the latest run by source: probed, cached or shared.',
+)
+metrics.describe(
+    'reachability_proxies',
+    'gauge',
+    'Proxies of the latest TCP pre-filter by outcome: reachable, unreachable '
+    'or skipped.',
+)
+metrics.describe(
+    'connect_rtt_seconds',
+    'summary',
+    'TCP connect RTT to the fastest address of reachable proxies.',
+)
+metrics.describe(
+    'connect_rtt_seconds_max', 'gauge', 'Slowest TCP connect of reachable proxies.'
+)
+metrics.describe('clash_instances', 'gauge', 'Running Clash instances.')
+metrics.describe('clash_starts_total', 'counter', 'Clash instances started.')
+metrics.describe(
+    'clash_startup_seconds', 'summary', 'Seconds until a Clash controller answered.'
+)
+metrics.describe(
+    'clash_startup_seconds_max', 'gauge', 'Slowest Clash startup so far.'
+)
+metrics.describe(
+    'distributed_workers', 'gauge', 'Workers connected to the coordinator.'
+)
+metrics.describe(
+    'distributed_shards_total',
+    'counter',
+    'Shards of proxies probed on workers by outcome: done or requeued.',
+)
+metrics.describe(
+    'daemon_cycle_failures_total', 'counter', 'Daemon cycles that raised an error.'
+)
+metrics.describe(
+    'last_run_timestamp_seconds', 'gauge', 'When the metrics were last written.'
+)
@@ -0,0 +1,151 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Tuple, Union
+
+
+class ProbeStore:
+    """SQLite store of egress probe results, keyed by proxy fingerprint.
+
+    A result is reused while it is younger than the TTL of its outcome and
+    the proxy still resolves to the same ingress IP. Results are committed
+    one by one, so an interrupted run keeps what it has probed so far.
+
+    The duration of each probe is kept as well, see `durations`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 6 * 3600,
+        error_ttl: float = 15 * 60,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS probes ('
+            'fingerprint TEXT PRIMARY KEY, '
+            'ingress TEXT, '
+            'egress TEXT, '
+            'error TEXT, '
+            'probed_at REAL, '
+            'duration REAL)'
+        )
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(probes)')]
+        if 'duration' not in columns:
+            # store of an older version
+            self._conn.execute('ALTER TABLE probes ADD COLUMN duration REAL')
+        self._conn.commit()
+
+    def get(
+        self, fingerprint: str, ingress: Union[str, None]
+    ) -> Union[Tuple[Union[str, None], Union[str, None]], None]:
+        """
+
+        Return
+        ---
+        `None` if no fresh result, otherwise `(egress, error)` where exactly
+        one is set.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT ingress, egress, error, probed_at FROM probes '
+                'WHERE fingerprint = ?',
+                (fingerprint,),
+            ).fetchone()
+        if row is None:
+            return None
+        row_ingress, egress, error, probed_at = row
+        if row_ingress != ingress:
+            return None
+        ttl = self.ttl if error is None else self.error_ttl
+        if probed_at + ttl < time.time():
+            return None
+        return egress, error
+
+    def put(
+        self,
+        fingerprint: str,
+        ingress: Union[str, None],
+        egress: Union[str, None],
+        error: Union[str, None],
+        duration: Union[float, None] = None,
+    ):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO probes '
+                '(fingerprint, ingress, egress, error, probed_at, duration) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (fingerprint, ingress, egress, error, time.time(), duration),
+            )
+            self._conn.commit()
+
+    def durations(self, limit: int = 256) -> List[float]:
+        """
+
+        Return
+        ---
+        Durations of the latest `limit` successful probes, in seconds.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT duration FROM probes '
+                'WHERE error IS NULL AND duration IS NOT NULL '
+                'ORDER BY probed_at DESC LIMIT ?',
+                (limit,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def stalest(self, limit: int, age: float = 0.5) -> List[str]:
+        """
+
+        Return
+        ---
+        Up to `limit` fingerprints older than `age` of their outcome TTL,
+        oldest first.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT fingerprint FROM probes WHERE '
+                '(error IS NULL AND probed_at < ?) OR '
+                '(error IS NOT NULL AND probed_at < ?) '
+                'ORDER BY probed_at LIMIT ?',
+                (now - self.ttl * age, now - self.error_ttl * age, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def fingerprints(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute('SELECT fingerprint FROM probes').fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, fingerprints: Iterable[str]):
+        with self._lock:
+            self._conn.executemany(
+                'DELETE FROM probes WHERE fingerprint = ?',
+                [(fingerprint,) for fingerprint in fingerprints],
+            )
+            self._conn.commit()
+
+    def prune(self):
+        """Delete results that no outcome TTL would accept anymore."""
+        with self._lock:
+            cur = self._conn.execute(
+                'DELETE FROM probes WHERE probed_at < ?',
+                (time.time() - max(self.ttl, self.error_ttl),),
+            )
+            self._conn.commit()
+        logging.debug(f'[probe store] {cur.rowcount} expired results pruned')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
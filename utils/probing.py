@@ -0,0 +1,191 @@
+import bisect
+import collections
+import math
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Callable, Iterable, Sequence, Union
+
+import requests
+
+from . import utils
+
+
+class AdaptiveTimeout:
+    """Probe deadline following the durations of successful probes.
+
+    The deadline is the `percentile` of the last `window` durations plus
+    `margin`, kept within `[minimum, initial]`. It is `initial` until
+    `min_samples` durations are seen.
+    """
+
+    def __init__(
+        self,
+        initial: float = 10,
+        percentile: float = 0.95,
+        margin: float = 1,
+        minimum: float = 1,
+        window: int = 256,
+        min_samples: int = 16,
+    ) -> None:
+        self.initial = initial
+        self.percentile = percentile
+        self.margin = margin
+        self.minimum = minimum
+        self.min_samples = min_samples
+        self._durations: collections.deque = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._durations.append(seconds)
+
+    def quantile(self, q: float) -> Union[float, None]:
+        """
+
+        Return
+        ---
+        `None` until `min_samples` durations are seen.
+        """
+        with self._lock:
+            if len(self._durations) < self.min_samples:
+                return None
+            durations = sorted(self._durations)
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+
+    @property
+    def timeout(self) -> float:
+        value = self.quantile(self.percentile)
+        if value is None:
+            return self.initial
+        return min(self.initial, max(self.minimum, value + self.margin))
+
+
+class RetryBudget:
+    """Retries left for a whole run, shared by every worker."""
+
+    def __init__(self, retries: int) -> None:
+        self.left = retries
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            self.used += 1
+            return True
+
+
+def _start(fn, *args) -> Future:
+    """Run `fn(*args)` in a daemon thread, which can be abandoned."""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def hedged_egress_ip(
+    proxy: str,
+    urls: Sequence[str],
+    timeout: float,
+    hedge_after: float,
+    on_hedge: Union[Callable[[], None], None] = None,
+) -> str:
+    """Ask `urls[0]` for the egress IP through the http(s) proxy `proxy`, and
+    also `urls[1]` if no answer within `hedge_after` seconds, calling
+    `on_hedge`. The first answer wins.
+
+    Raise
+    ---
+    The error of the first request if all failed, `requests.Timeout` if none
+    answered within `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    futures = [_start(utils.get_egress_ip, proxy, urls[0], timeout)]
+    if len(urls) > 1 and hedge_after < timeout:
+        done, _ = wait(futures, hedge_after)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            futures.append(
+                _start(utils.get_egress_ip, proxy, urls[1], timeout - hedge_after)
+            )
+    pending = set(futures)
+    while pending:
+        done, pending = wait(
+            pending, max(0, deadline - time.monotonic()), FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    if futures[0].done() and futures[0].exception() is not None:
+        raise futures[0].exception()
+    raise requests.exceptions.Timeout(f'no egress IP within {timeout:.1f}s')
+
+
+class ProbePolicy:
+    """How egress probes of one run time out, hedge and retry.
+
+    Args
+    ---
+    - urls: echo endpoints, the second one is used for hedging,
+      `utils.egress_echo_url` and `utils.egress_hedge_url` if not given.
+    - timeout: deadlines, adapted as probes succeed.
+    - retry_ratio: retries of timed out or refused probes allowed per run,
+      relative to the proxies probed, see `budget`.
+    - hedge_percentile: hedge probes slower than this percentile of the
+      successful ones, half the deadline until enough are seen.
+    """
+
+    def __init__(
+        self,
+        urls: Union[Sequence[str], None] = None,
+        timeout: Union[AdaptiveTimeout, None] = None,
+        retry_ratio: float = 0.05,
+        hedge_percentile: Union[float, None] = 0.9,
+    ) -> None:
+        self.urls = urls
+        self.timeout = timeout or AdaptiveTimeout(initial=utils.egress_timeout)
+        self.retry_ratio = retry_ratio
+        self.hedge_percentile = hedge_percentile
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+    def budget(self, probes: int) -> RetryBudget:
+        """Retry budget of a run of `probes` probes."""
+        return RetryBudget(math.ceil(self.retry_ratio * probes))
+
+    def warm_up(self, durations: Iterable[float]):
+        """Seed the deadlines with durations of earlier successful probes."""
+        for seconds in durations:
+            self.timeout.observe(seconds)
+
+    def get_egress_ip(self, proxy: str) -> str:
+        urls = self.urls or [utils.egress_echo_url, utils.egress_hedge_url]
+        timeout = self.timeout.timeout
+        if self.hedge_percentile is None:
+            return utils.get_egress_ip(proxy, urls[0], timeout)
+        hedge_after = self.timeout.quantile(self.hedge_percentile)
+        if hedge_after is None:
+            hedge_after = timeout / 2
+        return hedged_egress_ip(proxy, urls, timeout, hedge_after, self._on_hedge)
+
+    def _on_hedge(self):
+        with self._lock:
+            self.hedged += 1
+
+    def summary(self, budget: Union[RetryBudget, None] = None):
+        text = f'deadline {self.timeout.timeout:.2f}s, {self.hedged} hedged'
+        if budget is not None:
+            text += f', {budget.used} retried, {budget.left} retries left'
+        return text
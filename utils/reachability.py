@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from ipaddress import ip_address
+from typing import List, Optional, Sequence, Tuple
+
+# seconds before the next address is tried while earlier attempts are still
+# pending, the "Connection Attempt Delay" of RFC 8305
+ATTEMPT_DELAY = 0.25
+
+# proxy types carried over UDP, a TCP connect says nothing about them
+UDP_TYPES = frozenset(['hysteria', 'hysteria2', 'tuic', 'wireguard'])
+
+# (addresses, port) of a server
+Target = Tuple[Sequence[str], int]
+# (fastest address, seconds to connect to it)
+Reach = Tuple[str, float]
+
+
+def interleave_families(addresses: Sequence[str]) -> List[str]:
+    """Alternate IPv6 and IPv4 addresses, starting with the family of the
+    first one and keeping the order within each family, as RFC 8305 asks."""
+    families: dict = {}
+    for address in addresses:
+        families.setdefault(ip_address(address).version, []).append(address)
+    if len(families) < 2:
+        return list(addresses)
+    first, second = families.values()
+    ret = []
+    for i in range(max(len(first), len(second))):
+        ret += first[i : i + 1] + second[i : i + 1]
+    return ret
+
+
+async def _connect(address: str, port: int) -> Reach:
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    _, writer = await asyncio.open_connection(address, port)
+    rtt = loop.time() - start
+    writer.close()
+    return address, rtt
+
+
+async def race(
+    addresses: Sequence[str],
+    port: int,
+    timeout: float,
+    delay: float = ATTEMPT_DELAY,
+) -> Optional[Reach]:
+    """Connect to `port` on `addresses` happy-eyeballs style: an attempt
+    starts every `delay` seconds, or as soon as the previous one failed, and
+    the first established connection wins and cancels the others.
+
+    Return
+    ---
+    `(address, connect RTT)` of the winner, `None` if no address accepted a
+    connection within `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    queue = interleave_families(addresses)
+    pending: set = set()
+    try:
+        while queue or pending:
+            if queue:
+                pending.add(asyncio.ensure_future(_connect(queue.pop(0), port)))
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=min(delay, remaining) if queue else remaining,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _check_all(
+    targets: Sequence[Target], timeout: float, concurrency: int, delay: float
+):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def check(addresses: Sequence[str], port: int):
+        async with semaphore:
+            return await race(addresses, port, timeout, delay)
+
+    return await asyncio.gather(*[check(*target) for target in targets])
+
+
+def check_reachability(
+    targets: Sequence[Target],
+    timeout: float = 3,
+    concurrency: int = 256,
+    delay: float = ATTEMPT_DELAY,
+) -> List[Optional[Reach]]:
+    """Race TCP connects to every target, each distinct target at most once.
+
+    Args
+    ---
+    - targets: `(addresses, port)` pairs, all resolved addresses of a server.
+    - concurrency: targets checked at once, each may hold a socket per
+      address.
+
+    Return
+    ---
+    `(fastest address, connect RTT)` for each target, in order, `None` for
+    those not accepting connections.
+    """
+    distinct = list(dict.fromkeys((tuple(a), p) for a, p in targets))
+    logging.info(
+        f'[reach] {len(targets)} targets, {len(distinct)} distinct, '
+        f'timeout {timeout}s'
+    )
+    if not distinct:
+        return []
+    results = dict(
+        zip(distinct, asyncio.run(_check_all(distinct, timeout, concurrency, delay)))
+    )
+    return [results[(tuple(a), p)] for a, p in targets]
+
+
+def tcp_port(port) -> Optional[int]:
+    """`port` of a proxy as an int, `None` if it is not a valid TCP port."""
+    try:
+        port = int(port)
+    except (TypeError, ValueError):
+        return None
+    return port if 0 < port < 65536 else None
+
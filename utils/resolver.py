@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+
+class DNSCache:
+    """Hostname to addresses cache with per-entry expiry.
+
+    `getaddrinfo` does not expose record TTLs, so every entry gets `ttl`
+    seconds, or `negative_ttl` seconds for names without any record.
+    Entries are persisted as JSON if `path` is given.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, None] = None,
+        ttl: float = 3600,
+        negative_ttl: float = 300,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: Dict[str, Tuple[float, List[str]]] = {}
+        if path is not None:
+            self.load()
+
+    def get(self, hostname: str) -> Optional[List[str]]:
+        """
+
+        Return
+        ---
+        `None` on cache miss, otherwise the cached addresses (may be empty).
+        """
+        try:
+            expire, addresses = self._entries[hostname]
+        except KeyError:
+            return None
+        if expire < time.time():
+            del self._entries[hostname]
+            return None
+        return addresses
+
+    def set(self, hostname: str, addresses: List[str]):
+        ttl = self.ttl if addresses else self.negative_ttl
+        self._entries[hostname] = (time.time() + ttl, addresses)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fd:
+                entries = json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return
+        now = time.time()
+        for hostname, (expire, addresses) in entries.items():
+            if expire >= now:
+                self._entries[hostname] = (expire, addresses)
+
+    def save(self):
+        if self.path is None:
+            return
+        now = time.time()
+        entries = {k: v for k, v in self._entries.items() if v[0] >= now}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(entries, fd)
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+async def _lookup(hostname: str, semaphore: asyncio.Semaphore):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        try:
+            infos = await loop.getaddrinfo(hostname, None)
+        except (socket.gaierror, UnicodeError):
+            return hostname, []
+    # dedupe, order kept
+    return hostname, list(dict.fromkeys(info[4][0] for info in infos))
+
+
+async def _lookup_all(hostnames: Iterable[str], concurrency: int):
+    loop = asyncio.get_running_loop()
+    # `getaddrinfo` runs in the default executor, size it to the limit
+    loop.set_default_executor(ThreadPoolExecutor(concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(
+        *[_lookup(hostname, semaphore) for hostname in hostnames]
+    )
+
+
+def resolve_hostnames(
+    hostnames: Iterable[str],
+    concurrency: int = 64,
+    cache: Union[DNSCache, None] = None,
+) -> Dict[str, List[str]]:
+    """Resolve hostnames concurrently, each distinct name at most once.
+
+    Return
+    ---
+    Dict from hostname to its addresses, empty list for no record.
+    """
+    ret: Dict[str, List[str]] = {}
+    misses = []
+    for hostname in dict.fromkeys(hostnames):
+        addresses = cache.get(hostname) if cache is not None else None
+        if addresses is None:
+            misses.append(hostname)
+        else:
+            ret[hostname] = addresses
+    logging.info(
+        f'[dns] {len(ret) + len(misses)} hostnames, '
+        f'{len(ret)} cached, {len(misses)} to resolve'
+    )
+
+    if misses:
+        for hostname, addresses in asyncio.run(_lookup_all(misses, concurrency)):
+            ret[hostname] = addresses
+            if cache is not None:
+                cache.set(hostname, addresses)
+    if cache is not None:
+        cache.save()
+    return ret
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import marshal
+import os
+import stat
+import tempfile
+from typing import IO, Any, Union
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    # pyyaml built without libyaml
+    from yaml import SafeDumper, SafeLoader
+
+parse_cache_dir = os.path.join('assets', 'cache', 'yaml')
+parse_cache_size = 64
+CACHE_SUFFIX = '.marshal'
+LEGACY_CACHE_SUFFIX = '.pickle'
+
+# mkstemp creates 0600 files, new outputs get the permissions of open()
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+class ParseCache:
+    """Parsed documents on disk, like YAML configs or render plans, keyed by
+    the SHA-256 of their raw bytes.
+
+    Only the `size` most recently used documents are kept. Documents are
+    stored with `marshal`, which builds plain data and runs no code, so only
+    dicts, lists, tuples, sets, strings, bytes, numbers, booleans and `None`
+    are cached. Subscriptions hold credentials: the directory and files are
+    private to the user, and files owned by someone else or writable by
+    others are not loaded.
+    """
+
+    def __init__(self, path: str, size: int = 64) -> None:
+        self.path = path
+        self.size = size
+
+    def _file(self, digest: str):
+        return os.path.join(self.path, digest + CACHE_SUFFIX)
+
+    def get(self, digest: str):
+        """
+
+        Raise
+        ---
+        `KeyError` on cache miss.
+        """
+        try:
+            with open(self._file(digest), 'rb') as fd:
+                if not _is_private(os.fstat(fd.fileno())):
+                    logging.warning(f'[cache] ignore {fd.name}, not private')
+                    raise KeyError(digest)
+                data = marshal.load(fd)
+        except (OSError, EOFError, ValueError, TypeError):
+            raise KeyError(digest)
+        # mark as recently used
+        os.utime(self._file(digest))
+        return data
+
+    def put(self, digest: str, data: Any):
+        """Store `data`, skipped if it holds other types than `marshal`
+        supports, e.g. YAML timestamps."""
+        try:
+            raw = marshal.dumps(data)
+        except ValueError:
+            logging.debug(f'[cache] {digest[:12]} not cached, unsupported types')
+            return
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        st = os.stat(self.path)
+        if hasattr(os, 'getuid') and st.st_uid == os.getuid() and st.st_mode & 0o077:
+            # created by an older version, open to others
+            os.chmod(self.path, 0o700)
+        # unique, processes may put the same digest at once, and private
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp, self._file(digest))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self._prune()
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            try:
+                if entry.name.endswith(LEGACY_CACHE_SUFFIX):
+                    # pickled by older versions, never loaded
+                    os.remove(entry.path)
+                elif entry.name.endswith(CACHE_SUFFIX):
+                    entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                # pruned by another process meanwhile
+                pass
+        if len(entries) <= self.size:
+            return
+        entries.sort()
+        for _, path in entries[: len(entries) - self.size]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _is_private(st: os.stat_result) -> bool:
+    """Whether a cache file or directory is owned by this user and not
+    writable by others. Always `True` without POSIX ownership."""
+    if not hasattr(os, 'getuid'):
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def loads_yaml(raw: Union[bytes, str], cache: bool = True):
+    """Parse YAML with libyaml if available, reusing earlier parses of the
+    same bytes."""
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    if not cache:
+        return yaml.load(raw, Loader=SafeLoader)
+
+    digest = hashlib.sha256(raw).hexdigest()
+    parse_cache = ParseCache(parse_cache_dir, parse_cache_size)
+    try:
+        data = parse_cache.get(digest)
+        logging.debug(f'[yaml] parse cache hit {digest[:12]}')
+        return data
+    except KeyError:
+        pass
+    data = yaml.load(raw, Loader=SafeLoader)
+    try:
+        parse_cache.put(digest, data)
+    except OSError as e:
+        logging.warning(f'[yaml] failed to cache parse result, {e}')
+    return data
+
+
+def load_yaml(url_or_path: str) -> dict:
+    logging.info(f'load yaml file from {url_or_path}')
+    try:
+        ret = load_yaml_from_path(url_or_path)
+    except FileNotFoundError as fileNotFoundError:
+        import requests
+
+        try:
+            ret = load_yaml_from_url(url_or_path)
+        except (
+            requests.exceptions.MissingSchema,
+            requests.exceptions.InvalidSchema,
+        ):
+            raise fileNotFoundError
+    return ret
+
+
+def load_yaml_from_url(url: str):
+    import requests
+
+    headers = {'charset': 'utf-8'}
+    r = requests.get(
+        url=url,
+        headers=headers,
+    )
+    ret = loads_yaml(r.content)
+    return ret
+
+
+def load_yaml_from_path(path: str):
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'{path} not found')
+    with open(path, 'rb') as fd:
+        ret = loads_yaml(fd.read())
+    return ret
+
+
+def cache_yaml(raw: Union[bytes, str], data: Any):
+    """Remember `data` as the parse result of `raw`, e.g. right after dumping
+    it, so the next `loads_yaml` of the same bytes is a cache hit."""
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    digest = hashlib.sha256(raw).hexdigest()
+    try:
+        ParseCache(parse_cache_dir, parse_cache_size).put(digest, data)
+    except OSError as e:
+        logging.warning(f'[yaml] failed to cache parse result, {e}')
+
+
+def write_atomic(path: str, data: bytes, suffix: str = '.tmp'):
+    """Replace `path` by `data` at once, readers see the old or the new
+    content but never a partial file.
+
+    Notice
+    ---
+    The temporary file is unique, writers of the same path do not clobber
+    each other. An existing file keeps its permissions.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix=suffix)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def dump_yaml(data: Any, stream: Union[IO, None] = None, **kwargs):
+    """
+
+    Return
+    ---
+    The YAML text if `stream` is `None`.
+    """
+    return yaml.dump(data, stream, Dumper=SafeDumper, allow_unicode=True, **kwargs)
+
+
+def dump_json(data: Any, stream: IO):
+    json.dump(data, stream, ensure_ascii=False)
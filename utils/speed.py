@@ -0,0 +1,89 @@
+import time
+from typing import Callable, NamedTuple, Union
+
+# download endpoint of the speed test, should serve at least
+# `speed_max_bytes` bytes
+speed_test_url = 'https://speed.cloudflare.com/__down?bytes=1048576'
+speed_timeout = 10
+speed_max_bytes = 2**20
+SPEED_CHUNK_SIZE = 2**16
+
+
+class SpeedSample(NamedTuple):
+    # seconds of a HEAD request on a new connection through the proxy, i.e.
+    # the proxy handshake plus one round trip
+    latency: float
+    # seconds from sending the download request on the warm connection to
+    # its first body byte
+    ttfb: float
+    # bytes per second of the download, first byte included
+    throughput: float
+
+
+def measure_speed(
+    proxy: str,
+    url: Union[str, None] = None,
+    timeout: Union[float, None] = None,
+    max_bytes: Union[int, None] = None,
+) -> Union[SpeedSample, None]:
+    """Measure the http(s) proxy `proxy` against `url`, `speed_test_url` by
+    default.
+
+    Return
+    ---
+    `None` if any request failed.
+    """
+    import requests
+
+    url = url or speed_test_url
+    timeout = timeout or speed_timeout
+    max_bytes = max_bytes or speed_max_bytes
+    proxies = {'http': proxy, 'https': proxy}
+    session = requests.Session()
+    try:
+        start = time.perf_counter()
+        r = session.head(url, proxies=proxies, timeout=timeout)
+        r.raise_for_status()
+        latency = time.perf_counter() - start
+
+        start = time.perf_counter()
+        size = 0
+        ttfb = None
+        with session.get(url, proxies=proxies, timeout=timeout, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(SPEED_CHUNK_SIZE):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                size += len(chunk)
+                if size >= max_bytes:
+                    break
+        elapsed = time.perf_counter() - start
+    except requests.RequestException:
+        return None
+    finally:
+        session.close()
+    if ttfb is None:
+        # empty body
+        return None
+    return SpeedSample(latency, ttfb, size / elapsed)
+
+
+# what proxies can be ordered by, best first
+ORDER_KEYS = ('latency', 'ttfb', 'throughput')
+
+
+def speed_key(order_by: str) -> Callable[[Union[SpeedSample, None]], tuple]:
+    """Sort key over samples, best first, missing samples last."""
+    if order_by == 'throughput':
+        return lambda sample: (sample is None, -sample.throughput if sample else 0)
+    field = SpeedSample._fields.index(order_by)
+    return lambda sample: (sample is None, sample[field] if sample else 0)
+
+
+def format_speed(sample: Union[SpeedSample, None]):
+    if sample is None:
+        return 'failed'
+    return (
+        f'latency {sample.latency * 1000:.0f}ms, ttfb {sample.ttfb * 1000:.0f}ms, '
+        f'{sample.throughput / 1024:.0f}KiB/s'
+    )
@@ -3,42 +3,71 @@ import ipaddress
 import math
 import socket
 import sys
-from typing import Mapping, MutableMapping, MutableSequence, Sequence, Union
-import yaml
+from typing import (
+    Dict,
+    Hashable,
+    List,
+    Mapping,
+    MutableMapping,
+    MutableSequence,
+    Sequence,
+    Union,
+)
 import os
-import requests
 
+from .serialization import (
+    load_yaml,
+    load_yaml_from_path,
+    load_yaml_from_url,
+    loads_yaml,
+)
 
-def load_yaml(url_or_path: str) -> dict:
-    logging.info(f'load yaml file from {url_or_path}')
-    try:
-        ret = load_yaml_from_path(url_or_path)
-    except FileNotFoundError as fileNotFoundError:
-        try:
-            ret = load_yaml_from_url(url_or_path)
-        except (
-            requests.exceptions.MissingSchema,
-            requests.exceptions.InvalidSchema,
-        ):
-            raise fileNotFoundError
-    return ret
+# where and how long egress probes ask for the egress IP, slow probes are
+# hedged against the second endpoint
+egress_echo_url = 'https://api64.ipify.org'
+egress_hedge_url = 'https://icanhazip.com'
+egress_timeout = 10
 
 
-def load_yaml_from_url(url: str):
-    headers = {'charset': 'utf-8'}
-    r = requests.get(
-        url=url,
-        headers=headers,
-    )
-    ret = yaml.safe_load(r.text)
-    return ret
+def load_yamls(
+    urls_or_paths: Sequence[str], timeout: float = 30, retries: int = 3
+) -> List[dict]:
+    """Like `load_yaml`, but fetch all URLs concurrently, revalidating
+    earlier downloads with conditional GETs.
 
+    Return
+    ---
+    Parsed configs, in the order of `urls_or_paths`.
+    """
+    ret = [None] * len(urls_or_paths)
+    urls = []
+    for i, src in enumerate(urls_or_paths):
+        if os.path.isfile(src):
+            logging.info(f'load yaml file from {src}')
+            ret[i] = load_yaml_from_path(src)
+        else:
+            urls.append((i, src))
+    if not urls:
+        return ret
+
+    import requests
 
-def load_yaml_from_path(path: str):
-    if not os.path.isfile(path):
-        raise FileNotFoundError(f'{path} not found')
-    with open(path, 'r') as fd:
-        ret = yaml.safe_load(fd)
+    from .fetch import HTTPCache, fetch_many, http_cache_dir
+
+    try:
+        bodies = fetch_many(
+            [url for _, url in urls],
+            timeout=timeout,
+            retries=retries,
+            cache=HTTPCache(http_cache_dir),
+        )
+    except (
+        requests.exceptions.MissingSchema,
+        requests.exceptions.InvalidSchema,
+    ) as e:
+        raise FileNotFoundError(f'neither a file nor a URL, {e}')
+    for (i, _), body in zip(urls, bodies):
+        ret[i] = loads_yaml(body)
     return ret
 
 
@@ -55,6 +84,37 @@ def make_simple_clash_config(
     return config
 
 
+def make_listeners_clash_config(
+    controller_port: int,
+    listener_ports: Sequence[int],
+    proxies: MutableSequence[MutableMapping],
+):
+    """One inbound listener per proxy, so they can be probed at once.
+
+    Notice
+    ---
+    Needs a Clash core supporting `listeners`, e.g. Clash.Meta.
+    """
+    assert len(proxies) <= len(listener_ports)
+    config = {
+        'external-controller': f':{controller_port}',
+        'ipv6': True,
+        'mode': 'rule',
+        'listeners': [
+            {
+                'name': f'probe-{i}',
+                'type': 'mixed',
+                'listen': '127.0.0.1',
+                'port': port,
+                'proxy': proxy['name'],
+            }
+            for i, (port, proxy) in enumerate(zip(listener_ports, proxies))
+        ],
+    }
+    config.update({'proxies': proxies})
+    return config
+
+
 def my_nslookup(hostname):
     try:
         r = socket.getaddrinfo(hostname, None)
@@ -63,9 +123,26 @@ def my_nslookup(hostname):
     return [e[4][0] for e in r]
 
 
-def get_egress_ip(proxy: Union[None, Mapping]):
-    r = requests.get('https://api64.ipify.org', proxies=proxy, timeout=10)
-    return r.text
+def get_egress_ip(
+    proxy: Union[None, str, Mapping],
+    url: Union[str, None] = None,
+    timeout: Union[float, None] = None,
+):
+    """
+
+    Args
+    ---
+    - proxy: `requests` proxies, or one http(s) proxy URL for both schemes.
+    """
+    import requests
+
+    if isinstance(proxy, str):
+        proxy = {'http': proxy, 'https': proxy}
+    r = requests.get(
+        url or egress_echo_url, proxies=proxy, timeout=timeout or egress_timeout
+    )
+    # too short for charset guessing
+    return r.content.decode('utf-8').strip()
 
 
 def designate_jobs(jobs: Sequence, max_worker_count: int):
@@ -92,6 +169,33 @@ def designate_jobs(jobs: Sequence, max_worker_count: int):
     return ret
 
 
+def interleave(groups: Sequence[Hashable], subgroups: Sequence[Hashable]):
+    """
+
+    Return
+    ---
+    Indices of `groups`, taken round-robin over the groups and, within a
+    group, round-robin over its subgroups.
+
+    Notice
+    ---
+    Order kept within a subgroup.
+    """
+    tree: Dict[Hashable, Dict[Hashable, List[int]]] = {}
+    for i, (group, subgroup) in enumerate(zip(groups, subgroups)):
+        tree.setdefault(group, {}).setdefault(subgroup, []).append(i)
+    return _round_robin(
+        [_round_robin(list(subgroups.values())) for subgroups in tree.values()]
+    )
+
+
+def _round_robin(sequences: List[List[int]]):
+    ret = []
+    for i in range(max(map(len, sequences), default=0)):
+        ret += [sequence[i] for sequence in sequences if i < len(sequence)]
+    return ret
+
+
 def is_tcp_port_in_use(port: int, addr='127.0.0.1', timeout=0.01):
     s = None
     ret = False